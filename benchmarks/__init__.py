@@ -0,0 +1,11 @@
+# benchmark suite for the pipeline stages on synthetic municipality frames, run via `python -m benchmarks`
+
+import subprocess
+
+
+# current git revision of the repo, so that results can be tracked over time
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
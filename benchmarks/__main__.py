@@ -0,0 +1,171 @@
+import argparse
+import itertools
+import json
+import platform
+import resource
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from municipality_selection.ingest import read_from_input
+from municipality_selection.letters import calc_letters
+from municipality_selection.replacements import select_replacements
+from municipality_selection.select import run_selection
+from municipality_selection.stats import calc_stats
+from municipality_selection.stratify import assign_groups, build_group_index, define_classes
+from municipality_selection.streams import REPLACEMENTS, RandomStreams
+from municipality_selection.targets import assign_targets, calc_measure, init_params
+from municipality_selection.weights import calc_weights
+
+from . import git_revision
+from .frames import synthetic_frame, write_input_file
+
+
+# call function and measure wall time and peak memory allocated during the call
+def measure(fn, *args, trace_memory: bool = True, **kwargs):
+    if trace_memory:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    wall = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+
+    return result, {'wall_s': wall, 'peak_mem_mb': peak / 2**20 if peak is not None else None}
+
+
+# Run all stages once on a synthetic frame and return one record per stage. Draws are the number of units drawn by the
+# PPS selection in a stage.
+def run_benchmark(num_muns: int, num_strata: int, K: int, workers: int | None, max_xlsx_rows: int,
+                  trace_memory: bool = True, n_init: int = 80, seed: int = 0):
+    records = []
+
+    def record(stage: str, metrics: dict, draws: int | None = None):
+        records.append({
+            'stage': stage,
+            **metrics,
+            'draws': draws,
+            'draws_per_s': draws / metrics['wall_s'] if draws else None,
+        })
+        print(f"{num_muns} units, {num_strata} strata -- {stage}: {metrics['wall_s']:.3f}s")
+
+    classes = define_classes()
+    states, muns = synthetic_frame(num_muns=num_muns, num_strata=num_strata, seed=seed)
+
+    # reading the input file is only benchmarked for frames that fit into a spreadsheet
+    if num_muns <= max_xlsx_rows:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_file_path = Path(tmpdir) / 'input.xlsx'
+            write_input_file(input_file_path, states, muns)
+            _, metrics = measure(read_from_input, input_file_path, classes, trace_memory=trace_memory)
+            record('ingest', metrics)
+
+    # size classes, groups, and group index
+    (muns, groups), metrics = measure(assign_groups, muns, classes, trace_memory=trace_memory)
+    group_index, metrics_index = measure(build_group_index, muns, groups, trace_memory=trace_memory)
+    record('stratify', {
+        'wall_s': metrics['wall_s'] + metrics_index['wall_s'],
+        'peak_mem_mb': max(metrics['peak_mem_mb'], metrics_index['peak_mem_mb']) if trace_memory else None,
+    })
+
+    # targets for the given initial target (which has to be at least the number of strata)
+    def targets():
+        params = init_params(groups, n_init=n_init)
+        groups_targets, params = assign_targets(groups, params)
+        muns_measure = calc_measure(muns, params)
+        return groups_targets, params, muns_measure
+
+    (groups, params, muns), metrics = measure(targets, trace_memory=trace_memory)
+    record('targets', metrics)
+
+    # selection, letters, and replacements from the random streams of a fixed seed
+    results, metrics = measure(run_selection, muns, groups, group_index, streams=RandomStreams([seed]), trace_memory=trace_memory)
+    record('select', metrics, draws=int(params['n*']))
+
+    results, metrics = measure(calc_letters, results, muns, groups, params, trace_memory=trace_memory)
+    record('letters', metrics)
+
+    _, metrics = measure(calc_weights, results, muns, groups, group_index, trace_memory=trace_memory)
+    record('weights', metrics)
+
+    _, metrics = measure(select_replacements, results, muns, groups, group_index, streams=RandomStreams([seed], REPLACEMENTS), trace_memory=trace_memory)
+    record('replacements', metrics, draws=5 * int((groups['ng'] != 0).sum()))
+
+    # statistics over K iterations
+    _, metrics = measure(calc_stats, muns, groups, group_index, [seed], [K], workers=workers, trace_memory=trace_memory)
+    record('stats', metrics, draws=int(params['n*']) * K)
+
+    return records
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Benchmark the pipeline stages on synthetic municipality frames with heavy-tailed populations.',
+    )
+    parser.add_argument('--sizes', type=int, nargs='+', default=[11000, 100000, 1000000],
+                        help='numbers of municipalities in the synthetic frames')
+    parser.add_argument('--strata', type=int, nargs='+', default=[48],
+                        help='numbers of strata (states times size classes) in the synthetic frames')
+    parser.add_argument('--n-init', type=int, default=80,
+                        help='initial target for number of municipalities to select (at least the number of strata)')
+    parser.add_argument('--K', type=int, default=10,
+                        help='number of iterations in the stats stage')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes in the stats stage')
+    parser.add_argument('--max-xlsx-rows', type=int, default=20000,
+                        help='largest frame for which reading the input file is benchmarked')
+    parser.add_argument('--no-trace-memory', dest='trace_memory', action='store_false',
+                        help='do not trace peak memory, which slows down stages with many small allocations')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for the synthetic frames and the selection')
+    parser.add_argument('--output', type=Path, default=Path('output') / 'benchmarks.jsonl',
+                        help='file to append the results to as JSON lines')
+    args = parser.parse_args(argv)
+
+    # metadata of this run
+    run = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'n_init': args.n_init,
+        'K': args.K,
+        'workers': args.workers,
+    }
+
+    # run benchmarks for all combinations of sizes and numbers of strata
+    records = []
+    for num_muns, num_strata in itertools.product(args.sizes, args.strata):
+        for r in run_benchmark(num_muns, num_strata, args.K, args.workers, args.max_xlsx_rows, args.trace_memory, args.n_init, args.seed):
+            records.append({**run, 'num_muns': num_muns, 'num_strata': num_strata, **r})
+
+    # peak resident memory of the whole run (in kilobytes on Linux)
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    for r in records:
+        r['max_rss_mb'] = max_rss_mb
+
+    # append results and print summary
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, 'a') as f:
+        for r in records:
+            f.write(json.dumps(r) + '\n')
+
+    print(
+        pd.DataFrame.from_records(records)
+        .set_index(['num_muns', 'num_strata', 'stage'])
+        .filter(['wall_s', 'peak_mem_mb', 'draws', 'draws_per_s'])
+        .round(3)
+        .to_string()
+    )
+
+
+if __name__ == '__main__':
+    main()
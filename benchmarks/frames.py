@@ -0,0 +1,77 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from municipality_selection.ingest import muns_dtypes
+from municipality_selection.stratify import assign_groups
+
+
+# Synthetic municipality frame with a heavy-tailed (Zipf-like) population size. Populations are drawn as a multiple of
+# a minimum size with a Zipf distributed factor, which for the default exponent gives a largest municipality of a few
+# million out of the ~11k German ones, like the real frame. The number of states is chosen such that, with the given
+# three size classes, there are (at least) the given number of strata.
+def synthetic_frame(num_muns: int = 11000, num_strata: int = 48, zipf_a: float = 1.9, Nm_min: int = 100,
+                    Nm_max: int = 10**8, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    num_states = -(-num_strata // 3)
+
+    # states with names
+    states = pd.DataFrame(
+        {'State-Name': [f"State {i}" for i in range(1, num_states + 1)]},
+        index=pd.Index(np.arange(1, num_states + 1), name='State-ID'),
+    )
+
+    # heavy-tailed populations and states with uneven shares of muns
+    Nm = np.minimum(Nm_min * rng.zipf(zipf_a, num_muns), Nm_max).astype(np.float64)
+    state_weights = rng.dirichlet(np.ones(num_states))
+    state_ids = rng.choice(states.index.values, size=num_muns, p=state_weights)
+
+    # muns with the same columns and dtypes as read from the input file, with the AGS as integer key
+    mun_names = pd.Series(np.arange(num_muns)).astype(str).radd('Gemeinde ')
+    muns = pd.DataFrame({
+        'Mun-Name': (mun_names + ', Stadt').values,
+        'Mun-Shortname': mun_names.values,
+        'State-ID': state_ids,
+        'Nm': Nm,
+        'Urbanisation': rng.integers(1, 4, num_muns).astype(str),
+        'LONG': rng.uniform(6.0, 15.0, num_muns),
+        'LAT': rng.uniform(47.5, 55.0, num_muns),
+    }, index=pd.Index(state_ids * 10**10 + np.arange(num_muns), name='Mun-ID')).astype(muns_dtypes)
+
+    return states, muns
+
+
+# synthetic frame with size classes and groups, as returned by read_from_input
+def synthetic_input(classes: pd.DataFrame, **kwargs):
+    states, muns = synthetic_frame(**kwargs)
+    muns, groups = assign_groups(muns, classes)
+
+    return states, muns, groups
+
+
+# write frame to an XLSX file in the layout of the DESTATIS input file, so that read_from_input can be benchmarked
+def write_input_file(fpath: Path, states: pd.DataFrame, muns: pd.DataFrame):
+    empty = [None] * 20
+
+    # state records (Satzart 10)
+    rows = [
+        ['10', None, f"{state_id:02d}", *empty[:4], state_name, *empty[8:]]
+        for state_id, state_name in states['State-Name'].items()
+    ]
+
+    # municipality records (Satzart 60), with the Mun-ID split into its parts
+    mun_ids = [f"{mun_id % 10**10:010d}" for mun_id in muns.index.values]
+    for mun_id, (name, state_id, Nm, urbanisation, long, lat) in zip(
+        mun_ids,
+        muns[['Mun-Name', 'State-ID', 'Nm', 'Urbanisation', 'LONG', 'LAT']].itertuples(index=False),
+    ):
+        rows.append([
+            '60', None, f"{state_id:02d}", mun_id[:1], mun_id[1:3], mun_id[3:7], mun_id[7:], name, None,
+            f"{Nm:.0f}", None, None, None, None, f"{long}".replace('.', ','), f"{lat}".replace('.', ','),
+            None, None, None, urbanisation,
+        ])
+
+    with pd.ExcelWriter(fpath) as writer:
+        pd.DataFrame([['']]).to_excel(writer, sheet_name='Deckblatt', index=False, header=False)
+        pd.DataFrame(rows).to_excel(writer, sheet_name='Onlineprodukt_Gemeinden', index=False, header=False, startrow=6)
@@ -0,0 +1,190 @@
+import argparse
+import json
+import platform
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy
+from samplics import SelectMethod
+from samplics.sampling import SampleSelection
+
+from municipality_selection.samplers import samplers
+from municipality_selection.select import run_selection
+from municipality_selection.stratify import build_group_index, define_classes
+from municipality_selection.streams import RandomStreams
+from municipality_selection.targets import assign_targets, calc_measure, init_params
+
+from . import git_revision
+from .frames import synthetic_input
+
+
+# samplics designs that the sampling methods are compared with (PPS-SYS is reproduced exactly by pps_sys, and the
+# Rao-Sampford method draws from the same design as sampford)
+samplics_methods = {
+    'samplics_pps_sys': SelectMethod.pps_sys,
+    'samplics_pps_rs': SelectMethod.pps_rs,
+}
+
+
+# synthetic frame with targets for the given initial target (which has to be at least the number of strata) and measure
+# of size
+def synthetic_design(num_muns: int, num_strata: int, n_init: int, seed: int):
+    _, muns, groups = synthetic_input(define_classes(), num_muns=num_muns, num_strata=num_strata, seed=seed)
+    group_index = build_group_index(muns, groups)
+    params = init_params(groups, n_init=n_init)
+    groups, params = assign_targets(groups, params)
+    muns = calc_measure(muns, params)
+
+    return muns, groups, group_index
+
+
+# Inclusion probabilities of the design: one for the certainty muns, and proportional to the measure of size among the
+# other muns of a group, summing to the target of the group minus its certainty muns.
+def inclusion_probs(muns: pd.DataFrame, groups: pd.DataFrame, certainty: pd.Series):
+    group_ids = muns['Group-ID']
+    mos = muns['Mm'].where(~certainty, 0.0)
+    samp_sizes = groups['ng'] - certainty.groupby(group_ids).sum().reindex(groups.index, fill_value=0)
+
+    return (mos / mos.groupby(group_ids).transform('sum') * group_ids.map(samp_sizes)).fillna(0.0).where(~certainty, 1.0)
+
+
+# Exactness of the inclusion probabilities pi from the number of times each unit was selected in K iterations: the
+# largest absolute deviation of the inclusion frequency from pi, and the largest and the mean squared z-score of the
+# deviations over the non-certainty units (which are about 1 on average if the inclusion probabilities are exact, and
+# grow with K otherwise).
+def exactness(selected: np.ndarray, pi: np.ndarray, K: int):
+    sampled = (pi > 0) & (pi < 1)
+    freq = selected[sampled] / K
+    z = (freq - pi[sampled]) / np.sqrt(pi[sampled] * (1 - pi[sampled]) / K)
+
+    return {
+        'max_abs_dev': float(np.abs(freq - pi[sampled]).max()),
+        'max_abs_z': float(np.abs(z).max()),
+        'mean_z2': float((z ** 2).mean()),
+    }
+
+
+# selection K times with samplics, calling it once per group and iteration on the non-certainty muns (as in the
+# notebook), and returning the number of times selected
+def samplics_selection(muns: pd.DataFrame, groups: pd.DataFrame, certainty: pd.Series, select_method: SelectMethod,
+                       K: int, seed: int):
+    np.random.seed(seed)
+    sel = SampleSelection(method=select_method, strat=False, wr=False)
+    selected = pd.Series(np.where(certainty, K, 0), index=muns.index)
+
+    noncertainty = muns.loc[~certainty]
+    samp_sizes = groups['ng'] - certainty.groupby(muns['Group-ID']).sum().reindex(groups.index, fill_value=0)
+    for group_id, group_muns in noncertainty.groupby('Group-ID'):
+        samp_size = int(samp_sizes.loc[group_id])
+        if samp_size == 0:
+            continue
+        for _ in range(K):
+            hits = sel.select(
+                samp_unit=group_muns.index.tolist(),
+                samp_size=samp_size,
+                stratum=None,
+                mos=group_muns['Mm'].values,
+                to_dataframe=True,
+                sample_only=False,
+            )['_sample'].astype(int).values
+            selected.loc[group_muns.index] += hits
+
+    return selected.values
+
+
+# Run every sampling method and samplics baseline K times on a synthetic frame and return one record per method with
+# its throughput and the exactness of its inclusion probabilities.
+def run_benchmark(num_muns: int, num_strata: int, methods: list[str], K: int, K_samplics: int, n_init: int = 80,
+                  seed: int = 0):
+    muns, groups, group_index = synthetic_design(num_muns, num_strata, n_init, seed)
+    certainty = run_selection(muns, groups, group_index, streams=RandomStreams([seed]))['Certainty']
+    pi = inclusion_probs(muns, groups, certainty).values
+    num_draws = int(groups['ng'].sum() - certainty.sum())
+
+    records = []
+    for method in methods:
+        t0 = time.perf_counter()
+        if method in samplics_methods:
+            this_K = K_samplics
+            selected = samplics_selection(muns, groups, certainty, samplics_methods[method], this_K, seed)
+        else:
+            this_K = K
+            selected = run_selection(muns, groups, group_index, K, streams=RandomStreams([seed]), method=method)['Selected'].values
+        wall = time.perf_counter() - t0
+
+        records.append({
+            'method': method,
+            'K': this_K,
+            'wall_s': wall,
+            'draws': num_draws * this_K,
+            'draws_per_s': num_draws * this_K / wall,
+            **exactness(selected, pi, this_K),
+        })
+        print(f"{num_muns} units, {num_strata} strata -- {method}: {wall:.3f}s")
+
+    return records
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.samplers',
+        description='Benchmark the sampling methods against samplics for throughput and exactness of the inclusion '
+                    'probabilities on synthetic municipality frames.',
+    )
+    parser.add_argument('--sizes', type=int, nargs='+', default=[11000],
+                        help='numbers of municipalities in the synthetic frames')
+    parser.add_argument('--strata', type=int, nargs='+', default=[48],
+                        help='numbers of strata (states times size classes) in the synthetic frames')
+    parser.add_argument('--methods', nargs='+', default=[*samplers, *samplics_methods],
+                        choices=[*samplers, *samplics_methods],
+                        help='sampling methods and samplics baselines to benchmark')
+    parser.add_argument('--n-init', type=int, default=80,
+                        help='initial target for number of municipalities to select (at least the number of strata)')
+    parser.add_argument('--K', type=int, default=1000,
+                        help='number of iterations of the sampling methods')
+    parser.add_argument('--K-samplics', type=int, default=20,
+                        help='number of iterations of the samplics baselines, which are called once per group and iteration')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for the synthetic frames and the selection')
+    parser.add_argument('--output', type=Path, default=Path('output') / 'benchmarks_samplers.jsonl',
+                        help='file to append the results to as JSON lines')
+    args = parser.parse_args(argv)
+
+    # metadata of this run
+    run = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'scipy': scipy.__version__,
+        'n_init': args.n_init,
+    }
+
+    # run benchmarks for all combinations of sizes and numbers of strata
+    records = []
+    for num_muns in args.sizes:
+        for num_strata in args.strata:
+            for r in run_benchmark(num_muns, num_strata, args.methods, args.K, args.K_samplics, args.n_init, args.seed):
+                records.append({**run, 'num_muns': num_muns, 'num_strata': num_strata, **r})
+
+    # append results and print summary
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, 'a') as f:
+        for r in records:
+            f.write(json.dumps(r) + '\n')
+
+    print(
+        pd.DataFrame.from_records(records)
+        .set_index(['num_muns', 'num_strata', 'method'])
+        .filter(['K', 'wall_s', 'draws_per_s', 'max_abs_dev', 'max_abs_z', 'mean_z2'])
+        .round(3)
+        .to_string()
+    )
+
+
+if __name__ == '__main__':
+    main()
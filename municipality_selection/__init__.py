@@ -0,0 +1,5 @@
+# Random selection of municipalities.
+#
+# The pipeline is split into stages, each in its own module: ingest, stratify, targets, seed, select, letters,
+# replacements, stats, and plots. Modules are not imported here, so that importing the package stays cheap and the
+# heavy dependencies (plotting, beacon client) are only loaded by the stages that need them.
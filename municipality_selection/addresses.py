@@ -0,0 +1,100 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .profiling import count
+from .streams import ADDRESSES, RandomStreams
+
+
+# number of rows of a register read at a time, which bounds the memory used per municipality together with the number
+# of addresses to draw
+chunk_size = 100000
+
+# extensions of register files (compressed files are decompressed while streaming)
+register_extensions = ['.csv', '.csv.gz', '.csv.zip', '.csv.bz2', '.csv.xz']
+
+
+# register file of a municipality, named by its Mun-ID, or None if there is none
+def register_file(register_path: Path, mun_id: int):
+    for ext in register_extensions:
+        fpath = register_path / f"{mun_id}{ext}"
+        if fpath.exists():
+            return fpath
+    return None
+
+
+# Key of the register files, from their names, sizes, and modification times (hashing the contents of multi-million-row
+# registers would take about as long as sampling from them)
+def register_key(register_path: Path):
+    h = hashlib.sha256()
+    if register_path.exists():
+        for fpath in sorted(register_path.iterdir()):
+            stat = fpath.stat()
+            h.update(f"{fpath.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return h.hexdigest()[:16]
+
+
+# Draw a simple random sample of n rows (w/o replacement) from a register streamed in chunks, with reservoir sampling by
+# random keys: every row gets a uniform key, and the n rows with the smallest keys seen so far are kept, so that the
+# sample is uniform over all rows however long the register is and only n rows plus one chunk are held in memory. The
+# keys are drawn in order of rows from the generator of the municipality, so the sample does not depend on the chunk
+# size. All columns are read as strings so that house numbers and postcodes are kept as they are. Returns the sampled
+# rows in register order, indexed by their (zero-based) row number.
+def sample_register(fpath: Path, n: int, rng, chunk_size: int = chunk_size):
+    reservoir = None
+    keys = np.empty(0)
+    num_rows = 0
+
+    for chunk in pd.read_csv(fpath, dtype=str, keep_default_na=False, chunksize=chunk_size):
+        chunk.index = pd.RangeIndex(num_rows, num_rows + len(chunk), name='Row')
+        num_rows += len(chunk)
+        count('register rows', len(chunk))
+
+        # keep the n rows with the smallest keys among the reservoir and the chunk
+        keys = np.concatenate([keys, rng.random(len(chunk))])
+        candidates = chunk if reservoir is None else pd.concat([reservoir, chunk])
+        if len(keys) > n:
+            keep = np.argpartition(keys, n - 1)[:n]
+            keys = keys[keep]
+            candidates = candidates.iloc[keep]
+        reservoir = candidates
+
+    if num_rows < n:
+        raise Exception(f"Cannot draw {n} addresses from the {num_rows} rows of the register {fpath}.")
+
+    return reservoir.sort_index()
+
+
+# Second stage: draw exactly Lm_rounded addresses from the register of every selected municipality. The registers are
+# CSV files named by the Mun-ID of the municipality in the register directory, and are streamed in chunks and sampled
+# concurrently in a thread pool (the CSV parser releases the GIL), so that memory is bounded by the number of workers,
+# the chunk size, and the number of letters, however large the registers are. Every municipality draws from its own
+# random stream for addresses, keyed by the beacon ints and the Mun-ID, so the sample of a municipality does not depend
+# on the other municipalities or the order in which they are processed. Returns the sampled addresses with the Mun-ID
+# and row number in the register as index.
+def draw_addresses(results: pd.DataFrame, register_path: Path, ints: list[int], workers: int | None = None,
+                   chunk_size: int = chunk_size):
+    streams = RandomStreams(ints, ADDRESSES)
+    targets = results.loc[(results['Selected'] > 0) & (results['Lm_rounded'] > 0), 'Lm_rounded'].astype(int)
+
+    # register files of all selected muns
+    fpaths = [register_file(register_path, mun_id) for mun_id in targets.index]
+    missing = [str(mun_id) for mun_id, fpath in zip(targets.index, fpaths) if fpath is None]
+    if missing:
+        raise Exception(f"No register found in {register_path} for the selected municipalities: {', '.join(missing)}.")
+
+    # generators of the muns, created up front so that the streams are not shared between threads
+    rngs = [streams.generator(mun_id, 0) for mun_id in targets.index]
+    pending = list(zip(fpaths, targets.values, rngs))
+    count('registers sampled', len(pending))
+
+    if workers == 1 or len(pending) <= 1:
+        samples = [sample_register(fpath, n, rng, chunk_size) for fpath, n, rng in pending]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            samples = list(executor.map(lambda args: sample_register(*args, chunk_size), pending))
+
+    return pd.concat(samples, keys=targets.index, names=[results.index.name, 'Row']) if samples else pd.DataFrame()
@@ -0,0 +1,54 @@
+import heapq
+
+import numpy as np
+
+
+# Sainte-Laguë apportionment as a divisor method with lower and upper bounds for every party built in, so that the
+# bounds never change the total. The divisor is first estimated from the parties not fixed at their bounds, and the
+# remaining difference to the total is then fixed by assigning (or removing) single seats in order of the Sainte-Laguë
+# priorities v / (a ± 0.5) using a heap.
+def apportion_sainte_lague(votes, seats: int, lower=None, upper=None):
+    votes = np.asarray(votes, dtype=float)
+    lower = np.zeros(len(votes), dtype=int) if lower is None else np.asarray(lower, dtype=int)
+    upper = np.full(len(votes), seats, dtype=int) if upper is None else np.asarray(upper, dtype=int)
+
+    # check that bounds are feasible
+    if (lower > upper).any() or not lower.sum() <= seats <= upper.sum():
+        raise Exception(f"Cannot apportion {seats} seats within the given bounds.")
+
+    # estimate divisor, updating it from the parties not fixed at their bounds
+    seats_assigned = lower.copy()
+    divisor = votes.sum() / seats if seats > 0 else np.inf
+    for i in range(10):
+        if not 0 < divisor < np.inf:
+            break
+        seats_unbounded = np.floor(votes / divisor + 0.5)
+        seats_assigned = np.clip(seats_unbounded, lower, upper).astype(int)
+        if seats_assigned.sum() == seats:
+            break
+        free = (seats_unbounded >= lower) & (seats_unbounded <= upper)
+        seats_free = seats - seats_assigned[~free].sum()
+        if seats_free <= 0 or votes[free].sum() == 0:
+            break
+        divisor = votes[free].sum() / seats_free
+
+    # fix remaining difference seat by seat in order of priority
+    diff = int(seats - seats_assigned.sum())
+    if diff > 0:
+        heap = [(-votes[i] / (seats_assigned[i] + 0.5), i) for i in np.flatnonzero(seats_assigned < upper)]
+        heapq.heapify(heap)
+        for k in range(diff):
+            _, i = heapq.heappop(heap)
+            seats_assigned[i] += 1
+            if seats_assigned[i] < upper[i]:
+                heapq.heappush(heap, (-votes[i] / (seats_assigned[i] + 0.5), i))
+    elif diff < 0:
+        heap = [(votes[i] / (seats_assigned[i] - 0.5), i) for i in np.flatnonzero(seats_assigned > lower)]
+        heapq.heapify(heap)
+        for k in range(-diff):
+            _, i = heapq.heappop(heap)
+            seats_assigned[i] -= 1
+            if seats_assigned[i] > lower[i]:
+                heapq.heappush(heap, (votes[i] / (seats_assigned[i] - 0.5), i))
+
+    return seats_assigned
@@ -0,0 +1,284 @@
+import hashlib
+import json
+import os
+import struct
+from pathlib import Path
+
+
+# NIST randomness beacon (version 2.0 of the API)
+beacon_url = 'https://beacon.nist.gov/beacon/2.0'
+
+# types of list values in the order they are serialized
+list_value_types = ['previous', 'hour', 'day', 'month', 'year']
+
+
+def _pack_bytes(value: bytes):
+    return struct.pack('>I', len(value)) + value
+
+
+def _pack_hex(value: str):
+    return _pack_bytes(bytes.fromhex(value))
+
+
+def _pack_str(value: str):
+    return _pack_bytes(value.encode('utf-8'))
+
+
+# Serialization of the fields of a pulse signed by the beacon (cipher suite 0): strings and byte values are prefixed with
+# their length as 4-byte big-endian integer, cipher suite, period, and status codes are 4-byte and the chain and pulse
+# indices 8-byte big-endian integers.
+def serialize_pulse(pulse: dict):
+    list_values = {list_value['type']: list_value['value'] for list_value in pulse['listValues']}
+
+    return b''.join([
+        _pack_str(pulse['uri']),
+        _pack_str(pulse['version']),
+        struct.pack('>I', pulse['cipherSuite']),
+        struct.pack('>I', pulse['period']),
+        _pack_hex(pulse['certificateId']),
+        struct.pack('>Q', pulse['chainIndex']),
+        struct.pack('>Q', pulse['pulseIndex']),
+        _pack_str(pulse['timeStamp']),
+        _pack_hex(pulse['localRandomValue']),
+        _pack_hex(pulse['external']['sourceId']),
+        struct.pack('>I', pulse['external']['statusCode']),
+        _pack_hex(pulse['external']['value']),
+        *[_pack_hex(list_values[list_value_type]) for list_value_type in list_value_types],
+        _pack_hex(pulse['precommitmentValue']),
+        struct.pack('>I', pulse['statusCode']),
+    ])
+
+
+# output value of a pulse, the SHA-512 hash of its signed fields and the signature
+def calc_output_value(pulse: dict):
+    return hashlib.sha512(serialize_pulse(pulse) + _pack_hex(pulse['signatureValue'])).hexdigest().upper()
+
+
+def pulse_name(pulse: dict):
+    return f"{pulse['chainIndex']}/{pulse['pulseIndex']}"
+
+
+# ensure that the output value of a pulse matches its content
+def verify_output_value(pulse: dict):
+    if calc_output_value(pulse) != pulse['outputValue'].upper():
+        raise Exception(f"The output value of beacon pulse {pulse_name(pulse)} does not match its content.")
+
+
+# ensure that the certificate matches the ID of the pulse (the SHA-512 hash of the PEM certificate) and that the pulse is
+# signed with its key (RSA with PKCS #1 v1.5 padding and SHA-512)
+def verify_signature(pulse: dict, certificate: bytes):
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    if hashlib.sha512(certificate).hexdigest() != pulse['certificateId'].lower():
+        raise Exception(f"The certificate does not match the certificate ID of beacon pulse {pulse_name(pulse)}.")
+
+    public_key = x509.load_pem_x509_certificate(certificate).public_key()
+    try:
+        public_key.verify(bytes.fromhex(pulse['signatureValue']), serialize_pulse(pulse), padding.PKCS1v15(), hashes.SHA512())
+    except InvalidSignature:
+        raise Exception(f"The signature of beacon pulse {pulse_name(pulse)} is invalid.")
+
+
+# ensure that a pulse is chained to the pulse before it: it must list the output value of the previous pulse, and its
+# local random value must hash to the value the previous pulse committed to
+def verify_chain(pulse: dict, previous: dict):
+    list_values = {list_value['type']: list_value['value'] for list_value in pulse['listValues']}
+
+    if previous['chainIndex'] != pulse['chainIndex'] or previous['pulseIndex'] != pulse['pulseIndex'] - 1:
+        raise Exception(f"Beacon pulse {pulse_name(previous)} does not precede pulse {pulse_name(pulse)}.")
+    if list_values['previous'].upper() != previous['outputValue'].upper():
+        raise Exception(f"Beacon pulse {pulse_name(pulse)} does not list the output value of pulse {pulse_name(previous)}.")
+    if hashlib.sha512(bytes.fromhex(pulse['localRandomValue'])).hexdigest() != previous['precommitmentValue'].lower():
+        raise Exception(f"The local random value of beacon pulse {pulse_name(pulse)} does not match the precommitment of "
+                        f"pulse {pulse_name(previous)}.")
+
+
+# Local cache of beacon pulses and certificates. Every pulse is stored under its chain and pulse index and verified
+# against its output value whenever it is read, and certificates are verified against their ID, so that corrupted or
+# altered files are never used (and are fetched again if online). The pulse found at a requested time is recorded, so
+# that reruns for the same time string need no network access.
+class PulseCache:
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.times_path = path / 'times.json'
+        self.times = json.loads(self.times_path.read_text()) if self.times_path.exists() else {}
+
+    def _write(self, fpath: Path, content: bytes):
+        fpath_tmp = fpath.with_suffix('.tmp')
+        fpath_tmp.write_bytes(content)
+        os.replace(fpath_tmp, fpath)
+
+    def get(self, chain_index: int, pulse_index: int):
+        fpath = self.path / f"pulse_{chain_index}_{pulse_index}.json"
+        if not fpath.exists():
+            return None
+
+        pulse = json.loads(fpath.read_text())
+        try:
+            verify_output_value(pulse)
+        except Exception:
+            fpath.unlink()
+            return None
+
+        return pulse
+
+    def put(self, pulse: dict):
+        verify_output_value(pulse)
+        self._write(self.path / f"pulse_{pulse['chainIndex']}_{pulse['pulseIndex']}.json", json.dumps(pulse, indent=2).encode())
+
+    def at_time(self, timestamp: int):
+        if str(timestamp) not in self.times:
+            return None
+        return self.get(*self.times[str(timestamp)])
+
+    def set_time(self, timestamp: int, pulse: dict):
+        self.times[str(timestamp)] = [pulse['chainIndex'], pulse['pulseIndex']]
+        self._write(self.times_path, json.dumps(self.times, indent=2).encode())
+
+    def certificate(self, certificate_id: str):
+        fpath = self.path / f"certificate_{certificate_id.lower()[:32]}.pem"
+        if not fpath.exists():
+            return None
+
+        certificate = fpath.read_bytes()
+        if hashlib.sha512(certificate).hexdigest() != certificate_id.lower():
+            fpath.unlink()
+            return None
+
+        return certificate
+
+    def put_certificate(self, certificate_id: str, certificate: bytes):
+        if hashlib.sha512(certificate).hexdigest() != certificate_id.lower():
+            raise Exception(f"The certificate does not match its ID {certificate_id}.")
+        self._write(self.path / f"certificate_{certificate_id.lower()[:32]}.pem", certificate)
+
+
+# directory of the cache of a beacon, keyed by the URL of its API so that pulses of different beacons (eg a stand-in) are
+# never mixed up
+def beacon_cache_path(cache_path: Path, url: str):
+    return cache_path / hashlib.sha256(url.rstrip('/').encode()).hexdigest()[:16]
+
+
+# Client of the beacon API. Requests go through one pooled session with bounded connect and read timeouts, and failed
+# connections and server errors are retried with exponential backoff. Pulses are taken from the local cache of the
+# beacon if present and otherwise fetched and verified (output value, signature, and chain to the previous pulse) before
+# being cached. In offline mode, the cache is the only source and a missing pulse is an error.
+class BeaconClient:
+    def __init__(self, url: str = beacon_url, cache_path: Path | None = None, offline: bool = False,
+                 timeout: tuple[float, float] = (3.05, 10.0), retries: int = 5, backoff: float = 0.5):
+        self.url = url.rstrip('/')
+        self.cache = PulseCache(beacon_cache_path(cache_path, self.url)) if cache_path is not None else None
+        self.offline = offline
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._session = None
+
+        if offline and self.cache is None:
+            raise Exception('A cache path is required for offline access to the beacon.')
+
+    # pooled session, created on the first request (the beacon client is only imported when needed)
+    @property
+    def session(self):
+        if self._session is None:
+            from requests import Session
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=self.retries,
+                backoff_factor=self.backoff,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=['GET'],
+            )
+            self._session = Session()
+            self._session.mount(self.url, HTTPAdapter(max_retries=retry))
+
+        return self._session
+
+    # GET request to path of the API, returning None if not found
+    def _get(self, path: str):
+        if self.offline:
+            raise Exception(f"Beacon resource {path} is not in the cache and the beacon client is offline.")
+
+        r = self.session.get(f"{self.url}{path}", timeout=self.timeout)
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+
+        return r
+
+    def _fetch_pulse(self, path: str, chained: bool = True):
+        r = self._get(path)
+        if r is None:
+            return None
+
+        pulse = r.json()['pulse']
+        self.verify(pulse, chained)
+        if self.cache is not None:
+            self.cache.put(pulse)
+
+        return pulse
+
+    # pulse at timestamp (in milliseconds), or None if there is none (eg in the future)
+    def pulse_at(self, timestamp: int):
+        if self.cache is not None:
+            pulse = self.cache.at_time(timestamp)
+            if pulse is not None:
+                return pulse
+
+        pulse = self._fetch_pulse(f"/pulse/time/{timestamp}")
+        if pulse is not None and self.cache is not None:
+            self.cache.set_time(timestamp, pulse)
+
+        return pulse
+
+    # pulse by chain and pulse index, verifying its chain to the previous pulse if chained
+    def pulse(self, chain_index: int, pulse_index: int, chained: bool = True):
+        if self.cache is not None:
+            pulse = self.cache.get(chain_index, pulse_index)
+            if pulse is not None:
+                return pulse
+
+        return self._fetch_pulse(f"/chain/{chain_index}/pulse/{pulse_index}", chained)
+
+    # last pulse, always fetched
+    def last_pulse(self):
+        return self._fetch_pulse('/pulse/last')
+
+    # certificate by ID in PEM format
+    def certificate(self, certificate_id: str):
+        if self.cache is not None:
+            certificate = self.cache.certificate(certificate_id)
+            if certificate is not None:
+                return certificate
+
+        r = self._get(f"/certificate/{certificate_id}")
+        if r is None:
+            raise Exception(f"Beacon certificate {certificate_id} not found.")
+        certificate = r.content
+        if self.cache is not None:
+            self.cache.put_certificate(certificate_id, certificate)
+
+        return certificate
+
+    # Verify the output value of a pulse, its signature, and (if chained) its chain to the previous pulse, whose own chain
+    # is not followed further. Offline, this only uses the cached certificate and previous pulse, which are cached when the
+    # pulse is first fetched. A pulse whose previous pulse cannot be found is rejected.
+    def verify(self, pulse: dict, chained: bool = True):
+        verify_output_value(pulse)
+        verify_signature(pulse, self.certificate(pulse['certificateId']))
+
+        if chained and pulse['pulseIndex'] > 1:
+            if self.offline:
+                previous = self.cache.get(pulse['chainIndex'], pulse['pulseIndex'] - 1)
+            else:
+                previous = self.pulse(pulse['chainIndex'], pulse['pulseIndex'] - 1, chained=False)
+            if previous is None:
+                raise Exception(f"The pulse before beacon pulse {pulse_name(pulse)} was not found, so its chain cannot be "
+                                f"verified.")
+            verify_chain(pulse, previous)
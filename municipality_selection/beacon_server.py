@@ -0,0 +1,182 @@
+import argparse
+import hashlib
+import json
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .beacon import calc_output_value, serialize_pulse
+
+
+# Local stand-in for the NIST beacon serving one chain of pulses in the format of version 2.0 of the API, for running
+# the selection and its tests without network access. Pulses are derived deterministically from a seed and generated on
+# demand from the first pulse at the start time, with every pulse committing to the local random value of the next one
+# and listing the output value of the previous one. Pulses are signed with a fresh RSA key, whose self-signed certificate
+# is served.
+class StandInBeacon:
+    def __init__(self, start: int, num_pulses: int = 1000, period: int = 60000, seed: int = 0, chain_index: int = 1):
+        self.start = start
+        self.num_pulses = num_pulses
+        self.period = period
+        self.seed = seed
+        self.chain_index = chain_index
+        self.pulses = []
+        self.requests = []
+        self._lock = threading.Lock()
+        self._key, self.certificate = self._make_certificate()
+        self.certificate_id = hashlib.sha512(self.certificate).hexdigest()
+
+    def _make_certificate(self):
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.x509.oid import NameOID
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Stand-in beacon')])
+        start = datetime.fromtimestamp(self.start / 1000, timezone.utc)
+        certificate = x509.CertificateBuilder() \
+            .subject_name(name) \
+            .issuer_name(name) \
+            .public_key(key.public_key()) \
+            .serial_number(x509.random_serial_number()) \
+            .not_valid_before(start) \
+            .not_valid_after(datetime.fromtimestamp((self.start + self.num_pulses * self.period) / 1000 + 86400, timezone.utc)) \
+            .sign(key, hashes.SHA256())
+
+        return key, certificate.public_bytes(serialization.Encoding.PEM)
+
+    def _sign(self, message: bytes):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+
+        return self._key.sign(message, padding.PKCS1v15(), hashes.SHA512())
+
+    def _local_random_value(self, pulse_index: int):
+        return hashlib.sha512(f"{self.seed}/local/{pulse_index}".encode()).digest()
+
+    # pulse by index, generating all pulses up to it
+    def pulse(self, pulse_index: int):
+        if not 1 <= pulse_index <= self.num_pulses:
+            return None
+
+        with self._lock:
+            while len(self.pulses) < pulse_index:
+                i = len(self.pulses) + 1
+                timestamp = self.start + (i - 1) * self.period
+                previous = self.pulses[-1]['outputValue'] if self.pulses else '00' * 64
+                first = self.pulses[0]['outputValue'] if self.pulses else previous
+                pulse = {
+                    'uri': f"http://localhost/beacon/2.0/chain/{self.chain_index}/pulse/{i}",
+                    'version': 'Version 2.0',
+                    'cipherSuite': 0,
+                    'period': self.period,
+                    'certificateId': self.certificate_id,
+                    'chainIndex': self.chain_index,
+                    'pulseIndex': i,
+                    'timeStamp': datetime.fromtimestamp(timestamp / 1000, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                    'localRandomValue': self._local_random_value(i).hex().upper(),
+                    'external': {'sourceId': '00' * 64, 'statusCode': 0, 'value': '00' * 64},
+                    'listValues': [
+                        {'uri': '', 'type': list_value_type, 'value': previous if list_value_type == 'previous' else first}
+                        for list_value_type in ['previous', 'hour', 'day', 'month', 'year']
+                    ],
+                    'precommitmentValue': hashlib.sha512(self._local_random_value(i + 1)).hexdigest().upper(),
+                    'statusCode': 0,
+                }
+                pulse['signatureValue'] = self._sign(serialize_pulse(pulse)).hex().upper()
+                pulse['outputValue'] = calc_output_value(pulse)
+                self.pulses.append(pulse)
+
+        return self.pulses[pulse_index - 1]
+
+    # last pulse at or before timestamp (in milliseconds), or None if before the first or after the last pulse
+    def pulse_at(self, timestamp: int):
+        if not self.start <= timestamp < self.start + self.num_pulses * self.period:
+            return None
+        return self.pulse((timestamp - self.start) // self.period + 1)
+
+    def last_pulse(self):
+        return self.pulse(self.num_pulses)
+
+    # response to a request path of the API as status code, content type, and body
+    def respond(self, path: str):
+        self.requests.append(path)
+        parts = path.strip('/').split('/')
+        if parts[:2] != ['beacon', '2.0']:
+            return 404, 'text/plain', b'Not found'
+        parts = parts[2:]
+
+        pulse = None
+        if parts[:2] == ['pulse', 'time'] and len(parts) == 3 and parts[2].isdigit():
+            pulse = self.pulse_at(int(parts[2]))
+        elif parts == ['pulse', 'last']:
+            pulse = self.last_pulse()
+        elif len(parts) == 4 and parts[0] == 'chain' and parts[2] == 'pulse' and parts[3].isdigit():
+            pulse = self.pulse(int(parts[3])) if parts[1] == str(self.chain_index) else None
+        elif len(parts) == 2 and parts[0] == 'certificate' and parts[1].lower() == self.certificate_id:
+            return 200, 'application/x-pem-file', self.certificate
+
+        if pulse is None:
+            return 404, 'text/plain', b'Not found'
+
+        return 200, 'application/json', json.dumps({'pulse': pulse}).encode()
+
+
+def _make_handler(beacon: StandInBeacon):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            status, content_type, body = beacon.respond(self.path)
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+# serve stand-in beacon in a background thread, yielding the base URL of its API (a free port is chosen by default)
+@contextmanager
+def serve(beacon: StandInBeacon, host: str = '127.0.0.1', port: int = 0):
+    server = ThreadingHTTPServer((host, port), _make_handler(beacon))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://{host}:{server.server_address[1]}/beacon/2.0"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog='python -m municipality_selection.beacon_server',
+        description='Local stand-in for the NIST randomness beacon serving one chain of pulses.',
+    )
+    parser.add_argument('--start', default='30 Apr 2024 07:00:00.000 CEST',
+                        help='time string of the first pulse')
+    parser.add_argument('--num-pulses', type=int, default=1440,
+                        help='number of pulses in the chain')
+    parser.add_argument('--period', type=int, default=60000,
+                        help='time between pulses in milliseconds')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed the pulses are derived from')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to serve on')
+    args = parser.parse_args(argv)
+
+    from dateutil import parser as time_parser
+
+    beacon = StandInBeacon(int(time_parser.parse(args.start).timestamp()) * 1000, args.num_pulses, args.period, args.seed)
+    with serve(beacon, port=args.port) as url:
+        print(f"Serving stand-in beacon at {url}")
+        threading.Event().wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import argparse
+from pathlib import Path
+
+from .pipeline import STAGES, Config, run_pipeline
+
+
+# stages run by default: a production selection run without statistics and plots
+default_stages = ['targets', 'letters', 'replacements']
+
+
+# user-defined bin given as NAME:COLUMN:T1,T2,... with the upper thresholds of the bins
+def parse_bin(value: str):
+    try:
+        name, column, thresholds = value.split(':')
+        return name, (column, [float(threshold) for threshold in thresholds.split(',')])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid bin: {value}. Expected NAME:COLUMN:T1,T2,...")
+
+
+def main(argv: list[str] | None = None):
+    defaults = Config()
+
+    parser = argparse.ArgumentParser(
+        prog='python -m municipality_selection',
+        description='Random selection of municipalities. Runs the requested stages and all stages they depend on.',
+    )
+    parser.add_argument('stages', nargs='*', default=default_stages,
+                        help=f"stages to run (default: {' '.join(default_stages)}; available: {' '.join(STAGES)})")
+    parser.add_argument('--base-path', type=Path, default=defaults.base_path,
+                        help='working directory containing the input, cache, and output directories')
+    parser.add_argument('--no-cache', dest='allow_caching', action='store_false',
+                        help='force reprocessing of the input file')
+    parser.add_argument('--strata', nargs='+', default=defaults.strata,
+                        help='keys to stratify muns by (eg State-ID Class-ID Urbanisation Kreis-ID or names of bins)')
+    parser.add_argument('--bin', dest='bins', type=parse_bin, action='append', default=[],
+                        help='user-defined bin of a column of muns as NAME:COLUMN:T1,T2,... (upper thresholds of the bins)')
+    parser.add_argument('--n-init', type=int, default=defaults.n_init,
+                        help='initial target for number of municipalities to select (at least the number of strata with '
+                             'population)')
+    parser.add_argument('--letters', type=int, default=defaults.L,
+                        help='total number of letters to send out')
+    parser.add_argument('--alpha', type=float, default=defaults.alpha,
+                        help='max share of population invited in small municipalities')
+    parser.add_argument('--method', choices=['pps_sys', 'lpm', 'sampford', 'conditional_poisson', 'pareto'], default=defaults.method,
+                        help='sampling method: PPS-SYS, spatially balanced sampling with the local pivotal method, or the '
+                             'Sampford, conditional Poisson, or Pareto πps design')
+    parser.add_argument('--joint-approx', choices=['hajek', 'brewer'], default=defaults.joint_approx,
+                        help='approximation of the joint inclusion probabilities of large groups in the weights stage')
+    parser.add_argument('--exact-max-units', type=int, default=defaults.exact_max_units,
+                        help='max number of non-certainty municipalities of a group for exact joint inclusion probabilities')
+    parser.add_argument('--joint-sims', type=int, default=defaults.joint_sims,
+                        help='number of iterations simulated for the joint inclusion probabilities of spatially balanced '
+                             'sampling in the weights stage')
+    parser.add_argument('--num-repl', type=int, default=defaults.num_repl,
+                        help='number of replacements per group')
+    parser.add_argument('--timestr', default=defaults.timestr,
+                        help='time string of the beacon pulse used for seeding')
+    parser.add_argument('--beacon-url', default=defaults.beacon_url,
+                        help='URL of the beacon API (eg of a local stand-in beacon)')
+    parser.add_argument('--offline', action='store_true',
+                        help='only use beacon pulses from the cache')
+    parser.add_argument('--Ks', type=int, nargs='+', default=defaults.Ks,
+                        help='strictly increasing numbers of iterations for checking probabilities')
+    parser.add_argument('--workers', type=int, default=defaults.workers,
+                        help='number of worker processes for checking probabilities')
+    parser.add_argument('--formats', nargs='+', default=defaults.formats,
+                        help='formats to export the tables to (xlsx, csv, parquet)')
+    parser.add_argument('--plot-max-points', type=int, default=defaults.plot_max_points,
+                        help='max number of points per trace when exporting plots (0 to plot every municipality)')
+    parser.add_argument('--profile', action='store_true',
+                        help='instrument stages and write a report to the output directory')
+    parser.add_argument('--no-trace-memory', dest='trace_memory', action='store_false',
+                        help='do not trace memory allocations when instrumenting stages')
+    parser.add_argument('--profile-stage', default=defaults.profile_stage,
+                        help='stage to dump a cProfile profile for when instrumenting stages (eg select)')
+    parser.add_argument('--no-memo', dest='memoize', action='store_false',
+                        help='recompute all stages instead of loading memoized outputs from the cache directory')
+    args = parser.parse_args(argv)
+
+    config = Config(
+        base_path=args.base_path,
+        allow_caching=args.allow_caching,
+        strata=args.strata,
+        bins=dict(args.bins),
+        n_init=args.n_init,
+        L=args.letters,
+        alpha=args.alpha,
+        num_repl=args.num_repl,
+        joint_approx=args.joint_approx,
+        exact_max_units=args.exact_max_units,
+        joint_sims=args.joint_sims,
+        method=args.method,
+        timestr=args.timestr,
+        beacon_url=args.beacon_url,
+        offline=args.offline,
+        Ks=args.Ks,
+        workers=args.workers,
+        formats=args.formats,
+        plot_max_points=args.plot_max_points or None,
+        profile=args.profile or args.profile_stage is not None,
+        trace_memory=args.trace_memory,
+        profile_stage=args.profile_stage,
+        memoize=args.memoize,
+    )
+
+    run_pipeline(args.stages, config)
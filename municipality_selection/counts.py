@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# Store of the number of times each mun was selected, as an int32 matrix with one row per snapshot (taken after a given
+# number of iterations K) and one column per mun. With a path, the matrix is memory-mapped from a file in the cache
+# directory, so that counts for many snapshots never have to be held in memory. The list of snapshots is written after
+# every snapshot, so that a store can be reopened and a run resumed from its last snapshot.
+class CountStore:
+    def __init__(self, counts: np.ndarray, index: pd.Index, snapshots: list[dict], path: Path | None = None):
+        self.counts = counts
+        self.index = index
+        self.snapshots = snapshots
+        self.path = path
+
+    # create empty store with room for a number of snapshots (grown when full)
+    @classmethod
+    def create(cls, index: pd.Index, capacity: int, path: Path | None = None):
+        shape = (max(capacity, 1), len(index))
+        if path is None:
+            return cls(np.zeros(shape, dtype=np.int32), index, [])
+
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / 'index.npy', index.values)
+        counts = np.lib.format.open_memmap(path / 'counts.npy', mode='w+', dtype=np.int32, shape=shape)
+        store = cls(counts, index, [], path)
+        store._write_snapshots()
+
+        return store
+
+    # open existing store from path
+    @classmethod
+    def open(cls, path: Path):
+        with open(path / 'snapshots.json') as f:
+            snapshots = json.load(f)
+        index = pd.Index(np.load(path / 'index.npy', allow_pickle=False), name='Mun-ID')
+        counts = np.load(path / 'counts.npy', mmap_mode='r+')
+
+        return cls(counts, index, snapshots, path)
+
+    # open store from path if present and matching the muns, otherwise create it
+    @classmethod
+    def open_or_create(cls, index: pd.Index, capacity: int, path: Path):
+        if (path / 'snapshots.json').exists():
+            store = cls.open(path)
+            if store.index.equals(index):
+                return store
+
+        return cls.create(index, capacity, path)
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    # numbers of iterations of snapshots
+    @property
+    def Ks(self):
+        return [snapshot['K'] for snapshot in self.snapshots]
+
+    # add snapshot of counts after K iterations, with further metadata (eg the position in the random streams)
+    def append(self, K: int, counts: np.ndarray, **meta):
+        if len(self) == len(self.counts):
+            self._grow()
+
+        self.counts[len(self)] = counts
+        self.snapshots.append({'K': int(K), **meta})
+
+        if self.path is not None:
+            self.counts.flush()
+            self._write_snapshots()
+
+    # last snapshot as number of iterations, counts, and metadata
+    def latest(self):
+        snapshot = self.snapshots[-1]
+        return snapshot['K'], np.array(self.counts[len(self) - 1]), snapshot
+
+    # snapshots as dataframe with one column per K, backed by the (memory-mapped) matrix without copying
+    def to_frame(self):
+        return pd.DataFrame(self.counts[:len(self)].T, index=self.index, columns=self.Ks)
+
+    # double the number of rows, copying the snapshots taken so far
+    def _grow(self):
+        shape = (2 * len(self.counts), self.counts.shape[1])
+        if self.path is None:
+            counts = np.zeros(shape, dtype=np.int32)
+            counts[:len(self)] = self.counts[:len(self)]
+            self.counts = counts
+            return
+
+        fpath_tmp = self.path / 'counts.tmp.npy'
+        counts = np.lib.format.open_memmap(fpath_tmp, mode='w+', dtype=np.int32, shape=shape)
+        counts[:len(self)] = self.counts[:len(self)]
+        counts.flush()
+        del counts
+        self.counts = None
+        os.replace(fpath_tmp, self.path / 'counts.npy')
+        self.counts = np.load(self.path / 'counts.npy', mmap_mode='r+')
+
+    # write list of snapshots atomically
+    def _write_snapshots(self):
+        fpath_tmp = self.path / 'snapshots.tmp.json'
+        with open(fpath_tmp, 'w') as f:
+            json.dump(self.snapshots, f)
+        os.replace(fpath_tmp, self.path / 'snapshots.json')
+
+
+# key of a store from the beacon ints, the muns, and further parameters of the run (arrays such as the measure of size
+# by their bytes), so that a run with a different seed, frame, or design never resumes from it
+def store_key(ints: list[int], index: pd.Index, *params):
+    h = hashlib.sha256(np.array(ints, dtype=np.uint64).tobytes() + index.values.astype(np.int64).tobytes())
+    for param in params:
+        h.update(param.tobytes() if isinstance(param, np.ndarray) else json.dumps(param).encode())
+
+    return h.hexdigest()[:16]
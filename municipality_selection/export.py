@@ -0,0 +1,101 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from .profiling import count
+
+
+# formats that tables can be exported to
+export_formats = ['xlsx', 'csv', 'parquet']
+
+# number of rows converted to Python objects at a time when streaming tables to XLSX
+chunk_size = 10000
+
+
+# Write table to XLSX with xlsxwriter in constant-memory mode, which flushes every row to disk once the next row is
+# started, so that memory stays constant however many rows are written. The layout follows DataFrame.to_excel, with the
+# index as leading columns and one header row per level of the column labels (named next to the index), followed by a
+# row of index names if the columns have several levels. Repeated labels are not merged, as merged cells would require
+# holding all rows. Missing values are left blank and infinite values written as text.
+def write_xlsx(table: pd.DataFrame, fpath: Path, sheet_name: str = 'Sheet1'):
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(fpath, {'constant_memory': True})
+    worksheet = workbook.add_worksheet(sheet_name)
+    bold = workbook.add_format({'bold': True})
+
+    # header rows of column levels
+    num_index = table.index.nlevels
+    num_levels = table.columns.nlevels
+    for row in range(num_levels):
+        if num_levels > 1 and table.columns.names[row] is not None:
+            write_cell(worksheet, row, num_index - 1, table.columns.names[row], bold)
+        for col, label in enumerate(table.columns.get_level_values(row), start=num_index):
+            write_cell(worksheet, row, col, label, bold)
+
+    # index names in last header row or in row of their own
+    row = num_levels - 1 if num_levels == 1 else num_levels
+    for col, name in enumerate(table.index.names):
+        if name is not None:
+            write_cell(worksheet, row, col, name, bold)
+
+    # rows streamed chunk by chunk
+    row += 1
+    for start in range(0, len(table), chunk_size):
+        for values in table.iloc[start:start + chunk_size].itertuples(index=True, name=None):
+            index_values = values[0] if num_index > 1 else (values[0],)
+            for col, value in enumerate(index_values + values[1:]):
+                write_cell(worksheet, row, col, value, bold if col < num_index else None)
+            row += 1
+
+    workbook.close()
+
+
+# write a single value to a worksheet cell by type
+def write_cell(worksheet, row: int, col: int, value, cell_format=None):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return
+    if isinstance(value, bool):
+        worksheet.write_boolean(row, col, value, cell_format)
+    elif isinstance(value, (int, float)):
+        if math.isinf(value):
+            worksheet.write_string(row, col, str(value), cell_format)
+        else:
+            worksheet.write_number(row, col, value, cell_format)
+    else:
+        worksheet.write_string(row, col, str(value), cell_format)
+
+
+# write table to file in one of the export formats
+def write_table(table: pd.DataFrame, fpath: Path, fmt: str):
+    count('rows written', len(table))
+
+    if fmt == 'xlsx':
+        write_xlsx(table, fpath)
+    elif fmt == 'csv':
+        table.to_csv(fpath)
+    elif fmt == 'parquet':
+        # Parquet requires string column labels
+        if table.columns.nlevels > 1:
+            table = table.set_axis([' '.join(map(str, labels)) for labels in table.columns], axis=1)
+        table.to_parquet(fpath)
+    else:
+        raise Exception(f"Unknown export format: {fmt}. Available formats: {', '.join(export_formats)}.")
+
+
+# Write tables (by file name) to the output directory in the format given by the extension of the file name. The files
+# are independent and written concurrently in a thread pool, sharing the tables without copying them to other processes.
+def export_tables(tables: dict[str, pd.DataFrame], output_path: Path, workers: int | None = None):
+    pending = [
+        (table, output_path / fname, Path(fname).suffix.lstrip('.'))
+        for fname, table in tables.items()
+    ]
+
+    if workers == 1 or len(pending) <= 1:
+        for table, fpath, fmt in pending:
+            write_table(table, fpath, fmt)
+    elif pending:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(write_table, *zip(*pending)))
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from urllib.request import urlretrieve
+
+import pandas as pd
+from pyarrow import feather
+
+from .profiling import count
+from .stratify import assign_groups, default_strata
+
+
+# list of municipalities (Gemeindeverzeichnis) from the DESTATIS webpage
+input_file_name = 'AuszugGV1QAktuell.xlsx'
+input_file_url = 'https://www.destatis.de/DE/Themen/Laender-Regionen/Regionales/Gemeindeverzeichnis/Administrativ/Archiv/GVAuszugQ/AuszugGV1QAktuell.xlsx?__blob=publicationFile'
+
+# list of columns to read from file
+input_columns = {
+    'A': {'name': 'Satzart', 'dtype': 'str'},
+    'C': {'name': 'State-ID', 'dtype': 'str'},
+    'D': {'name': 'Mun-ID-1', 'dtype': 'str'},
+    'E': {'name': 'Mun-ID-2', 'dtype': 'str'},
+    'F': {'name': 'Mun-ID-3', 'dtype': 'str'},
+    'G': {'name': 'Mun-ID-4', 'dtype': 'str'},
+    'H': {'name': 'Name', 'dtype': 'str'},
+    'J': {'name': 'Nm', 'dtype': 'float64'},
+    'O': {'name': 'LONG', 'dtype': 'float64'},
+    'P': {'name': 'LAT', 'dtype': 'float64'},
+    'T': {'name': 'Urbanisation', 'dtype': 'str'},
+}
+
+
+# compact dtypes of muns: categoricals for names and urbanisation and integer populations (IDs are downcast to the
+# smallest integer dtype that fits when assigning groups)
+muns_dtypes = {
+    'Mun-Name': 'category',
+    'Mun-Shortname': 'category',
+    'Nm': 'int32',
+    'Urbanisation': 'category',
+}
+
+
+# download input file if not present
+def download_input(input_file_path: Path, url: str = input_file_url):
+    if not (input_file_path.exists() and input_file_path.is_file()):
+        urlretrieve(url, input_file_path)
+
+
+# read states and muns from XLSX input file and group muns by the given strata (see assign_groups)
+def read_from_input(input_file_path: Path, classes: pd.DataFrame, columns: dict = input_columns,
+                    strata: list[str] = default_strata, bins: dict | None = None):
+    # read excel to raw dataframe
+    raw_dataframe = pd.read_excel(
+        input_file_path,
+        sheet_name=1,
+        index_col=None,
+        usecols=','.join(list(columns.keys())),
+        names=[col_specs['name'] for col_specs in columns.values()],
+        dtype={col_specs['name']: col_specs['dtype'] for col_specs in columns.values()},
+        decimal=',',
+        skiprows=5,
+    )
+
+    # obtain states from raw dataframe
+    states = raw_dataframe \
+        .query("Satzart=='10'") \
+        .rename(columns={'Name': 'State-Name'}) \
+        .astype({'State-ID': 'int64'}) \
+        .filter(['State-ID', 'State-Name']) \
+        .set_index('State-ID')
+
+    # obtain municipalities from raw dataframe, with the AGS as integer key (state ID followed by the ten digits of the
+    # Mun-ID parts)
+    muns = raw_dataframe \
+        .query("Satzart=='60'") \
+        .rename(columns={'Name': 'Mun-Name'}) \
+        .astype({'State-ID': 'int64'}) \
+        .assign(**{
+            'Mun-ID': lambda df: df['State-ID'] * 10**10 + (df['Mun-ID-1'] + df['Mun-ID-2'] + df['Mun-ID-3'] + df['Mun-ID-4']).astype('int64'),
+            'Mun-Shortname': lambda df: df['Mun-Name'].str.split(',').str[0],
+        }) \
+        .filter(['Mun-ID', 'Mun-Name', 'Mun-Shortname', 'State-ID', 'Nm', 'Urbanisation', 'LONG', 'LAT']) \
+        .set_index('Mun-ID')
+
+    # drop municipalities with zero population and apply compact dtypes
+    muns = muns \
+        .loc[muns['Nm'] > 0] \
+        .astype(muns_dtypes)
+
+    # add size classes and groups
+    muns, groups = assign_groups(muns, classes, strata, bins)
+
+    return states, muns, groups
+
+
+# compute cache key from input file content, class definitions, column specification, dtypes, and strata
+def cache_key(input_file_path: Path, classes: pd.DataFrame, columns: dict = input_columns,
+              strata: list[str] = default_strata, bins: dict | None = None):
+    h = hashlib.sha256()
+    with open(input_file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    h.update(classes.to_json().encode())
+    h.update(json.dumps(columns, sort_keys=True).encode())
+    h.update(json.dumps(muns_dtypes, sort_keys=True).encode())
+    h.update(json.dumps({'strata': strata, 'bins': bins}, sort_keys=True, default=str).encode())
+    return h.hexdigest()[:16]
+
+
+# read dataframe from cache
+def read_cache(cache_path: Path, key: str, name: str):
+    fpath = cache_path / f"ingest_{key}" / f"{name}.feather"
+    if not fpath.exists():
+        return None
+    df = feather.read_table(fpath, memory_map=True).to_pandas()
+    return df.set_index(df.columns[0])
+
+
+# write dataframe to cache
+def write_cache(cache_path: Path, key: str, name: str, df: pd.DataFrame):
+    fpath = cache_path / f"ingest_{key}" / f"{name}.feather"
+    fpath.parent.mkdir(exist_ok=True)
+    fpath_tmp = fpath.with_suffix('.tmp')
+    feather.write_feather(df.reset_index(), fpath_tmp, compression='uncompressed')
+    os.replace(fpath_tmp, fpath)
+
+
+# read states, muns, and groups from cache if allowed and present, otherwise from input file
+def load_input(input_file_path: Path, cache_path: Path, classes: pd.DataFrame, allow_caching: bool = True,
+               strata: list[str] = default_strata, bins: dict | None = None):
+    key = cache_key(input_file_path, classes, strata=strata, bins=bins)
+
+    # read from cache if allowed
+    states, muns, groups = (
+        (read_cache(cache_path, key, 'states'), read_cache(cache_path, key, 'muns'), read_cache(cache_path, key, 'groups'))
+        if allow_caching else
+        (None, None, None)
+    )
+
+    # if either of them is None, caching was either disabled or the files don't exist yet, so read from input file and write cache files
+    if any(df is None for df in (states, muns, groups)):
+        count('input file reads')
+        states, muns, groups = read_from_input(input_file_path, classes, strata=strata, bins=bins)
+        write_cache(cache_path, key, 'states', states)
+        write_cache(cache_path, key, 'muns', muns)
+        write_cache(cache_path, key, 'groups', groups)
+
+    return states, muns, groups
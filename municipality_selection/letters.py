@@ -0,0 +1,38 @@
+import pandas as pd
+
+from .apportionment import apportion_sainte_lague
+
+
+# compute the share of letters to send for each municipality (ie apportionment factors for deviation from L*/n*) and
+# the actual final number of letters Lm to send out
+def calc_letters(results: pd.DataFrame, muns: pd.DataFrame, groups: pd.DataFrame, params: dict, check_sum: bool = True):
+    certainty = results['Certainty']
+
+    # certainty muns
+    Nm = muns.loc[certainty, 'Nm']
+    results.loc[certainty, 'AFm'] = Nm / params['N*'] * params['n*']
+
+    # non-certainty muns
+    Nm = muns.loc[~certainty, 'Nm']
+    Mm = muns.loc[~certainty, 'Mm']
+    Mg = muns.loc[~certainty].groupby('Group-ID')['Mm'].transform(sum)
+    ng = muns.loc[~certainty].join(groups[['ng']], on='Group-ID')['ng'] - certainty.groupby(muns['Group-ID']).transform(sum).loc[~certainty]
+    results.loc[~certainty, 'AFm'] = Nm / params['N*'] * params['n*'] / ng * Mg / Mm
+
+    # calculate final number of letters
+    results['Lm'] = params['L*'] / params['n*'] * results['AFm']
+    results.loc[results['Selected'] > 0, 'Lm_rounded'] = apportion_sainte_lague(results.loc[results['Selected'] > 0, 'AFm'], round(results.loc[results['Selected'] > 0, 'Lm'].sum()))
+
+    return results
+
+
+# selected muns in user-friendly format, with the labels of muns (see mun_labels) aligned by position
+def results_table(results: pd.DataFrame, muns: pd.DataFrame, labels: pd.DataFrame):
+    cond_selected = results['Selected'].values > 0
+
+    return pd.concat([
+            muns.loc[cond_selected],
+            results.loc[cond_selected].drop(columns=['Selected', 'Certainty']),
+            labels.loc[cond_selected],
+        ], axis=1) \
+        .sort_values(by=['State-ID', 'Class-ID'])
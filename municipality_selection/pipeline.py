@@ -0,0 +1,499 @@
+import hashlib
+import json
+import os
+import pickle
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .beacon import beacon_url
+from .profiling import count
+
+
+# pipeline stages in order of execution
+STAGES = ['ingest', 'stratify', 'targets', 'seed', 'select', 'letters', 'weights', 'replacements', 'addresses', 'stats', 'plots']
+
+# stages that each stage depends on
+DEPENDENCIES = {
+    'ingest': [],
+    'stratify': ['ingest'],
+    'targets': ['stratify'],
+    'seed': [],
+    'select': ['targets', 'seed'],
+    'letters': ['select'],
+    'weights': ['letters'],
+    'replacements': ['letters'],
+    'addresses': ['letters'],
+    'stats': ['letters'],
+    'plots': ['letters'],
+}
+
+# stages that a stage depends on if they are run as well
+OPTIONAL_DEPENDENCIES = {
+    'plots': ['stats'],
+}
+
+# parameters of the config that each stage depends on (not the number of workers, which never changes the outputs)
+PARAMETERS = {
+    'ingest': ['allow_caching', 'strata', 'bins'],
+    'stratify': [],
+    'targets': ['n_init', 'L', 'alpha'],
+    'seed': ['timestr', 'beacon_url'],
+    'select': ['method'],
+    'letters': [],
+    'weights': ['method', 'joint_approx', 'exact_max_units', 'joint_sims'],
+    'replacements': ['num_repl', 'method'],
+    'addresses': [],
+    'stats': ['Ks', 'method'],
+    'plots': ['plot_max_points'],
+}
+
+# stages whose outputs are memoized (the input is read from its own cache and the group index is quickly rebuilt, while
+# the plots are only rewritten if their figures changed)
+MEMOIZED = ['targets', 'seed', 'select', 'letters', 'weights', 'replacements', 'addresses', 'stats']
+
+# tables written to the output directory (in each of the export formats) for each requested stage
+OUTPUT_TABLES = {
+    'targets': ['municipality_selection_targets'],
+    'letters': ['municipality_selection_results'],
+    'weights': ['municipality_selection_weights', 'municipality_selection_joint_probs'],
+    'replacements': ['municipality_selection_replacements'],
+    'addresses': ['municipality_selection_addresses'],
+}
+
+
+@dataclass
+class Config:
+    # base path should be set to the main repo directory but can also be any other working directory
+    base_path: Path = Path('.')
+    allow_caching: bool = True
+
+    # key parameters
+    n_init: int = 80  # initial target for number of municipalities to select
+    L: int = 20000  # total number of letters to send out
+    alpha: float = 0.1  # max share of population invited in small municipalities
+    num_repl: int = 5  # number of replacements per group
+    method: str = 'pps_sys'  # sampling method (pps_sys, lpm for spatially balanced sampling, sampford, conditional_poisson, or pareto)
+
+    # approximation of joint inclusion probabilities of large groups (hajek or brewer), max number of non-certainty muns
+    # of a group for exact joint inclusion probabilities, and number of iterations simulated for the joint inclusion
+    # probabilities of spatial sampling methods
+    joint_approx: str = 'hajek'
+    exact_max_units: int = 20
+    joint_sims: int = 10000
+
+    # keys that muns are stratified by, and user-defined bins (name: column and upper thresholds) that can be used as keys
+    strata: list[str] = field(default_factory=lambda: ['State-ID', 'Class-ID'])
+    bins: dict[str, tuple[str, list[float]]] = field(default_factory=dict)
+
+    # time string of beacon pulse used for seeding, URL of the beacon API, and whether to only use cached pulses
+    timestr: str = '30 Apr 2024 08:00:00.000 CEST'
+    beacon_url: str = beacon_url
+    offline: bool = False
+
+    # numbers of iterations for checking probabilities and number of worker processes
+    Ks: list[int] = field(default_factory=lambda: [10, 20, 30])
+    workers: int | None = None
+
+    # opt-in instrumentation of stages with a report written to the output directory, optionally tracing memory and
+    # dumping a cProfile profile of one stage
+    profile: bool = False
+    trace_memory: bool = True
+    profile_stage: str | None = None
+
+    # formats the tables are exported to (xlsx, csv, parquet)
+    formats: list[str] = field(default_factory=lambda: ['xlsx'])
+
+    # max number of points (or bars) per trace when exporting plots, or None to plot every mun
+    plot_max_points: int | None = 2000
+
+    # memoize stage outputs in the cache directory under a hash of their inputs and parameters
+    memoize: bool = True
+
+    # input, cache, and output directories should be subdirectories
+    @property
+    def input_path(self):
+        return self.base_path / 'input'
+
+    # register files of the muns (named by Mun-ID) for drawing addresses in the second stage
+    @property
+    def register_path(self):
+        return self.input_path / 'registers'
+
+    @property
+    def cache_path(self):
+        return self.base_path / 'cache'
+
+    @property
+    def output_path(self):
+        return self.base_path / 'output'
+
+
+# requested stages and all stages they depend on, in order of execution
+def resolve_stages(stages: list[str]):
+    unknown = [stage for stage in stages if stage not in DEPENDENCIES]
+    if unknown:
+        raise Exception(f"Unknown stages: {', '.join(unknown)}. Available stages: {', '.join(STAGES)}.")
+
+    required = set()
+
+    def add(stage: str):
+        if stage not in required:
+            required.add(stage)
+            for dep in DEPENDENCIES[stage]:
+                add(dep)
+
+    for stage in stages:
+        add(stage)
+
+    return [stage for stage in STAGES if stage in required]
+
+
+# hash of the source code of the package, so that memoized outputs are invalidated when the code changes
+def code_key():
+    h = hashlib.sha256()
+    for fpath in sorted(Path(__file__).parent.glob('*.py')):
+        h.update(fpath.read_bytes())
+    return h.hexdigest()[:16]
+
+
+# Key of a stage from its parameters and the keys of the stages it depends on. The key of the ingest stage also covers
+# the content of the input file, the class definitions, and the strata via the key of the input cache, and the key of
+# the addresses stage covers the register files. Once the seed stage has run, its key is replaced by the key of the
+# pulse actually fetched (see pulse_key), which the stages after it are keyed by.
+def stage_key(name: str, config: Config, keys: dict, code: str):
+    h = hashlib.sha256()
+    h.update(json.dumps({
+        'stage': name,
+        'code': code,
+        'parameters': {param: getattr(config, param) for param in PARAMETERS[name]},
+        'dependencies': {dep: keys[dep] for dep in DEPENDENCIES[name] + OPTIONAL_DEPENDENCIES.get(name, []) if dep in keys},
+    }, sort_keys=True, default=str).encode())
+
+    if name == 'ingest':
+        from .ingest import cache_key, download_input, input_file_name
+        from .stratify import define_classes
+
+        input_file_path = config.input_path / input_file_name
+        download_input(input_file_path)
+        h.update(cache_key(input_file_path, define_classes(), strata=config.strata, bins=config.bins).encode())
+    elif name == 'addresses':
+        from .addresses import register_key
+
+        h.update(register_key(config.register_path).encode())
+
+    return h.hexdigest()[:16]
+
+
+# key of a beacon pulse from its time string, timestamp, and output value, as the pulse fetched for a time string is not
+# fixed if it falls back to the last pulse
+def pulse_key(beacon: dict):
+    return hashlib.sha256(json.dumps(beacon, sort_keys=True).encode()).hexdigest()[:16]
+
+
+# memoized stage outputs in the cache directory, and keys of the stages that the files in the output directory were
+# written from
+class Memo:
+    def __init__(self, memo_path: Path):
+        self.memo_path = memo_path
+        self.memo_path.mkdir(parents=True, exist_ok=True)
+        self.outputs_path = memo_path / 'outputs.json'
+        self.outputs = json.loads(self.outputs_path.read_text()) if self.outputs_path.exists() else {}
+
+    def load(self, name: str, key: str):
+        fpath = self.memo_path / f"{name}_{key}.pkl"
+        if not fpath.exists():
+            return None
+        with open(fpath, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, name: str, key: str, outputs: dict):
+        fpath = self.memo_path / f"{name}_{key}.pkl"
+        fpath_tmp = fpath.with_suffix('.tmp')
+        with open(fpath_tmp, 'wb') as f:
+            pickle.dump(outputs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fpath_tmp, fpath)
+
+    # whether all output files exist and were written from the given key
+    def outputs_current(self, output_path: Path, fnames: list[str], key: str):
+        return all((output_path / fname).exists() and self.outputs.get(fname) == key for fname in fnames)
+
+    def set_outputs(self, keys: dict):
+        self.outputs.update(keys)
+        self.outputs_path.write_text(json.dumps(self.outputs, indent=2))
+
+
+def _run_ingest(data: dict, config: Config):
+    from .ingest import input_file_name, load_input
+    from .stratify import define_classes
+
+    classes = define_classes()
+    states, muns, groups = load_input(config.input_path / input_file_name, config.cache_path, classes, config.allow_caching,
+                                      strata=config.strata, bins=config.bins)
+
+    return {'classes': classes, 'states': states, 'muns': muns, 'groups': groups, 'strata': config.strata}
+
+
+def _run_stratify(data: dict, config: Config):
+    from .stratify import build_group_index
+
+    return {'group_index': build_group_index(data['muns'], data['groups'])}
+
+
+def _run_targets(data: dict, config: Config):
+    from .targets import assign_targets, init_params, measure_of_size
+
+    params = init_params(data['groups'], n_init=config.n_init, L=config.L)
+    groups, params = assign_targets(data['groups'].copy(), params)
+
+    return {'groups': groups, 'params': params, 'Mm': measure_of_size(data['muns']['Nm'].values, params, alpha=config.alpha)}
+
+
+def _run_seed(data: dict, config: Config):
+    from .seed import fetch_pulse, seed_ints
+
+    timestr, timestamp, output_value = fetch_pulse(config.timestr, config.cache_path / 'beacon', config.beacon_url, config.offline)
+    ints = seed_ints(output_value)
+
+    # the last pulse (requested if none exists at the given time) is not memoized, and the stages after the seed are
+    # keyed by the pulse fetched (see pulse_key)
+    return {
+        'beacon': {'timestr': timestr, 'timestamp': timestamp, 'output_value': output_value},
+        'ints': ints,
+        'volatile': timestamp == 'LAST',
+    }
+
+
+def _run_select(data: dict, config: Config):
+    from .select import run_selection
+    from .streams import RandomStreams
+
+    return {'results': run_selection(data['muns'], data['groups'], data['group_index'], streams=RandomStreams(data['ints']),
+                                     method=config.method)}
+
+
+def _run_letters(data: dict, config: Config):
+    from .letters import calc_letters
+
+    return {'results': calc_letters(data['results'].copy(), data['muns'], data['groups'], data['params'])}
+
+
+def _run_weights(data: dict, config: Config):
+    from .streams import RandomStreams
+    from .weights import calc_weights
+
+    weights, joint_probs = calc_weights(data['results'], data['muns'], data['groups'], data['group_index'], method=config.method,
+                                        approximation=config.joint_approx, exact_max_units=config.exact_max_units,
+                                        streams=RandomStreams(data['ints']), K=config.joint_sims)
+
+    return {'weights': weights, 'joint_probs': joint_probs}
+
+
+def _run_replacements(data: dict, config: Config):
+    from .replacements import select_replacements
+    from .streams import REPLACEMENTS, RandomStreams
+
+    return {'replacements': select_replacements(data['results'], data['muns'], data['groups'], data['group_index'], num_repl=config.num_repl,
+                                                streams=RandomStreams(data['ints'], REPLACEMENTS), method=config.method)}
+
+
+def _run_addresses(data: dict, config: Config):
+    from .addresses import draw_addresses
+
+    return {'addresses': draw_addresses(data['results'], config.register_path, data['ints'], workers=config.workers)}
+
+
+def _run_stats(data: dict, config: Config):
+    from .stats import calc_probs, calc_stats, summarise_probs
+
+    stats = calc_stats(data['muns'], data['groups'], data['group_index'], data['ints'], config.Ks, workers=config.workers, cache_path=config.cache_path,
+                       method=config.method)
+    probs_summary, probs_group_summary = summarise_probs(stats, data['results'], data['muns'], data['params'])
+
+    return {
+        'probs_exact': calc_probs(data['results'], data['muns'], data['groups'], data['params']),
+        'stats': stats,
+        'probs_summary': probs_summary,
+        'probs_group_summary': probs_group_summary,
+    }
+
+
+# the plots are only created when writing their images
+def _run_plots(data: dict, config: Config):
+    return {}
+
+
+STAGE_FUNCS = {
+    'ingest': _run_ingest,
+    'stratify': _run_stratify,
+    'targets': _run_targets,
+    'seed': _run_seed,
+    'select': _run_select,
+    'letters': _run_letters,
+    'weights': _run_weights,
+    'replacements': _run_replacements,
+    'addresses': _run_addresses,
+    'stats': _run_stats,
+    'plots': _run_plots,
+}
+
+
+# tables of the outputs of a stage (in the order of OUTPUT_TABLES), with the labels of muns looked up once and shared by
+# the tables
+def output_tables(name: str, data: dict):
+    if name == 'targets':
+        from .targets import targets_table
+
+        return [targets_table(data['groups'], data['states'], data['classes'], data['strata'])]
+
+    if 'labels' not in data:
+        from .stratify import mun_labels
+
+        data['labels'] = mun_labels(data['muns'], data['states'], data['classes'])
+
+    if name == 'letters':
+        from .letters import results_table
+
+        return [results_table(data['results'], data['muns'], data['labels'])]
+    elif name == 'weights':
+        from .weights import weights_table
+
+        return [weights_table(data['weights'], data['labels']), data['joint_probs']]
+    elif name == 'replacements':
+        from .replacements import replacements_table
+
+        return [replacements_table(data['replacements'], data['labels'])]
+    elif name == 'addresses':
+        return [data['addresses']]
+
+
+# Export the figures and return their keys by file name. Figures are only exported if their key differs from the key
+# they were last written from.
+def write_figures(data: dict, config: Config, written: dict | None = None):
+    from .plots import export_figures, plot_letters, plot_measure, plot_population, plot_population_cumulative, plot_probs
+
+    max_points = config.plot_max_points
+    figs = {
+        'plot1': plot_population(data['muns'], data['classes'], max_points),
+        'plot2': plot_population_cumulative(data['muns'], max_points),
+        'plot4': plot_measure(data['muns'], max_points),
+        'plot5': plot_letters(data['results'], data['muns'], data['params'], max_points),
+    }
+    if 'stats' in data:
+        figs['plot3'] = plot_probs(data['stats'], data['results'], data['muns'], data['params'], max_points)
+
+    return export_figures(figs, config.output_path, written, workers=config.workers)
+
+
+# Run the requested stages and the stages they depend on. Outputs are only written for the requested stages. Stage
+# modules are imported when their stage runs, so plotting and the beacon client are only loaded when needed.
+#
+# Every stage has a key computed from its parameters and the keys of the stages it depends on. With memoization enabled,
+# stage outputs are stored in the cache directory under their key and loaded instead of recomputed while the key is
+# unchanged, so that eg after changing alpha only the targets and the stages after them are recomputed. The stages after
+# the seed are keyed by the beacon pulse fetched, so that they are recomputed when the last pulse changes. All random
+# draws come from counter-based random streams derived from the beacon ints, so that no random state has to be passed
+# between stages. Output files are only rewritten if they were written from a different key. The tables of all requested
+# stages are collected and written concurrently at the end.
+#
+# With profiling enabled, every stage and the writing of its outputs are instrumented separately and a report is written
+# to the output directory.
+def run_pipeline(stages: list[str], config: Config = Config()):
+    from .export import export_formats, export_tables
+
+    unknown = [fmt for fmt in config.formats if fmt not in export_formats]
+    if unknown:
+        raise Exception(f"Unknown export formats: {', '.join(unknown)}. Available formats: {', '.join(export_formats)}.")
+
+    requested = set(stages)
+    stages = resolve_stages(stages)
+    data = {}
+    keys = {}
+    tables = {}
+    written = {}
+
+    # instrumentation of stages if enabled
+    if config.profile:
+        from .profiling import Profiler
+        profiler = Profiler(trace_memory=config.trace_memory, profile_stage=config.profile_stage)
+        stage = profiler.stage
+    else:
+        profiler = None
+        stage = lambda name: nullcontext()
+
+    # create subdirectories if not yet present
+    for p in [config.input_path, config.cache_path, config.output_path]:
+        p.mkdir(parents=True, exist_ok=True)
+
+    memo = Memo(config.cache_path / 'stages') if config.memoize else None
+    code = code_key()
+
+    for name in stages:
+        keys[name] = stage_key(name, config, keys, code)
+
+        with stage(name):
+            # load memoized outputs or run stage
+            outputs = memo.load(name, keys[name]) if memo is not None and name in MEMOIZED else None
+            if outputs is not None:
+                count('memoized')
+            else:
+                outputs = STAGE_FUNCS[name](data, config)
+
+                if memo is not None and name in MEMOIZED and not outputs.pop('volatile', False):
+                    memo.save(name, keys[name], outputs)
+
+            data.update(outputs)
+
+            # attach measure of size to muns
+            if name == 'targets':
+                data['muns']['Mm'] = data['Mm']
+
+            # key the stages after the seed by the pulse fetched rather than by the time string
+            if name == 'seed':
+                keys['seed'] = pulse_key(data['beacon'])
+
+        if name == 'seed':
+            print(f"Time string: {data['beacon']['timestr']}")
+            print(f"Timestamp: {data['beacon']['timestamp']}")
+            print(f"Beacon output: {data['beacon']['output_value']}")
+            print(f"Ints for seeding: {data['ints']}")
+        if name == 'stats':
+            print(data['probs_summary'].to_string())
+
+        # collect tables of requested stages for the formats not up to date
+        if name in requested and name in OUTPUT_TABLES:
+            fnames = {
+                table_name: [
+                    f"{table_name}.{fmt}"
+                    for fmt in config.formats
+                    if memo is None or not memo.outputs_current(config.output_path, [f"{table_name}.{fmt}"], keys[name])
+                ]
+                for table_name in OUTPUT_TABLES[name]
+            }
+            if any(fnames.values()):
+                with stage(f"{name}:table"):
+                    stage_tables = output_tables(name, data)
+                for table_name, table in zip(OUTPUT_TABLES[name], stage_tables):
+                    tables.update({fname: table for fname in fnames[table_name]})
+                    written.update({fname: keys[name] for fname in fnames[table_name]})
+
+        # export figures (checked one by one for changes)
+        if name in requested and name == 'plots':
+            with stage('plots:output'):
+                fig_keys = write_figures(data, config, memo.outputs if memo is not None else None)
+
+            if memo is not None:
+                memo.set_outputs(fig_keys)
+
+    # write all tables concurrently
+    if tables:
+        with stage('tables:output'):
+            export_tables(tables, config.output_path, workers=config.workers)
+
+        if memo is not None:
+            memo.set_outputs(written)
+
+    if profiler is not None:
+        data['report'] = profiler.write_report(config.output_path)
+
+    return data
@@ -0,0 +1,269 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+from .profiling import count
+
+
+# muns with a larger population are labelled in the plots and never merged or dropped when downsampling
+label_threshold = 0.5E+6
+
+
+# Positions of at most n_out points of a line chosen by largest-triangle-three-buckets (LTTB): the points are split into
+# n_out - 2 buckets between the first and last point, and from every bucket the point spanning the largest triangle with
+# the point chosen from the bucket before and the mean of the bucket after is kept. Points in keep (eg labelled muns or
+# outliers) are always kept in addition. Without n_out, all positions are returned.
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int | None, keep: np.ndarray | None = None):
+    n = len(x)
+    if n_out is None or n <= max(n_out, 2):
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, max(n_out, 3) - 1).astype(np.int64)
+
+    positions = [0]
+    for i in range(len(edges) - 1):
+        # mean of next bucket, or last point after last bucket
+        if i + 2 < len(edges):
+            x_next, y_next = x[edges[i+1]:edges[i+2]].mean(), y[edges[i+1]:edges[i+2]].mean()
+        else:
+            x_next, y_next = x[-1], y[-1]
+
+        a = positions[-1]
+        area = np.abs((x[a] - x_next) * (y[edges[i]:edges[i+1]] - y[a]) - (x[a] - x[edges[i]:edges[i+1]]) * (y_next - y[a]))
+        positions.append(edges[i] + np.nanargmax(area) if not np.isnan(area).all() else edges[i])
+    positions.append(n - 1)
+
+    positions = np.array(positions)
+    if keep is not None:
+        positions = np.union1d(positions, np.flatnonzero(keep))
+
+    return positions
+
+
+# Bars of muns with width given by population, with consecutive muns merged into bars of at least 1 / max_points of the
+# total population. Muns at least that wide and labelled muns keep a bar of their own. Merged bars take the height of
+# their largest mun, as the individual bars would be drawn narrower than a pixel. Without max_points, every mun is a bar.
+def population_bars(muns: pd.DataFrame, max_points: int | None = None):
+    Nm = muns['Nm'].values.astype(np.int64)
+    x0 = np.cumsum(Nm) - Nm
+
+    if max_points is None or len(Nm) <= max_points:
+        starts = np.arange(len(Nm))
+    else:
+        width = Nm.sum() / max_points
+        own = (Nm >= width) | (Nm > label_threshold)
+        bucket = (x0 // width).astype(np.int64)
+        starts = np.flatnonzero(np.concatenate([[True], (bucket[1:] != bucket[:-1]) | own[1:] | own[:-1]]))
+
+    num_muns = np.diff(np.append(starts, len(Nm)))
+    names = muns['Mun-Name'].values[starts].astype(object)
+    shortnames = muns['Mun-Shortname'].values[starts].astype(object)
+
+    return pd.DataFrame({
+        'x0': x0[starts],
+        'Nm': np.maximum.reduceat(Nm, starts) if len(Nm) else Nm,
+        'width': np.add.reduceat(Nm, starts) if len(Nm) else Nm,
+        'Mun-Name': np.where(num_muns == 1, names, [f"{n} municipalities" for n in num_muns]),
+        'Mun-Shortname': np.where(num_muns == 1, shortnames, None),
+    })
+
+
+# population of muns as bars with width given by population, with the size classes illustrated
+def plot_population(muns: pd.DataFrame, classes: pd.DataFrame, max_points: int | None = None):
+    bars = population_bars(muns, max_points)
+    fig = go.Figure(go.Bar(
+        x=bars['x0'],
+        y=bars['Nm'],
+        width=bars['width'],
+        offset=0.0,
+        text=bars.where(lambda d: d['Nm'] > label_threshold)['Mun-Shortname'],
+        customdata=bars['Mun-Name'],
+        hovertemplate='<br>'.join([
+            '<b>%{customdata}</b>',
+            'Pop: %{y}',
+            '<extra></extra>',
+        ]),
+    ))
+    fig.update_traces(
+        textfont_size=8,
+        textangle=270,
+        textposition='outside',
+        cliponaxis=True,
+    )
+    fig.update_layout(
+        xaxis_range=[0, 40E+6],
+        yaxis_range=[0, 5E+6],
+        uniformtext_minsize=5,
+        uniformtext_mode='show',
+    )
+
+    # add horizontal lines to illustrate classes
+    for class_id, class_row in classes.iterrows():
+        x0 = muns.iloc[:(muns['Nm'] < class_row['Threshold']).argmax()]['Nm'].sum()
+        fig.add_vline(x=x0)
+        fig.add_annotation(x=x0, xanchor='left', y=4.5E+6, text=class_row['Class-Desc'], showarrow=False)
+
+    return fig
+
+
+# population of muns over cumulative population
+def plot_population_cumulative(muns: pd.DataFrame, max_points: int | None = None):
+    Nm_cum = muns['Nm'].cumsum()
+    positions = lttb(Nm_cum.values, muns['Nm'].values, max_points, keep=muns['Nm'].values > label_threshold)
+    muns = muns.iloc[positions]
+
+    fig = go.Figure(go.Scatter(
+        x=Nm_cum.iloc[positions],
+        y=muns['Nm'],
+        customdata=muns['Mun-Name'],
+        mode='markers+lines',
+        hovertemplate='<br>'.join([
+            '<b>%{customdata}</b>',
+            'Pop: %{y}',
+            '<extra></extra>',
+        ]),
+    ))
+
+    return fig
+
+
+# Probability of receiving a letter for every citizen in each municipality, q_m = k_m / K * Lm / Nm, computed column by
+# column (eg from a count store) without melting the counts into a long frame. The muns are plotted by position with
+# their Mun-ID shown on hover. When downsampling, the tenth of points deviating most from L*/N* are always kept.
+def plot_probs(stats: pd.DataFrame, results: pd.DataFrame, muns: pd.DataFrame, params: dict, max_points: int | None = None):
+    Lm_Nm = (results['Lm'] / muns['Nm']).loc[stats.index].values
+    x = np.arange(len(stats))
+    q_target = params['L*'] / params['N*']
+
+    # plot one line per number of iterations
+    traces = []
+    for K in stats.columns:
+        q = stats[K].values / K * Lm_Nm
+        keep = None
+        if max_points is not None and len(q) > max_points:
+            keep = np.zeros(len(q), dtype=bool)
+            keep[np.argpartition(-np.nan_to_num(np.abs(q - q_target)), max_points // 10)[:max_points // 10]] = True
+        positions = lttb(x, q, max_points, keep=keep)
+        traces.append(go.Scatter(
+            x=x[positions],
+            y=q[positions],
+            customdata=stats.index.values[positions],
+            name=str(K),
+            mode='lines',
+            hovertemplate='Mun-ID: %{customdata}<br>Prob: %{y}',
+        ))
+
+    fig = go.Figure(traces)
+    fig.add_hline(q_target)
+    fig.update_layout(
+        xaxis_title='Mun',
+        yaxis_title='Prob',
+        legend_title_text='Iterations',
+        xaxis_range=[0, 1000],
+        yaxis_range=[0, 0.0005],
+    )
+
+    return fig
+
+
+# measure of size (Mm) along with the population size (Nm), downsampled to the union of the points kept for either
+def plot_measure(muns: pd.DataFrame, max_points: int | None = None):
+    Nm_cum = muns['Nm'].cumsum()
+    keep = muns['Nm'].values > label_threshold
+    positions = np.union1d(
+        lttb(Nm_cum.values, muns['Nm'].values, max_points, keep=keep),
+        lttb(Nm_cum.values, muns['Mm'].values, max_points, keep=keep),
+    )
+    muns = muns.iloc[positions]
+    Nm_cum = Nm_cum.iloc[positions]
+
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=Nm_cum,
+        y=muns['Nm'],
+        customdata=muns['Mun-Name'],
+        name='Real Population',
+        mode='markers+lines',
+        hovertemplate='<br>'.join([
+            '<b>%{customdata}</b>',
+            'Pop: %{y}',
+            '<extra></extra>',
+        ]),
+    ))
+    fig.add_trace(go.Scatter(
+        x=Nm_cum,
+        y=muns['Mm'],
+        customdata=muns['Mun-Name'],
+        name='Measure of Size',
+        mode='markers+lines',
+        hovertemplate='<br>'.join([
+            '<b>%{customdata}</b>',
+            'Pop: %{y}',
+            '<extra></extra>',
+        ]),
+    ))
+
+    fig.update_layout(
+        xaxis_range=[60000000.0, 84360000.0],
+        yaxis_range=[0.0, 30000.0],
+    )
+
+    return fig
+
+
+# number of letters to send in a municipality, keeping labelled and certainty muns when downsampling
+def plot_letters(results: pd.DataFrame, muns: pd.DataFrame, params: dict, max_points: int | None = None):
+    results = results.assign(Nm_cum=muns['Nm'].cumsum())
+    keep = (muns['Nm'].values > label_threshold) | results['Certainty'].values
+    results = results.iloc[lttb(results['Nm_cum'].values, results['Lm'].values, max_points, keep=keep)]
+
+    fig = px.line(results, x='Nm_cum', y='Lm')
+    fig.add_hline(params['L*'] / params['n*'])
+
+    fig.update_layout(
+        xaxis_range=[0, 84360000.0],
+        yaxis_range=[0.0, 800.0],
+    )
+
+    return fig
+
+
+# key of a figure from its data and layout
+def figure_key(fig: go.Figure):
+    return hashlib.sha256(fig.to_json().encode()).hexdigest()[:16]
+
+
+def _write_figure(fig: go.Figure, fpath: Path):
+    fig.write_image(fpath)
+
+
+# Write figures (by name) to image files in the output directory, concurrently in a process pool with one kaleido per
+# process. Figures whose image exists and was written from a figure with the same key (given by file name) are skipped.
+# Returns the keys of all figures by file name.
+def export_figures(figs: dict[str, go.Figure], output_path: Path, keys: dict | None = None, workers: int | None = None,
+                   fmt: str = 'png'):
+    keys = keys or {}
+    fig_keys = {f"{name}.{fmt}": figure_key(fig) for name, fig in figs.items()}
+    pending = [
+        (fig, output_path / fname)
+        for (fname, key), fig in zip(fig_keys.items(), figs.values())
+        if not ((output_path / fname).exists() and keys.get(fname) == key)
+    ]
+    count('figures written', len(pending))
+
+    if workers == 1 or len(pending) <= 1:
+        for fig, fpath in pending:
+            _write_figure(fig, fpath)
+    elif pending:
+        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count(), len(pending))) as executor:
+            list(executor.map(_write_figure, *zip(*pending)))
+
+    return fig_keys
@@ -0,0 +1,84 @@
+import cProfile
+import json
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+# Opt-in instrumentation of pipeline stages. Every stage run within `Profiler.stage` records its wall and CPU time, the
+# peak resident memory of the process after the stage, and, if tracing memory, the peak and net memory allocated during
+# the stage. Counters (eg groups processed or certainty units found) are incremented via `count` from within the stage
+# functions and are attributed to the stage running at the time. Counts in worker processes are not recorded.
+class Profiler:
+    def __init__(self, trace_memory: bool = True, profile_stage: str | None = None):
+        self.trace_memory = trace_memory
+        self.profile_stage = profile_stage
+        self.stages = []
+        self._profile = None
+
+    @contextmanager
+    def stage(self, name: str):
+        global _active
+        record = {'stage': name, 'counters': {}}
+        self.stages.append(record)
+
+        # start memory tracing and profiler for this stage
+        if self.trace_memory:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+            traced_start = tracemalloc.get_traced_memory()[0]
+        if name == self.profile_stage:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+        _active_prev, _active = _active, record
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - wall_start
+            record['cpu_s'] = time.process_time() - cpu_start
+            _active = _active_prev
+
+            if name == self.profile_stage:
+                self._profile.disable()
+            if self.trace_memory:
+                traced_end, traced_peak = tracemalloc.get_traced_memory()
+                record['traced_peak_mb'] = (traced_peak - traced_start) / 2**20
+                record['traced_net_mb'] = (traced_end - traced_start) / 2**20
+                tracemalloc.stop()
+
+            # peak resident memory of the process so far (in kilobytes on Linux)
+            record['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    # write report as JSON and, if a stage was profiled, its profile in the format of the pstats module
+    def write_report(self, output_path: Path, name: str = 'run_report'):
+        report = {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'wall_s': sum(record['wall_s'] for record in self.stages),
+            'cpu_s': sum(record['cpu_s'] for record in self.stages),
+            'max_rss_mb': max((record['max_rss_mb'] for record in self.stages), default=None),
+            'stages': self.stages,
+        }
+
+        with open(output_path / f"{name}.json", 'w') as f:
+            json.dump(report, f, indent=2)
+
+        if self._profile is not None:
+            self._profile.dump_stats(output_path / f"{name}_{self.profile_stage}.prof")
+
+        return report
+
+
+# record of the stage currently running, if any
+_active = None
+
+
+# increment counter of the stage currently running (does nothing if no stage is instrumented)
+def count(name: str, n: int = 1):
+    if _active is not None:
+        _active['counters'][name] = _active['counters'].get(name, 0) + int(n)
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+from .profiling import count
+from .samplers import Draws, samplers, spatial_samplers
+from .select import extract_certainty
+from .stratify import GroupIndex
+from .streams import RandomStreams
+
+
+# select replacement municipalities for each group from the muns not selected with one of the sampling methods (see
+# samplers), with the random numbers drawn from the random state or, if given, from the random streams of the groups
+def select_replacements(results: pd.DataFrame, muns: pd.DataFrame, groups: pd.DataFrame, group_index: GroupIndex, num_repl: int = 5, random_state=np.random,
+                        streams: RandomStreams | None = None, method: str = 'pps_sys'):
+    if method not in samplers:
+        raise Exception(f"Unknown sampling method: {method}. Available methods: {', '.join(samplers)}.")
+
+    # positions of certainty muns (or all muns if not enough are left) and non-certainty muns to sample from in each group
+    mos = muns['Mm'].values
+    group_replacements = []
+    sample_positions = []
+    sample_sizes = []
+    sample_group_ids = []
+
+    # loop over groups (with non-zero muns in them)
+    for group_id in groups.index[groups['ng'] != 0.0]:
+        count('groups processed')
+
+        # get positions of all eligible municipalities
+        this_positions = group_index.slice(group_id)
+        this_positions = this_positions[results['Selected'].values[this_positions] == 0]
+
+        # get target and count for group
+        this_ng = num_repl
+        this_Cg = len(this_positions)
+
+        # only perform PPS if there are more muns in the groups left than replacements we plan to select
+        if this_ng >= this_Cg:
+            group_replacements.append((this_positions, None))
+        else:
+            # remove muns with certainty
+            cond_muns_certainty, this_ng_noncertainty = extract_certainty(mos[this_positions], this_ng)
+            this_positions_certainty = this_positions[cond_muns_certainty]
+            this_positions_noncertainty = this_positions[~cond_muns_certainty]
+            count('certainty units', cond_muns_certainty.sum())
+
+            # check that no certainty muns remain
+            this_mos_noncertainty = mos[this_positions_noncertainty]
+            if (this_mos_noncertainty / this_mos_noncertainty.sum() * this_ng_noncertainty >= 1).any():
+                raise Exception(
+                    f"A group contains certainty muns.\n\n"
+                    f"{groups.loc[group_id]}"
+                )
+
+            # for certainty units update results and collect non-certainty muns for sampling
+            group_replacements.append((this_positions_certainty, len(sample_positions)))
+            sample_positions.append(this_positions_noncertainty)
+            sample_sizes.append(this_ng_noncertainty)
+            sample_group_ids.append(group_id)
+
+    # run selection for all groups at once
+    if sample_positions:
+        sample_offsets = np.cumsum([0] + [len(this_positions) for this_positions in sample_positions])
+        hits = samplers[method](
+            mos=mos[np.concatenate(sample_positions)],
+            offsets=sample_offsets,
+            samp_sizes=sample_sizes,
+            draws=Draws(sample_group_ids, streams=streams, random_state=random_state),
+            coords=muns[['LONG', 'LAT']].values[np.concatenate(sample_positions)] if method in spatial_samplers else None,
+        )
+
+    # combine certainty muns and sampled muns group by group
+    replacement_positions = []
+    for this_positions, sample_id in group_replacements:
+        if sample_id is not None:
+            this_hits = hits[0, sample_offsets[sample_id]:sample_offsets[sample_id+1]]
+            this_positions = np.concatenate([this_positions, sample_positions[sample_id][this_hits > 0]])
+
+        replacement_positions.append(this_positions)
+
+    replacements = muns.iloc[np.concatenate(replacement_positions)].copy()
+    replacements['Lm'] = results.loc[replacements.index, 'Lm']
+    replacements['Lm_rounded'] = replacements['Lm'].round()
+
+    return replacements
+
+
+# replacements in user-friendly format, with the labels of muns (see mun_labels)
+def replacements_table(replacements: pd.DataFrame, labels: pd.DataFrame):
+    return pd.concat([replacements, labels.loc[replacements.index]], axis=1)
@@ -0,0 +1,321 @@
+from dataclasses import dataclass
+from functools import lru_cache, partial
+
+import numpy as np
+
+from .profiling import count
+from .streams import RandomStreams
+
+
+# max number of rounds of rejective sampling before giving up on a sample
+max_rounds = 10000
+
+# tolerance of the working probabilities of conditional Poisson sampling, max number of Newton steps to find them, and
+# relative tolerance of the conjugate gradients solving for every step
+cps_tol = 1e-10
+cps_max_steps = 100
+cps_cg_tol = 1e-3
+
+
+# Random numbers of a selection run for the groups sampled from: iterations k0 to k0 + K - 1 draw from the random
+# streams of the groups if given, and otherwise from the random state.
+@dataclass
+class Draws:
+    group_ids: list[int]
+    K: int = 1
+    k0: int = 0
+    streams: RandomStreams | None = None
+    random_state: object = np.random
+
+    # random starts of all groups and iterations as array of shape (groups, K), or None to draw them from the random state
+    def random_starts(self):
+        if self.streams is None:
+            return None
+        return self.streams.random_starts(self.group_ids, self.k0, self.K)
+
+    # random generator of the g-th group in iteration k
+    def generator(self, g: int, k: int):
+        if self.streams is None:
+            return self.random_state
+        return self.streams.generator(self.group_ids[g], self.k0 + k)
+
+    # random generators of the g-th group in all iterations
+    def generators(self, g: int):
+        return [self.generator(g, k) for k in range(self.K)]
+
+
+# PPS-SYS sampling (probability-proportional-to-size) w/o replacement, following the implementation in the samplics
+# package. Unless given (eg from counter-based random streams), the random starts of all groups and iterations are drawn
+# at once from the random state, in the same order as consecutive samplics calls (group by group, K times each), so the
+# selection is identical for the same random seed. Returns the number of hits for every iteration and unit.
+def pps_sys_select(mos: np.ndarray, offsets: np.ndarray, samp_sizes: list[int], K: int = 1, random_state=np.random,
+                   random_starts: np.ndarray | None = None):
+    # number of groups and units
+    G = len(samp_sizes)
+    U = len(mos)
+
+    # draw all random starts at once
+    if random_starts is None:
+        random_starts = random_state.random_sample(G * K).reshape(G, K)
+
+    # loop over groups and collect hits as flat indices into the K x U array
+    hits_flat = []
+    for g, samp_size in enumerate(samp_sizes):
+        # cumulative measure of size of units in this group
+        start, end = offsets[g], offsets[g+1]
+        cumsize = np.append(0, np.cumsum(mos[start:end]))
+
+        # random picks for all K iterations
+        samp_interval = cumsize[-1] / samp_size
+        random_picks = (random_starts[g] * samp_interval)[:, None] + samp_interval * np.linspace(0, samp_size - 1, samp_size)
+
+        # unit k is hit if cumsize[k] < pick <= cumsize[k+1]
+        units = np.searchsorted(cumsize, random_picks, side='left') - 1
+        iters = np.broadcast_to(np.arange(K)[:, None], units.shape)
+        valid = (units >= 0) & (units < end - start)
+        hits_flat.append(iters[valid] * U + start + units[valid])
+
+    # count hits for every iteration and unit
+    hits = np.bincount(np.concatenate(hits_flat) if hits_flat else np.array([], dtype=int), minlength=K * U)
+
+    count('pps_sys_select calls')
+    count('draws', K * sum(samp_sizes))
+
+    return hits.reshape(K, U).astype(np.int32)
+
+
+# Pareto πps sampling (Rosén 1997): every unit gets the ranking variable Q = U / (1 - U) / (pi / (1 - pi)) from a
+# uniform number U, and the n units with the smallest Q are selected. The K samples are drawn at once, and the
+# inclusion probabilities are close to but not exactly pi (the more so the larger the sample).
+def pareto_design(pi: np.ndarray, n: int, generators: list):
+    u = np.stack([rng.random(len(pi)) for rng in generators])
+    q = u * (1 - pi) / ((1 - u) * pi)
+
+    selected = np.zeros(q.shape, dtype=bool)
+    np.put_along_axis(selected, np.argpartition(q, n - 1, axis=1)[:, :n], True, axis=1)
+
+    return selected
+
+
+# Probabilities of the sum of the first i Bernoulli variables with probabilities p being j, for i from 0 to N and j from
+# 0 to n, as array of shape (N + 1, n + 1), computed with the convolution recursion (the reverse of p gives the
+# probabilities of the sums of the last units).
+def poisson_sum_probs(p: np.ndarray, n: int):
+    probs = np.zeros((len(p) + 1, n + 1))
+    probs[0, 0] = 1.0
+    for i, p_i in enumerate(p):
+        probs[i+1] = probs[i] * (1 - p_i)
+        probs[i+1, 1:] += probs[i, :-1] * p_i
+
+    return probs
+
+
+# Probabilities of the sums of Bernoulli variables as in poisson_sum_probs, together with their derivatives in the
+# direction dp of the probabilities p, propagated through the same recursion.
+def poisson_sum_derivs(p: np.ndarray, n: int, dp: np.ndarray):
+    probs = np.zeros((len(p) + 1, n + 1))
+    dprobs = np.zeros((len(p) + 1, n + 1))
+    probs[0, 0] = 1.0
+    for i, (p_i, dp_i) in enumerate(zip(p, dp)):
+        probs[i+1] = probs[i] * (1 - p_i)
+        probs[i+1, 1:] += probs[i, :-1] * p_i
+        dprobs[i+1] = dprobs[i] * (1 - p_i) - probs[i] * dp_i
+        dprobs[i+1, 1:] += dprobs[i, :-1] * p_i + probs[i, :-1] * dp_i
+
+    return probs, dprobs
+
+
+# Poisson probabilities with the given log-odds up to a common shift, which is chosen such that the Poisson sample size
+# has expectation n. Conditional Poisson sampling only depends on the odds up to a common factor, so the shift does not
+# change the design but keeps the probabilities of the sample sizes well away from zero.
+def poisson_probs(lam: np.ndarray, n: int):
+    from scipy.optimize import brentq
+    from scipy.special import expit
+
+    return expit(lam + brentq(lambda c: expit(lam + c).sum() - n, -lam.max() - 50, -lam.min() + 50))
+
+
+# Inclusion probabilities of conditional Poisson sampling of size n with Poisson probabilities p, ie of Poisson sampling
+# conditioned on the sample size: unit k is included with probability p_k * P(sum of the other units = n - 1) /
+# P(sum = n), with the sums of the other units combined from the sums of the units before and after k. Unlike the
+# recursion over sample sizes, this only adds up probabilities and stays accurate for inclusion probabilities close to
+# one.
+def cps_inclusion_probs(p: np.ndarray, n: int):
+    before = poisson_sum_probs(p, n)
+    after = poisson_sum_probs(p[::-1], n)[::-1]
+    others = (before[:-1, :n] * after[1:, n-1::-1]).sum(axis=1)
+
+    return p * others / before[-1, n]
+
+
+# Product of the Jacobian of the inclusion probabilities of conditional Poisson sampling with respect to the log-odds of
+# the Poisson probabilities p (which is the covariance matrix of the sample indicators) with a vector v, from the
+# derivatives of cps_inclusion_probs in the direction v in a single pass.
+def cps_inclusion_probs_jvp(p: np.ndarray, n: int, v: np.ndarray):
+    dp = p * (1 - p) * v
+    before, dbefore = poisson_sum_derivs(p, n, dp)
+    after, dafter = (probs[::-1] for probs in poisson_sum_derivs(p[::-1], n, dp[::-1]))
+    others = (before[:-1, :n] * after[1:, n-1::-1]).sum(axis=1)
+    dothers = (dbefore[:-1, :n] * after[1:, n-1::-1] + before[:-1, :n] * dafter[1:, n-1::-1]).sum(axis=1)
+
+    return (dp * others + p * dothers - p * others * dbefore[-1, n] / before[-1, n]) / before[-1, n]
+
+
+# Newton step of the log-odds for the deviation r of the inclusion probabilities of conditional Poisson sampling,
+# solving J x = r for the Jacobian J with conjugate gradients preconditioned with the diagonal d
+def _cps_newton_step(p: np.ndarray, n: int, r: np.ndarray, d: np.ndarray):
+    x = np.zeros(len(r))
+    res = r.copy()
+    z = res / d
+    q = z.copy()
+    rz = res @ z
+    for _ in range(len(r)):
+        Jq = cps_inclusion_probs_jvp(p, n, q)
+        a = rz / (q @ Jq)
+        x += a * q
+        res -= a * Jq
+        if np.abs(res).max() < cps_cg_tol * np.abs(r).max():
+            break
+        z = res / d
+        rz, rz_prev = res @ z, rz
+        q = z + rz / rz_prev * q
+
+    return x
+
+
+# Poisson probabilities for which conditional Poisson sampling of size n has the inclusion probabilities pi. Their
+# log-odds maximise the entropy of the design, which is concave in the log-odds with the covariance matrix of the sample
+# indicators as Hessian, so they are found with Newton's method from the log-odds of pi. Every step is solved with
+# conjugate gradients from exact products with the covariance matrix (see cps_inclusion_probs_jvp), preconditioned with
+# its diagonal under Hájek's approximation pi_k (1 - pi_k), and halved until it reduces the largest deviation from pi.
+# Unlike the fixed-point iteration of Tillé (2006, sec. 5.6), which slows down to a crawl for inclusion probabilities
+# close to one or small groups, this takes a handful of steps. Cached by the inclusion probabilities, as they are the
+# same in every batch of iterations.
+@lru_cache(maxsize=1024)
+def _cps_poisson_probs(pi_bytes: bytes, n: int):
+    from scipy.special import logit
+
+    pi = np.frombuffer(pi_bytes)
+    lam = logit(pi)
+    p = poisson_probs(lam, n)
+    dev = pi - cps_inclusion_probs(p, n)
+    for _ in range(cps_max_steps):
+        if np.abs(dev).max() < cps_tol:
+            return p
+
+        step = _cps_newton_step(p, n, dev, pi * (1 - pi))
+        for t in 0.5 ** np.arange(20):
+            p_step = poisson_probs(lam + t * step, n)
+            dev_step = pi - cps_inclusion_probs(p_step, n)
+            if np.abs(dev_step).max() < np.abs(dev).max():
+                break
+        lam, p, dev = lam + t * step, p_step, dev_step
+        count('cps newton steps')
+
+    raise Exception(f"The working probabilities of conditional Poisson sampling did not converge.")
+
+
+def cps_poisson_probs(pi: np.ndarray, n: int):
+    return _cps_poisson_probs(np.ascontiguousarray(pi, dtype=float).tobytes(), n)
+
+
+# Draw conditional Poisson samples of size n with Poisson probabilities p exactly (without rejection) from one uniform
+# number per iteration and unit: going through the units, unit i is included with probability p_i * P(sum of the units
+# after i = r - 1) / P(sum of the units from i on = r), where r is the number of units still to select. The decisions of
+# all iterations are taken at once, unit by unit. Returns a boolean array of shape (iterations, units).
+def cps_sequential_draw(p: np.ndarray, n: int, u: np.ndarray):
+    after = poisson_sum_probs(p[::-1], n)[::-1]
+    selected = np.zeros(u.shape, dtype=bool)
+    remaining = np.full(len(u), n)
+
+    for i, p_i in enumerate(p):
+        prob = p_i * after[i+1, np.maximum(remaining - 1, 0)] / np.maximum(after[i, remaining], np.finfo(float).tiny)
+        selected[:, i] = (remaining > 0) & (u[:, i] < prob)
+        remaining -= selected[:, i]
+
+    return selected
+
+
+# Conditional Poisson sampling (maximum entropy design), drawn with the working probabilities that give inclusion
+# probabilities pi (up to their tolerance) and the sequential method.
+def conditional_poisson_design(pi: np.ndarray, n: int, generators: list):
+    u = np.stack([rng.random(len(pi)) for rng in generators])
+
+    return cps_sequential_draw(cps_poisson_probs(pi, n), n, u)
+
+
+# Sampford sampling: samples s of size n with probability proportional to sum(1 - pi_k) * prod(pi_k / (1 - pi_k)) over
+# the units k in s, which has inclusion probabilities pi exactly. Instead of the usual rejection of draws with
+# replacement, whose acceptance rate drops quickly for large samples or inclusion probabilities close to one, samples
+# are drawn from conditional Poisson sampling with odds pi / (1 - pi) and accepted with probability sum(1 - pi_k) over
+# the sample divided by its maximum. Each round draws one candidate for all pending iterations at once, from their own
+# generators, so that the sample of an iteration does not depend on the other iterations in the batch.
+def sampford_design(pi: np.ndarray, n: int, generators: list):
+    from scipy.special import logit
+
+    N = len(pi)
+    p = poisson_probs(logit(pi), n)
+    bound = np.sort(1 - pi)[-n:].sum()
+    selected = np.zeros((len(generators), N), dtype=bool)
+
+    pending = np.arange(len(generators))
+    for _ in range(max_rounds):
+        u = np.stack([generators[k].random(N + 1) for k in pending])
+        samples = cps_sequential_draw(p, n, u[:, :N])
+        accepted = u[:, N] * bound < samples @ (1 - pi)
+        selected[pending[accepted]] = samples[accepted]
+        pending = pending[~accepted]
+        count('rejected samples', len(pending))
+        if not len(pending):
+            return selected
+
+    raise Exception(f"Sampford sampling did not draw a sample of size {n} in {max_rounds} rounds.")
+
+
+# Sampling w/o replacement with inclusion probabilities proportional to the measure of size with one of the designs
+# above, which draw the K samples of a group at once from its generators (see Draws). Units without measure of size are
+# never selected. Returns the number of hits for every iteration and unit.
+def design_select(design, mos: np.ndarray, offsets: np.ndarray, samp_sizes: list[int], draws: Draws,
+                  coords: np.ndarray | None = None):
+    hits = np.zeros((draws.K, len(mos)), dtype=np.int32)
+
+    for g, samp_size in enumerate(samp_sizes):
+        if samp_size == 0:
+            continue
+        positions = offsets[g] + np.flatnonzero(mos[offsets[g]:offsets[g+1]] > 0)
+        pi = samp_size * mos[positions] / mos[positions].sum()
+        hits[:, positions] = design(pi, samp_size, draws.generators(g))
+
+    count(f"{design.__name__} calls")
+    count('draws', draws.K * sum(samp_sizes))
+
+    return hits
+
+
+def _pps_sys_sampler(mos: np.ndarray, offsets: np.ndarray, samp_sizes: list[int], draws: Draws,
+                     coords: np.ndarray | None = None):
+    return pps_sys_select(mos, offsets, samp_sizes, draws.K, draws.random_state, draws.random_starts())
+
+
+def _lpm_sampler(mos: np.ndarray, offsets: np.ndarray, samp_sizes: list[int], draws: Draws,
+                 coords: np.ndarray | None = None):
+    from .spatial import lpm_select
+
+    return lpm_select(mos, coords, offsets, samp_sizes, draws.K, draws.generator)
+
+
+# Registry of sampling methods, all with the interface sampler(mos, offsets, samp_sizes, draws, coords) returning the
+# number of hits for every iteration and unit: PPS-SYS (as in samplics), spatially balanced sampling with the local
+# pivotal method (which requires the coordinates of the units), and the πps designs of Sampford, conditional Poisson, and
+# Pareto sampling. Compare them with python -m benchmarks.samplers. The samplers only import scipy when they are used, so
+# that the default PPS-SYS selection does not load it.
+samplers = {
+    'pps_sys': _pps_sys_sampler,
+    'lpm': _lpm_sampler,
+    'sampford': partial(design_select, sampford_design),
+    'conditional_poisson': partial(design_select, conditional_poisson_design),
+    'pareto': partial(design_select, pareto_design),
+}
+
+# sampling methods that require the coordinates of the units
+spatial_samplers = ['lpm']
@@ -0,0 +1,37 @@
+import warnings
+from pathlib import Path
+
+from .beacon import BeaconClient, beacon_url
+
+
+# Request beacon pulse at time given by time string, or the last pulse if none exists at that time (eg in the future),
+# which is never taken from the cache. With a cache path, pulses are cached locally, so that reruns for the same time
+# string are instant and can run offline.
+def fetch_pulse(timestr: str, cache_path: Path | None = None, url: str = beacon_url, offline: bool = False):
+    # time parser is only imported when needed
+    from dateutil import parser
+
+    # set timestamp
+    timestamp = int(parser.parse(timestr).timestamp()) * 1000
+
+    # request beacon at timestamp
+    client = BeaconClient(url, cache_path=cache_path, offline=offline)
+    pulse = client.pulse_at(timestamp)
+
+    # if there is no pulse at the timestamp, use the last pulse instead
+    if pulse is None:
+        warnings.warn(f"No beacon pulse found at {timestr}, using the last pulse instead.")
+        timestr = timestamp = 'LAST'
+        pulse = client.last_pulse()
+
+    # get output value in hex format
+    output_value = pulse['outputValue']
+
+    return timestr, timestamp, output_value
+
+
+# convert beacon output value to list of ints for seeding
+def seed_ints(output_value: str):
+    l = 8
+    chunks = [output_value[y-l:y] for y in range(l, len(output_value)+l, l)]
+    return [int(c, 16) for c in chunks]
@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+
+from .profiling import count
+from .samplers import Draws, samplers, spatial_samplers
+from .stratify import GroupIndex
+from .streams import RandomStreams
+
+
+# Municipalities whose inclusion probability ng * Mm / Mg would exceed one are selected with certainty and removed from
+# the PPS selection. Sorting the muns by measure of size, the certainty units are always the c largest ones, where c is
+# the first count for which the largest remaining mun no longer exceeds one after the c largest are removed. This is
+# found in a single pass using the suffix sums of the measure of size.
+def extract_certainty(mos: np.ndarray, samp_size: int):
+    # sort by measure of size in descending order
+    order = np.argsort(-mos, kind='stable')
+    mos_sorted = mos[order]
+
+    # inclusion probability of the c-th largest unit after removing the c largest units for every c
+    c = np.arange(len(mos_sorted))
+    mos_remaining = np.cumsum(mos_sorted[::-1])[::-1]
+    cond_certainty = (mos_sorted / mos_remaining * (samp_size - c)) > 1
+
+    # number of certainty units is the first c for which the c-th largest unit is not a certainty unit
+    num_certainty = int(np.argmin(cond_certainty)) if not cond_certainty.all() else len(mos_sorted)
+
+    # mark certainty units in original order
+    certainty = np.zeros(len(mos_sorted), dtype=bool)
+    certainty[order[:num_certainty]] = True
+
+    return certainty, samp_size - num_certainty
+
+
+# Run selection K times with one of the sampling methods (see samplers). With random streams, iterations k0 to k0 + K - 1
+# are run with the random starts (or, for designs drawing several numbers, the generators) of the streams of the groups,
+# otherwise the random numbers are drawn from the random state. Spatial methods require the coordinates of the muns (LONG
+# and LAT). The results only hold the per-run columns (number of times selected and whether selected with certainty)
+# with the same index as muns, which they reference instead of copying.
+def run_selection(muns: pd.DataFrame, groups: pd.DataFrame, group_index: GroupIndex, K: int = 1, random_state=np.random,
+                  streams: RandomStreams | None = None, k0: int = 0, method: str = 'pps_sys'):
+    if method not in samplers:
+        raise Exception(f"Unknown sampling method: {method}. Available methods: {', '.join(samplers)}.")
+
+    # initialise per-run columns
+    mos = muns['Mm'].values
+    selected = np.zeros(len(muns), dtype=np.int32)
+    certainty = np.zeros(len(muns), dtype=bool)
+
+    # positions of non-certainty muns and sample sizes of groups to sample from
+    sample_positions = []
+    sample_sizes = []
+    sample_group_ids = []
+
+    # loop over groups (with non-zero muns in them), reading the target and count of muns of every group from plain
+    # tuples so that the loop scales to thousands of strata
+    for group_id, this_ng, this_Cg in groups.loc[groups['ng'] != 0.0, ['ng', 'Cg']].itertuples():
+        count('groups processed')
+
+        # get positions of all eligible municipalities
+        this_positions = group_index.slice(group_id)
+
+        # get target and count for group
+        this_ng = int(this_ng)
+        this_Cg = int(this_Cg)
+
+        # only select if there are more muns in a group than we want to pick
+        # (eg skip Berlin or Hamburg, as they are the only muns in the respective states)
+        if this_ng == this_Cg:
+            certainty[this_positions] = True
+        elif this_ng > this_Cg:
+            raise Exception(
+                f"Cannot select more municipalities than exist in a group. \n\n"
+                f"{groups.loc[group_id]}"
+            )
+        else:
+            # remove muns with certainty
+            cond_muns_certainty, this_ng_noncertainty = extract_certainty(mos[this_positions], this_ng)
+            this_positions_noncertainty = this_positions[~cond_muns_certainty]
+
+            # for certainty units update results
+            certainty[this_positions[cond_muns_certainty]] = True
+
+            # check that no certainty muns remain
+            this_mos_noncertainty = mos[this_positions_noncertainty]
+            if (this_mos_noncertainty / this_mos_noncertainty.sum() * this_ng_noncertainty >= 1).any():
+                raise Exception(
+                    f"A group contains certainty muns.\n\n"
+                    f"{groups.loc[group_id]}"
+                )
+
+            # collect non-certainty muns for sampling
+            sample_positions.append(this_positions_noncertainty)
+            sample_sizes.append(this_ng_noncertainty)
+            sample_group_ids.append(group_id)
+
+    # for non-certainty muns run sampling K times for all groups at once (so that we can experimentally test the results)
+    if sample_positions:
+        sample_offsets = np.cumsum([0] + [len(this_positions) for this_positions in sample_positions])
+        sample_positions = np.concatenate(sample_positions)
+        hits = samplers[method](
+            mos=mos[sample_positions],
+            offsets=sample_offsets,
+            samp_sizes=sample_sizes,
+            draws=Draws(sample_group_ids, K, k0, streams, random_state),
+            coords=muns[['LONG', 'LAT']].values[sample_positions] if method in spatial_samplers else None,
+        )
+
+        # add number of times selected
+        selected[sample_positions] += (hits > 0).sum(axis=0, dtype=np.int32)
+
+    # certainty muns are selected every time
+    selected[certainty] = K
+    count('certainty units', certainty.sum())
+
+    return pd.DataFrame({'Selected': selected, 'Certainty': certainty}, index=muns.index)
@@ -0,0 +1,168 @@
+from functools import lru_cache
+
+import numpy as np
+from numba import njit
+
+from .profiling import count
+
+
+# number of nearest neighbours looked up in advance for every unit (further neighbours are only searched once all of
+# them are decided, and a unit with a small inclusion probability can take over hundreds of them before it is decided)
+num_neighbours = 256
+
+# inclusion probabilities within this tolerance of zero or one are decided
+eps = 1e-9
+
+
+# planar coordinates from longitude and latitude (equirectangular projection around the mean latitude, which is accurate
+# enough for finding neighbours within a group)
+def project_coords(long: np.ndarray, lat: np.ndarray):
+    if np.isnan(long).any() or np.isnan(lat).any():
+        raise Exception('Spatially balanced sampling requires coordinates for all municipalities.')
+
+    return np.column_stack([long * np.cos(np.radians(lat.mean())), lat])
+
+
+# Nearest neighbours of the units of a group, found once with a KD tree and shared by all iterations. Every unit has a
+# row of its nearest neighbours sorted by distance, so that the nearest undecided neighbour is usually the first
+# undecided unit in its row. Only once all of them are decided are the remaining undecided units searched.
+class Neighbours:
+    def __init__(self, coords: np.ndarray):
+        from scipy.spatial import cKDTree
+
+        self.coords = coords
+        n = len(coords)
+        k = min(num_neighbours + 1, n)
+
+        # nearest neighbours of every unit, dropping the unit itself (which is not necessarily the first if several units
+        # share their coordinates)
+        _, idx = cKDTree(coords).query(coords, k=k)
+        idx = idx.reshape(n, k)
+        order = np.argsort(idx == np.arange(n)[:, None], axis=1, kind='stable')
+        self.lists = np.take_along_axis(idx, order, axis=1)[:, :k-1].astype(np.int32)
+
+
+# neighbours of the units of a group from the bytes of their longitudes and latitudes, cached as they are the same in
+# every batch of iterations
+@lru_cache(maxsize=1024)
+def _group_neighbours(coords_bytes: bytes):
+    coords = np.frombuffer(coords_bytes).reshape(-1, 2)
+    return Neighbours(project_coords(coords[:, 0], coords[:, 1]))
+
+
+# nearest undecided unit other than unit i among the given units by brute force, or -1 if no other unit is undecided
+@njit(cache=True)
+def _nearest_undecided(i: int, units: np.ndarray, undecided: np.ndarray, coords: np.ndarray):
+    nearest, nearest_dist = -1, np.inf
+    for j in units:
+        if undecided[j] and j != i:
+            dist = (coords[j, 0] - coords[i, 0]) ** 2 + (coords[j, 1] - coords[i, 1]) ** 2
+            if dist < nearest_dist:
+                nearest, nearest_dist = j, dist
+
+    return nearest
+
+
+# Draw samples with the local pivotal method, one for every row of the orders of visiting the units and the uniform
+# numbers for the pivots: units are visited in random order, and each undecided unit competes with its nearest undecided
+# neighbour until one of them is decided (see eg Grafström, Lundström & Schelin 2012). Each pivot moves the inclusion
+# probabilities of the pair towards zero or one while keeping their sum and expected values, and decides at least one of
+# the two units, so that at most n pivots are needed. As neighbours compete with each other, they are rarely selected
+# together, which spreads the sample in space. The neighbours of a unit are walked in order of distance, searching the
+# remaining units (collected again once more than half of them are decided) only once the known ones are decided. The
+# pivots are compiled with numba, as every pivot depends on the ones before. Returns a boolean array of the selected
+# units for every row and the number of pivots.
+@njit(cache=True)
+def _lpm_draws(pi: np.ndarray, lists: np.ndarray, coords: np.ndarray, orders: np.ndarray, u: np.ndarray):
+    K, n = orders.shape
+    selected = np.zeros((K, n), dtype=np.bool_)
+    num_pivots = 0
+
+    for k in range(K):
+        p = pi.copy()
+        undecided = (p > eps) & (p < 1 - eps)
+        remaining = np.flatnonzero(undecided)
+        num_undecided = len(remaining)
+
+        step = 0
+        for i in orders[k]:
+            pos = 0
+            while undecided[i]:
+                # nearest undecided neighbour, searching all units once all known neighbours are decided
+                while pos < lists.shape[1] and not undecided[lists[i, pos]]:
+                    pos += 1
+                if pos < lists.shape[1]:
+                    j = lists[i, pos]
+                else:
+                    if 2 * num_undecided < len(remaining):
+                        remaining = remaining[undecided[remaining]]
+                    j = _nearest_undecided(i, remaining, undecided, coords)
+                    if j < 0:
+                        # last undecided unit (only left over from rounding errors)
+                        p[i] = 1.0 if p[i] > 0.5 else 0.0
+                        undecided[i] = False
+                        num_undecided -= 1
+                        break
+
+                # pivot: unit i takes the sum (or 1) with the probability that keeps its expected value
+                s = p[i] + p[j]
+                if s < 1:
+                    if u[k, step] * s < p[i]:
+                        p[i], p[j] = s, 0.0
+                    else:
+                        p[i], p[j] = 0.0, s
+                else:
+                    if u[k, step] * (2 - s) < 1 - p[j]:
+                        p[i], p[j] = 1.0, s - 1
+                    else:
+                        p[i], p[j] = s - 1, 1.0
+                step += 1
+
+                for unit in (i, j):
+                    if not eps < p[unit] < 1 - eps:
+                        p[unit] = 1.0 if p[unit] > 0.5 else 0.0
+                        undecided[unit] = False
+                        num_undecided -= 1
+
+        selected[k] = p > 0.5
+        num_pivots += step
+
+    return selected, num_pivots
+
+
+# Draw one sample with the local pivotal method for every random generator, each drawing the order of visiting the units
+# and one uniform number for every pivot. Returns a boolean array of the selected units for every generator.
+def lpm_draws(pi: np.ndarray, neighbours: Neighbours, rngs: list):
+    n = len(pi)
+    orders = np.empty((len(rngs), n), dtype=np.intp)
+    u = np.empty((len(rngs), n))
+    for k, rng in enumerate(rngs):
+        orders[k] = rng.permutation(n)
+        u[k] = rng.random(n)
+
+    selected, num_pivots = _lpm_draws(pi, neighbours.lists, neighbours.coords, orders, u)
+    count('pivots', num_pivots)
+
+    return selected
+
+
+# Spatially balanced sampling w/o replacement with the local pivotal method and inclusion probabilities proportional to
+# the measure of size, with the same interface as pps_sys_select. The neighbours of each group are found once and cached
+# for all iterations and batches, and rngs(g, k) gives the random generator (or random state) of the g-th group in
+# iteration k.
+# Returns the number of hits for every iteration and unit.
+def lpm_select(mos: np.ndarray, coords: np.ndarray, offsets: np.ndarray, samp_sizes: list[int], K: int, rngs):
+    U = len(mos)
+    hits = np.zeros((K, U), dtype=np.int32)
+
+    for g, samp_size in enumerate(samp_sizes):
+        start, end = offsets[g], offsets[g+1]
+        pi = samp_size * mos[start:end] / mos[start:end].sum()
+        neighbours = _group_neighbours(np.ascontiguousarray(coords[start:end], dtype=float).tobytes())
+
+        hits[:, start:end] = lpm_draws(pi, neighbours, [rngs(g, k) for k in range(K)])
+
+    count('lpm_select calls')
+    count('draws', K * sum(samp_sizes))
+
+    return hits
@@ -0,0 +1,259 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .counts import CountStore, store_key
+from .profiling import count
+from .select import run_selection
+from .stratify import GroupIndex
+from .streams import RandomStreams
+
+
+K_max_batch = 50  # max number of iterations to do in one batch
+
+
+# The inclusion probabilities follow directly from the design: certainty muns are always selected, and for all other
+# muns PPS-SYS gives pi_m = ng' * Mm / Mg', where ng' and Mg' are the target and the total measure of size of the
+# non-certainty muns in the group. This gives the probability of receiving a letter q_m = pi_m * Lm / Nm for every
+# municipality without any simulation.
+def calc_probs(results: pd.DataFrame, muns: pd.DataFrame, groups: pd.DataFrame, params: dict):
+    certainty = results['Certainty']
+
+    # certainty muns are selected every time
+    pi = pd.Series(1.0, index=results.index)
+
+    # non-certainty muns are selected proportional to their measure of size
+    Mm = muns.loc[~certainty, 'Mm']
+    Mg = muns.loc[~certainty].groupby('Group-ID')['Mm'].transform(sum)
+    ng = muns.loc[~certainty].join(groups[['ng']], on='Group-ID')['ng'] - certainty.groupby(muns['Group-ID']).transform(sum).loc[~certainty]
+    pi.loc[~certainty] = ng / Mg * Mm
+
+    # probability of receiving a letter and relative deviation from L*/N*
+    return muns \
+        .filter(['Mun-Name', 'Group-ID']) \
+        .assign(
+            Certainty=certainty,
+            Nm=muns['Nm'],
+            Mm=muns['Mm'],
+            Lm=results['Lm'],
+            pi=pi,
+            q=lambda df: df['pi'] * df['Lm'] / df['Nm'],
+            q_dev=lambda df: df['q'] / (params['L*'] / params['N*']) - 1,
+        )
+
+
+# number of iterations needed to estimate pi_m within a relative tolerance, as the number of times k_m a municipality
+# is selected in K iterations is binomially distributed with relative standard error sqrt((1 - pi_m) / (K pi_m))
+def calc_iterations(probs: pd.DataFrame, rel_tol: float = 0.1, z: float = 1.96):
+    return np.ceil(z**2 * (1 - probs['pi']) / (probs['pi'] * rel_tol**2)).astype(int)
+
+
+# run selection for one batch of iterations k0 to k0 + K - 1 from the random streams derived from the beacon ints
+def run_selection_batch(muns: pd.DataFrame, groups: pd.DataFrame, group_index: GroupIndex, ints: list[int], k0: int, K: int,
+                        method: str = 'pps_sys'):
+    return run_selection(muns, groups, group_index, K, streams=RandomStreams(ints), k0=k0, method=method)['Selected'].values
+
+
+# data shared with worker processes, set once per process by the pool initializer
+_worker_data = {}
+
+
+def _init_worker(muns: pd.DataFrame, groups: pd.DataFrame, group_index: GroupIndex, ints: list[int], method: str):
+    _worker_data.update(muns=muns, groups=groups, group_index=group_index, ints=ints, method=method)
+
+
+def _run_worker_batch(k0: int, K: int):
+    return run_selection_batch(k0=k0, K=K, **_worker_data)
+
+
+def _make_executor(workers: int, muns: pd.DataFrame, groups: pd.DataFrame, group_index: GroupIndex, ints: list[int],
+                   method: str = 'pps_sys'):
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(muns, groups, group_index, ints, method),
+    )
+
+
+# Run the selection for a strictly increasing list of numbers of iterations Ks. The iterations are run in batches,
+# serially or, with workers set, spread across a process pool. Every iteration draws from the counter-based random
+# streams of the groups derived from the beacon ints (iteration 0 being the actual selection), so the statistics are
+# identical for any batch size and number of workers. The counts after every K are stored as snapshots in a count store,
+# memory-mapped from the cache directory if a cache path is given, and returned as a dataframe with one column per K
+# backed by the store.
+def calc_stats(muns: pd.DataFrame, groups: pd.DataFrame, group_index: GroupIndex, ints: list[int], Ks: list[int],
+               workers: int | None = None, cache_path: Path | None = None, method: str = 'pps_sys'):
+    # check input parameters
+    if any(Ks[i] <= Ks[i-1] for i in range(1, len(Ks))):
+        raise Exception(f"The list of iterations has to be strictly increasing.")
+
+    # split iterations into batches of iterations k0 to k0 + K_batch - 1
+    batches = []
+    K_prev = 0
+    for K in Ks:
+        # in this iteration run K-K_prev times
+        K_this = K - K_prev
+        while K_this > 0:
+            K_batch = min(K_this, K_max_batch)
+            batches.append((K, K - K_this, K_batch))
+            K_this -= K_batch
+
+        # add K to total number of times chosen
+        K_prev = K
+
+    count('batches', len(batches))
+
+    # store of snapshots after every K
+    store = CountStore.create(
+        muns.index,
+        capacity=len(Ks),
+        path=cache_path / f"counts_stats_{store_key(ints, muns.index, Ks, method)}" if cache_path is not None else None,
+    )
+
+    # run batches either serially or in a process pool
+    if workers is None:
+        selected = (run_selection_batch(muns, groups, group_index, ints, k0, K_batch, method) for K, k0, K_batch in batches)
+    else:
+        executor = _make_executor(workers, muns, groups, group_index, ints, method)
+        selected = executor.map(_run_worker_batch, [k0 for K, k0, K_batch in batches], [K_batch for K, k0, K_batch in batches])
+
+    # loop over iterations
+    counts = np.zeros(len(muns), dtype=np.int32)
+    K_prev = 0
+    for i, ((K, k0, K_batch), this_selected) in enumerate(zip(batches, selected)):
+        if K != K_prev:
+            print(K)
+            K_prev = K
+
+        # add number of times chosen to histogram
+        print(f"-- {K_batch}")
+        counts += this_selected
+
+        # take snapshot after last batch of this iteration
+        if i == len(batches) - 1 or batches[i+1][0] != K:
+            store.append(K, counts)
+
+    if workers is not None:
+        executor.shutdown()
+
+    return store.to_frame()
+
+
+# Stream the simulation: the running selection counts are yielded after every round of batches, and the run stops once
+# the maximum relative deviation of q_m from L*/N* falls below a tolerance. Every K_snapshot iterations (by default
+# after every round), the counts are added as a snapshot to a count store memory-mapped from the cache directory, so an
+# interrupted run resumes from the last snapshot, continuing the random streams at the number of iterations done. The
+# store is keyed on the beacon ints, the municipalities, and the design (the groups, the measure of size, the targets,
+# and the sampling method), so a run with a different seed, frame, alpha, L*, n*, or method never resumes from it.
+def iter_stats(muns: pd.DataFrame, groups: pd.DataFrame, group_index: GroupIndex, results: pd.DataFrame, params: dict,
+               ints: list[int], cache_path: Path, tol: float = 0.1, K_max: int = 100000, K_batch: int = K_max_batch,
+               workers: int = 1, checkpoint: bool = True, K_snapshot: int | None = None, method: str = 'pps_sys'):
+    # target probability of receiving a letter and ratio of letters to population
+    q_target = params['L*'] / params['N*']
+    Lm_Nm = (results['Lm'] / muns['Nm']).values
+
+    # iterations between snapshots
+    K_round = K_batch * workers
+    K_snapshot = K_snapshot or K_round
+
+    # store of snapshots for this seed, frame, and design; resume from last snapshot if present
+    capacity = min(-(-K_max // K_snapshot), 64)
+    if checkpoint:
+        key = store_key(
+            ints,
+            muns.index,
+            muns['Group-ID'].to_numpy(np.int64),
+            muns['Mm'].to_numpy(np.float64),
+            groups['ng'].to_numpy(np.int64),
+            method,
+        )
+        store = CountStore.open_or_create(muns.index, capacity, cache_path / f"counts_iter_{key}")
+    else:
+        store = CountStore.create(muns.index, capacity)
+
+    if len(store):
+        K, counts, snapshot = store.latest()
+    else:
+        counts = np.zeros(len(muns), dtype=np.int32)
+        K = 0
+
+    if workers > 1:
+        executor = _make_executor(workers, muns, groups, group_index, ints, method)
+        map_batches = lambda k0s, K_batches: executor.map(_run_worker_batch, k0s, K_batches)
+    else:
+        executor = None
+        map_batches = lambda k0s, K_batches: map(
+            lambda k0, K: run_selection_batch(muns, groups, group_index, ints, k0, K, method),
+            k0s,
+            K_batches,
+        )
+
+    try:
+        while K < K_max:
+            # run the next round of batches of iterations k0 to k0 + K_batch - 1
+            batches = [
+                (K + i * K_batch, min(K_batch, K_max - K - i * K_batch))
+                for i in range(workers)
+                if K + i * K_batch < K_max
+            ]
+            k0s, K_batches = zip(*batches)
+            selected = map_batches(k0s, K_batches)
+
+            # add number of times chosen to histogram
+            K_prev = K
+            for this_selected in selected:
+                counts += this_selected
+            K += sum(K_batches)
+
+            # maximum deviation of probability of receiving a letter
+            q_dev = np.abs(counts / K * Lm_Nm / q_target - 1).max()
+
+            # take snapshot every K_snapshot iterations and when stopping
+            if K // K_snapshot > K_prev // K_snapshot or K >= K_max or q_dev < tol:
+                store.append(K, counts)
+
+            yield pd.Series(counts, index=muns.index, name=K), q_dev
+
+            if q_dev < tol:
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+# Summary statistics of the deviation of q_m = k_m / K * Lm / Nm from L*/N* for every K, computed column by column from
+# the counts (eg backed by a count store) without melting them into a long frame. Returns the maximum, mean, and root
+# mean square absolute deviation over all muns and the mean and maximum absolute deviation in every group.
+def summarise_probs(stats: pd.DataFrame, results: pd.DataFrame, muns: pd.DataFrame, params: dict):
+    q_target = params['L*'] / params['N*']
+    Lm_Nm = (results['Lm'] / muns['Nm']).values
+    group_codes, group_ids = pd.factorize(muns['Group-ID'], sort=True)
+    group_counts = np.bincount(group_codes, minlength=len(group_ids))
+
+    summary = []
+    group_summary = []
+    for K in stats.columns:
+        q_dev = np.abs(stats[K].values / K * Lm_Nm / q_target - 1)
+
+        summary.append({
+            'K': K,
+            'q_dev_max': q_dev.max(),
+            'q_dev_mean': q_dev.mean(),
+            'q_dev_rms': np.sqrt((q_dev**2).mean()),
+        })
+
+        q_dev_group_max = np.zeros(len(group_ids))
+        np.maximum.at(q_dev_group_max, group_codes, q_dev)
+        group_summary.append(pd.DataFrame({
+            'K': K,
+            'Group-ID': group_ids,
+            'q_dev_mean': np.bincount(group_codes, weights=q_dev, minlength=len(group_ids)) / group_counts,
+            'q_dev_max': q_dev_group_max,
+        }))
+
+    return (
+        pd.DataFrame.from_records(summary).set_index('K'),
+        pd.concat(group_summary).set_index(['K', 'Group-ID']),
+    )
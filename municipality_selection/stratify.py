@@ -0,0 +1,136 @@
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+
+# define size classes from the upper thresholds of the small and medium classes
+def define_classes(thresholds: tuple[float, float] = (20000, 100000)):
+    # define classes
+    classes = pd.DataFrame.from_records([
+        {'Class-Name': 'Small', 'Threshold': thresholds[0],},
+        {'Class-Name': 'Medium', 'Threshold': thresholds[1],},
+        {'Class-Name': 'Large', 'Threshold': np.inf,},
+    ])
+
+    # insure that the threshold is monotonic increasing
+    assert classes['Threshold'].is_monotonic_increasing
+
+    # update index
+    classes.index += 1
+    classes.rename_axis('Class-ID', inplace=True)
+
+    # add description
+    classes['Class-Desc'] = classes \
+        .assign(Lower=lambda df: df['Threshold'].shift()) \
+        .replace(np.inf, np.nan) \
+        .agg(
+            lambda row: f"{row['Class-Name']} ("
+                      + (f"≥{row['Lower']}" if not pd.isnull(row['Lower']) else '')
+                      + ('; ' if row.notnull().all() else '')
+                      + (f"<{row['Threshold']}" if not pd.isnull(row['Threshold']) else '')
+                      + ')',
+            axis=1,
+        )
+
+    return classes
+
+
+# Keys that muns are stratified by by default. Muns can be stratified by any combination of their columns, eg the
+# state, the size class, the degree of urbanisation from the input file, the Kreis (the first five digits of the AGS,
+# added as Kreis-ID if stratified by it), or user-defined bins of any column (see assign_groups).
+default_strata = ['State-ID', 'Class-ID']
+
+
+# Assign size classes and groups to muns, with the IDs in muns downcast to the smallest integer dtype that fits (int8
+# for the states, classes, and groups in Germany). User-defined bins are given by the name of the new column, the column
+# to bin, and the upper thresholds of the bins (values above the last threshold form a bin of their own), and can then
+# be used as keys of the strata. Groups are only formed for the combinations of keys present in muns, with dense IDs
+# numbered in the lexicographic order of the keys.
+def assign_groups(muns: pd.DataFrame, classes: pd.DataFrame, strata: list[str] = default_strata,
+                  bins: dict[str, tuple[str, list[float]]] | None = None):
+    # add size classes (first class with Nm <= threshold)
+    muns = muns.assign(**{
+        'State-ID': pd.to_numeric(muns['State-ID'], downcast='integer'),
+        'Class-ID': pd.to_numeric(classes.index.values[np.searchsorted(classes['Threshold'].values, muns['Nm'].values, side='left')], downcast='integer'),
+    })
+
+    # add Kreis and user-defined bins (first bin with value <= threshold)
+    if 'Kreis-ID' in strata and 'Kreis-ID' not in muns:
+        muns['Kreis-ID'] = pd.to_numeric(muns.index.values // 10**7, downcast='integer')
+    for name, (column, thresholds) in (bins or {}).items():
+        muns[name] = pd.to_numeric(np.searchsorted(thresholds, muns[column].values, side='left') + 1, downcast='integer')
+
+    unknown = [key for key in strata if key not in muns.columns]
+    if unknown:
+        raise Exception(f"Unknown stratification keys: {', '.join(unknown)}. Available keys: {', '.join(muns.columns)}.")
+
+    # factorize every key into codes of its sorted values and combine them (in mixed radix) into one code per mun, which
+    # is factorized again into dense group codes, so that the cross product of the keys is never materialised
+    codes, uniques = zip(*(pd.factorize(muns[key], sort=True, use_na_sentinel=False) for key in strata))
+    dims = [len(this_uniques) for this_uniques in uniques]
+    group_codes, group_combined = pd.factorize(np.ravel_multi_index(codes, dims), sort=True)
+
+    # finally, we compute total pop, count of muns, and share of pop in groups in one grouped pass
+    groups = pd.DataFrame({'Nm': muns['Nm'].values.astype(np.int64)}) \
+        .groupby(group_codes + 1) \
+        .agg(Ng=('Nm', 'sum'), Cg=('Nm', 'count')) \
+        .rename_axis('Group-ID') \
+        .assign(Sg=lambda x: x['Ng'] / x['Ng'].sum())
+
+    # add keys of groups from their combined codes
+    group_codes_keys = np.unravel_index(group_combined, dims)
+    groups = pd.DataFrame({
+            key: pd.Series(np.asarray(this_uniques).take(this_codes), dtype=muns[key].dtype).values
+            for key, this_uniques, this_codes in zip(strata, uniques, group_codes_keys)
+        }, index=groups.index) \
+        .join(groups.filter(['Ng', 'Sg', 'Cg']))
+
+    # add group ID to muns
+    muns['Group-ID'] = pd.to_numeric(group_codes + 1, downcast='integer')
+
+    # sort muns by population
+    muns = muns.sort_values(by=['Nm'], ascending=False)
+
+    return muns, groups
+
+
+# names of the states and size classes of muns, looked up once and shared by all output tables instead of joining states
+# and classes for every table
+def mun_labels(muns: pd.DataFrame, states: pd.DataFrame, classes: pd.DataFrame):
+    return muns \
+        .filter(['State-ID', 'Class-ID']) \
+        .join(states, on='State-ID') \
+        .join(classes, on='Class-ID') \
+        .drop(columns=['State-ID', 'Class-ID']) \
+        .astype({'State-Name': 'category', 'Class-Name': 'category', 'Class-Desc': 'category'})
+
+
+# index of muns sorted by group, so that the muns of each group form a contiguous slice given by an offset array (as in
+# a compressed sparse row matrix)
+@dataclass
+class GroupIndex:
+    group_ids: np.ndarray  # sorted group IDs
+    offsets: np.ndarray  # muns of the i-th group are at positions[offsets[i]:offsets[i+1]]
+    positions: np.ndarray  # positions in muns sorted by group
+
+    def _loc(self, group_id: int):
+        i = np.searchsorted(self.group_ids, group_id)
+        return self.offsets[i], self.offsets[i+1]
+
+    # positions in muns of muns in group
+    def slice(self, group_id: int):
+        start, end = self._loc(group_id)
+        return self.positions[start:end]
+
+
+def build_group_index(muns: pd.DataFrame, groups: pd.DataFrame):
+    # sort muns by group, keeping their order within each group
+    group_codes = muns['Group-ID'].values
+    positions = np.argsort(group_codes, kind='stable')
+
+    # start of each group in the sorted muns
+    group_ids = np.sort(groups.index.values)
+    offsets = np.append(np.searchsorted(group_codes[positions], group_ids, side='left'), len(positions))
+
+    return GroupIndex(group_ids=group_ids, offsets=offsets, positions=positions)
@@ -0,0 +1,48 @@
+from dataclasses import dataclass, field
+
+import numpy as np
+
+
+# purposes of random streams, so that the selection, the replacements, and the addresses drawn in the second stage never
+# share random numbers (the streams of addresses are keyed by Mun-ID instead of Group-ID)
+SELECTION = 0
+REPLACEMENTS = 1
+ADDRESSES = 2
+
+
+# Counter-based random streams derived from the beacon ints. Every group has its own Philox stream for every purpose,
+# keyed by the beacon ints, the purpose, and the Group-ID, and the random start of iteration k is the k-th double drawn
+# from it (iteration 0 being the actual selection). As Philox draws four numbers per counter, any single draw is
+# regenerated in constant time by setting the counter to k // 4, independent of the order in which groups and
+# iterations are run, the batches they are run in, and the number of worker processes. Designs drawing several numbers
+# per iteration use the substream of the iteration instead (see generator).
+@dataclass
+class RandomStreams:
+    ints: list[int]
+    purpose: int = SELECTION
+    _keys: dict = field(default_factory=dict, repr=False, compare=False)
+
+    # 128-bit Philox key of the stream of a group
+    def key(self, group_id: int):
+        if group_id not in self._keys:
+            self._keys[group_id] = np.random.SeedSequence(self.ints, spawn_key=(self.purpose, int(group_id))).generate_state(2, np.uint64)
+        return self._keys[group_id]
+
+    # random starts of iterations k0 to k0 + K - 1 for every group, as array of shape (groups, K)
+    def random_starts(self, group_ids: list[int], k0: int = 0, K: int = 1):
+        random_starts = np.empty((len(group_ids), K))
+        for g, group_id in enumerate(group_ids):
+            bit_generator = np.random.Philox(key=self.key(group_id))
+            bit_generator.advance(k0 // 4)
+            random_starts[g] = np.random.Generator(bit_generator).random(k0 % 4 + K)[k0 % 4:]
+
+        return random_starts
+
+    # random start of a single iteration and group, eg for auditing one draw
+    def random_start(self, group_id: int, k: int):
+        return self.random_starts([group_id], k, 1)[0, 0]
+
+    # generator of iteration k of a group for designs drawing several numbers per iteration: the stream of the group from
+    # counter (0, k + 1, 0, 0), which never overlaps with the random starts drawn from counters (c, 0, 0, 0)
+    def generator(self, group_id: int, k: int):
+        return np.random.Generator(np.random.Philox(counter=[0, k + 1, 0, 0], key=self.key(group_id)))
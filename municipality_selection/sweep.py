@@ -0,0 +1,166 @@
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .apportionment import apportion_sainte_lague
+from .select import extract_certainty, run_selection
+from .stratify import GroupIndex, assign_groups, build_group_index, default_strata, define_classes
+from .streams import RandomStreams
+from .targets import assign_targets, init_params, measure_of_size
+
+
+# default values of the swept parameters
+sweep_defaults = {
+    'n_init': 80,  # initial target for number of municipalities to select
+    'L': 20000,  # total number of letters to send out
+    'alpha': 0.1,  # max share of population invited in small municipalities
+    'thresholds': (20000, 100000),  # upper thresholds of the small and medium size classes
+}
+
+
+# all combinations of the given values of the parameters, with the other parameters at their defaults
+def sweep_grid(**values):
+    unknown = [name for name in values if name not in sweep_defaults]
+    if unknown:
+        raise Exception(f"Unknown sweep parameters: {', '.join(unknown)}. Available parameters: {', '.join(sweep_defaults)}.")
+
+    names = list(values)
+    return [
+        {**sweep_defaults, **dict(zip(names, combination))}
+        for combination in itertools.product(*values.values())
+    ]
+
+
+# muns, groups, and group index for the size class thresholds of a configuration, regrouping only if they differ from
+# the ones the frame was grouped with and reusing earlier regroupings
+def _stratification(data: dict, thresholds: tuple):
+    thresholds = tuple(thresholds)
+    if thresholds not in data['stratifications']:
+        muns, groups = assign_groups(data['muns'].drop(columns=['Class-ID', 'Group-ID']), define_classes(thresholds), data['strata'])
+        data['stratifications'][thresholds] = (muns, groups, build_group_index(muns, groups))
+
+    return data['stratifications'][thresholds]
+
+
+# Evaluate one configuration analytically and, for K > 0, by simulating the selection K times from the random streams of
+# the groups derived from the beacon ints. All configurations draw the same random starts for the same groups (common
+# random numbers), so that differences between configurations are not masked by sampling noise. Certainty muns have
+# pi_m = 1 and all other muns pi_m = ng' * Mm / Mg' (see calc_probs), and the number of letters is Lm = L*/N* * Nm / pi_m
+# (see calc_letters), so that q_m = pi_m * Lm / Nm equals L*/N* exactly. The analytic spread of q_m therefore comes from
+# rounding Lm to whole letters only, which is measured on the actual selection (iteration 0 of the random streams) with
+# the letters apportioned among the selected muns by Sainte-Laguë as in calc_letters.
+def evaluate_config(data: dict, config: dict, ints: list[int], K: int = 0):
+    muns, groups, group_index = _stratification(data, config['thresholds'])
+
+    # targets and measure of size
+    groups = groups.copy()
+    params = init_params(groups, n_init=config['n_init'], L=config['L'])
+    groups, params = assign_targets(groups, params)
+    Nm = muns['Nm'].values
+    mos = measure_of_size(Nm, params, alpha=config['alpha'])
+
+    # inclusion probabilities and certainty muns
+    pi = np.ones(len(muns))
+    certainty = np.zeros(len(muns), dtype=bool)
+    for group_id, ng, Cg in groups.loc[groups['ng'] != 0, ['ng', 'Cg']].itertuples():
+        this_positions = group_index.slice(group_id)
+        if ng == Cg:
+            certainty[this_positions] = True
+            continue
+        cond_muns_certainty, this_ng_noncertainty = extract_certainty(mos[this_positions], int(ng))
+        certainty[this_positions[cond_muns_certainty]] = True
+        this_positions_noncertainty = this_positions[~cond_muns_certainty]
+        pi[this_positions_noncertainty] = this_ng_noncertainty * mos[this_positions_noncertainty] / mos[this_positions_noncertainty].sum()
+
+    # number of letters
+    q_target = params['L*'] / params['N*']
+    Lm = q_target * Nm / pi
+
+    # deviation of q_m from L*/N* with the letters of the selected muns rounded as in calc_letters
+    selected = run_selection(
+        pd.DataFrame({'Mm': mos}, index=muns.index),
+        groups,
+        group_index,
+        streams=RandomStreams(ints),
+    )['Selected'].values > 0
+    Lm_rounded = apportion_sainte_lague(Lm[selected], round(Lm[selected].sum()))
+    q_dev_rounded = np.abs(pi[selected] * Lm_rounded / Nm[selected] / q_target - 1)
+
+    result = {
+        'n*': params['n*'],
+        'certainty_units': int(certainty.sum()),
+        'Lm_min': Lm.min(),
+        'Lm_p05': np.quantile(Lm, 0.05),
+        'Lm_median': np.median(Lm),
+        'Lm_p95': np.quantile(Lm, 0.95),
+        'Lm_max': Lm.max(),
+        'q_dev_rounded_max': q_dev_rounded.max(),
+        'q_dev_rounded_mean': q_dev_rounded.mean(),
+    }
+
+    # simulated deviation of q_m from L*/N*
+    if K > 0:
+        selected = run_selection(
+            pd.DataFrame({'Mm': mos}, index=muns.index),
+            groups,
+            group_index,
+            K,
+            streams=RandomStreams(ints),
+        )['Selected'].values
+        q_dev_sim = np.abs(selected / K * Lm / Nm / q_target - 1)
+        result.update({
+            'q_dev_sim_max': q_dev_sim.max(),
+            'q_dev_sim_mean': q_dev_sim.mean(),
+        })
+
+    return result
+
+
+# data shared by the evaluations: the frame and the stratifications for all thresholds evaluated so far
+def _sweep_data(muns: pd.DataFrame, groups: pd.DataFrame, group_index: GroupIndex, thresholds: tuple, strata: list[str]):
+    return {'muns': muns, 'strata': strata, 'stratifications': {tuple(thresholds): (muns, groups, group_index)}}
+
+
+# data shared with worker processes, set once per process by the pool initializer
+_worker_data = {}
+
+
+def _init_worker(muns: pd.DataFrame, groups: pd.DataFrame, group_index: GroupIndex, thresholds: tuple, strata: list[str]):
+    _worker_data.update(_sweep_data(muns, groups, group_index, thresholds, strata))
+
+
+def _evaluate_worker(config: dict, ints: list[int], K: int):
+    return evaluate_config(_worker_data, config, ints, K)
+
+
+# Evaluate a list of configurations (eg from sweep_grid), reusing the ingested frame and its group index for all
+# configurations with the thresholds the frame was grouped with (by the given strata), and spreading the configurations
+# across a process pool if workers are set. Returns one row per configuration with n*, the distribution of Lm, the
+# number of certainty units, and the spread of q_m.
+def run_sweep(muns: pd.DataFrame, groups: pd.DataFrame, group_index: GroupIndex, classes: pd.DataFrame,
+              configs: list[dict], ints: list[int], K: int = 0, workers: int | None = None,
+              strata: list[str] = default_strata):
+    # only the columns needed for the evaluation are shared
+    muns = muns.filter(['State-ID', 'Nm', 'Class-ID', 'Group-ID'] + [key for key in strata if key not in ['State-ID', 'Class-ID']])
+    groups = groups.filter(strata + ['Ng', 'Sg', 'Cg'])
+    thresholds = tuple(classes['Threshold'].iloc[:-1])
+
+    if workers is None:
+        data = _sweep_data(muns, groups, group_index, thresholds, strata)
+        results = [evaluate_config(data, config, ints, K) for config in configs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(muns, groups, group_index, thresholds, strata)) as executor:
+            results = list(executor.map(
+                _evaluate_worker,
+                configs,
+                itertools.repeat(ints),
+                itertools.repeat(K),
+                chunksize=max(1, len(configs) // (4 * workers)),
+            ))
+
+    return pd.concat([
+        pd.DataFrame.from_records(configs),
+        pd.DataFrame.from_records(results),
+    ], axis=1)
@@ -0,0 +1,78 @@
+import pandas as pd
+
+from .apportionment import apportion_sainte_lague
+from .stratify import default_strata
+
+
+# initialise key parameters
+def init_params(groups: pd.DataFrame, n_init: int = 80, L: int = 20000):
+    return {
+        'n*_init': n_init,  # initial target for number of municipalities to select
+        'L*': L,  # total number of letters to send out
+        'N*': groups['Ng'].sum(),  # total population in Germany
+    }
+
+
+# assign targets to groups via StLague, with at least one target for every group with non-zero population and no more
+# targets than muns in any group (so n*_init has to be at least the number of groups with non-zero population)
+def assign_targets(groups: pd.DataFrame, params: dict):
+    num_populated = int((groups['Ng'] > 0).sum())
+    if num_populated > params['n*_init']:
+        raise Exception(f"Cannot assign at least one target to each of the {num_populated} strata with non-zero population "
+                        f"with n*_init = {params['n*_init']}. Increase n*_init (--n-init) to at least {num_populated} or "
+                        f"stratify by fewer keys.")
+
+    # assign targets via StLague without and with bounds
+    groups['ng_init'] = apportion_sainte_lague(groups['Ng'].values, params['n*_init'])
+    groups['ng'] = apportion_sainte_lague(
+        groups['Ng'].values,
+        params['n*_init'],
+        lower=(groups['Ng'] > 0).astype(int),
+        upper=groups['Cg'],
+    )
+
+    # set total target number as new parameter Ttot
+    params['n*'] = groups['ng'].sum()
+
+    return groups, params
+
+
+# measure of size with a small correction such that we won't invite more than a share alpha of the population if small
+# municipalities get selected
+def measure_of_size(Nm, params: dict, alpha: float = 0.1):
+    Nmin = params['L*'] / params['n*'] / alpha
+    return Nm + Nmin / (1 + (Nm / Nmin))
+
+
+def calc_measure(muns: pd.DataFrame, params: dict, alpha: float = 0.1):
+    muns['Mm'] = measure_of_size(muns['Nm'], params, alpha)
+
+    return muns
+
+
+# groups in user-friendly format, indexed by the keys of the strata (with the names of states and size classes) and with
+# one column per size class if stratified by size class and further keys (strata without muns are left blank)
+def targets_table(groups: pd.DataFrame, states: pd.DataFrame, classes: pd.DataFrame, strata: list[str] = default_strata):
+    table = groups.reset_index()
+    index = []
+    for key in strata:
+        if key == 'State-ID':
+            table = table.join(states, on='State-ID')
+            index += ['State-ID', 'State-Name']
+        elif key == 'Class-ID':
+            table = table.join(classes, on='Class-ID')
+            index += ['Class-ID', 'Class-Desc']
+        else:
+            index.append(key)
+
+    table = table \
+        .set_index(index) \
+        .assign(
+            Sg=lambda df: df['Sg'] * 100,
+        ) \
+        .round(2)
+
+    if 'Class-ID' in strata and len(strata) > 1:
+        table = table.unstack(['Class-ID', 'Class-Desc'])
+
+    return table
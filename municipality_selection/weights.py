@@ -0,0 +1,221 @@
+import math
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+from .profiling import count
+from .samplers import Draws, cps_poisson_probs, samplers, spatial_samplers
+from .stratify import GroupIndex
+from .streams import RandomStreams
+
+
+# approximations of the joint inclusion probabilities of large groups: Hájek (1964) for high-entropy designs, and
+# Brewer (2002, eq. 9.15)
+joint_approximations = ['hajek', 'brewer']
+
+# max number of samples of a group enumerated for the exact joint inclusion probabilities
+max_samples = 10**6
+
+# max number of iterations of the selection simulated in one batch for the joint inclusion probabilities of the spatial
+# sampling methods (which bounds the memory of the hits of a group)
+K_max_batch = 1000
+
+
+# Exact joint inclusion probabilities of PPS-SYS sampling. In units of the sampling interval, the picks are u, u + 1,
+# ..., u + n - 1 for a uniform random start u, and unit k covers (c_k, c_k + pi_k] of the cumulative measure of size, so
+# it is hit iff u falls into the arc of length pi_k starting at c_k mod 1 on the unit circle. The joint inclusion
+# probability of two units is the length of the intersection of their arcs (which is zero for many pairs).
+def pps_sys_joint_probs(mos: np.ndarray, n: int, units: np.ndarray):
+    cumsize = np.append(0, np.cumsum(mos)) / mos.sum() * n
+    start = cumsize[units] % 1
+    pi = np.diff(cumsize)[units]
+
+    # intersection of the arcs of all pairs, with the second arc shifted by one turn in both directions
+    start_i, start_j = start[:, None], start[None, :] + np.array([-1, 0, 1])[:, None, None]
+    overlap = np.minimum(start_i + pi[:, None], start_j + pi[None, :]) - np.maximum(start_i, start_j)
+
+    return np.clip(overlap, 0, None).sum(axis=0)
+
+
+# Exact joint inclusion probabilities by enumerating all samples of size n of the units with non-zero inclusion
+# probability, given the log of the (unnormalised) probability of every sample as function of the array of samples of
+# shape (samples, n). Returns the joint inclusion probabilities of the given units.
+def enumerated_joint_probs(pi: np.ndarray, n: int, units: np.ndarray, log_sample_probs):
+    positive = np.flatnonzero(pi > 0)
+    samples = np.array(list(combinations(range(len(positive)), n)))
+    log_probs = log_sample_probs(positive, samples)
+    probs = np.exp(log_probs - log_probs.max())
+    probs /= probs.sum()
+
+    # indicators of the given units in every sample (never for units with zero inclusion probability)
+    columns = np.full(len(pi), -1)
+    columns[positive] = np.arange(len(positive))
+    columns = columns[units]
+    included = (samples[:, :, None] == columns[None, None, :]).any(axis=1)
+
+    return included.T.astype(float) @ (included * probs[:, None])
+
+
+# Log-probabilities of the samples of conditional Poisson sampling, proportional to the product of the odds of the
+# working probabilities of its units
+def _cps_log_sample_probs(pi: np.ndarray, n: int):
+    def log_sample_probs(positive: np.ndarray, samples: np.ndarray):
+        p = cps_poisson_probs(pi[positive], n)
+        return np.log(p / (1 - p))[samples].sum(axis=1)
+
+    return log_sample_probs
+
+
+# Log-probabilities of the samples of Sampford sampling, proportional to sum(1 - pi_k) * prod(pi_k / (1 - pi_k)) over
+# its units
+def _sampford_log_sample_probs(pi: np.ndarray, n: int):
+    def log_sample_probs(positive: np.ndarray, samples: np.ndarray):
+        pi_positive = pi[positive]
+        return np.log((1 - pi_positive)[samples].sum(axis=1)) + np.log(pi_positive / (1 - pi_positive))[samples].sum(axis=1)
+
+    return log_sample_probs
+
+
+# Exact joint inclusion probabilities of the given units of a group for the sampling methods that have them, or None
+# if there is none for the method or the group has too many samples to enumerate
+def exact_joint_probs(mos: np.ndarray, n: int, units: np.ndarray, method: str):
+    pi = n * mos / mos.sum()
+    num_samples = math.comb(int((pi > 0).sum()), n)
+
+    if method == 'pps_sys':
+        return pps_sys_joint_probs(mos, n, units)
+    elif method == 'conditional_poisson' and num_samples <= max_samples:
+        return enumerated_joint_probs(pi, n, units, _cps_log_sample_probs(pi, n))
+    elif method == 'sampford' and num_samples <= max_samples:
+        return enumerated_joint_probs(pi, n, units, _sampford_log_sample_probs(pi, n))
+
+    return None
+
+
+# Approximate joint inclusion probabilities of the given units of a group from the inclusion probabilities of all its
+# units, in closed form. Hájek's approximation pi_i pi_j (1 - (1 - pi_i)(1 - pi_j) / d) with d = sum(pi_k (1 - pi_k))
+# holds for high-entropy designs, and Brewer's approximation pi_i pi_j (c_i + c_j) / 2 with c_k = (n - 1) / (n - pi_k)
+# only needs the sample size.
+def approx_joint_probs(pi: np.ndarray, n: int, units: np.ndarray, approximation: str = 'hajek'):
+    pi_i, pi_j = pi[units][:, None], pi[units][None, :]
+
+    if approximation == 'hajek':
+        d = (pi * (1 - pi)).sum()
+        return pi_i * pi_j * (1 - (1 - pi_i) * (1 - pi_j) / d)
+    elif approximation == 'brewer':
+        c = (n - 1) / (n - pi[units])
+        return pi_i * pi_j * (c[:, None] + c[None, :]) / 2
+
+    raise Exception(f"Unknown approximation: {approximation}. Available approximations: {', '.join(joint_approximations)}.")
+
+
+# Joint inclusion probabilities of the given units of a group estimated by simulation, as the share of iterations 1 to K
+# of the selection from the random streams of the group (the same iterations as in the stats stage) in which both are
+# selected. This is used for the spatial sampling methods, which select neighbours together less often than the
+# high-entropy designs that the closed-form approximations hold for. The standard error of every estimate is
+# sqrt(pi_ij (1 - pi_ij) / K).
+def simulated_joint_probs(mos: np.ndarray, n: int, units: np.ndarray, method: str, group_id: int, streams: RandomStreams,
+                          K: int, coords: np.ndarray | None = None):
+    joint = np.zeros((len(units), len(units)))
+    for k0 in range(1, K + 1, K_max_batch):
+        draws = Draws([group_id], min(K_max_batch, K + 1 - k0), k0, streams)
+        hits = (samplers[method](mos, np.array([0, len(mos)]), [n], draws, coords)[:, units] > 0).astype(float)
+        joint += hits.T @ hits
+
+    return joint / K
+
+
+# Design weights and joint inclusion probabilities of the selected muns for variance estimation (eg with the
+# Horvitz-Thompson or Sen-Yates-Grundy estimator). The first-order inclusion probabilities pi_m are one for certainty
+# muns and proportional to the measure of size among the other muns of a group, and the design weights are 1 / pi_m.
+# Joint inclusion probabilities are given for all pairs of selected muns in the same group (muns in different groups are
+# selected independently, so theirs is the product of their inclusion probabilities). Pairs with a certainty mun also
+# have the product, while pairs of non-certainty muns have the exact joint inclusion probabilities of the sampling
+# method in groups with at most exact_max_units non-certainty muns (if the method has them), and a closed-form
+# approximation otherwise, so that large groups only cost as much as their number of muns. The closed-form
+# approximations do not hold for the spatial sampling methods, whose joint inclusion probabilities are instead estimated
+# by simulating K iterations of the selection from the random streams. The Source column gives how every joint inclusion
+# probability was found (certainty, exact, hajek, brewer, or simulated).
+def calc_weights(results: pd.DataFrame, muns: pd.DataFrame, groups: pd.DataFrame, group_index: GroupIndex,
+                 method: str = 'pps_sys', approximation: str = 'hajek', exact_max_units: int = 20,
+                 streams: RandomStreams | None = None, K: int = 10000):
+    if approximation not in joint_approximations:
+        raise Exception(f"Unknown approximation: {approximation}. Available approximations: {', '.join(joint_approximations)}.")
+    if method in spatial_samplers and streams is None:
+        raise Exception(f"The joint inclusion probabilities of {method} sampling are simulated and require random streams.")
+
+    mos = muns['Mm'].values
+    selected = results['Selected'].values > 0
+    certainty = results['Certainty'].values
+    pi = np.where(certainty, 1.0, np.nan)
+
+    pairs = []
+
+    # loop over groups with selected muns
+    for group_id, this_ng in groups.loc[groups['ng'] != 0.0, ['ng']].itertuples():
+        count('groups processed')
+
+        # positions of non-certainty and selected muns in group
+        this_positions = group_index.slice(group_id)
+        this_positions_noncertainty = this_positions[~certainty[this_positions]]
+        this_positions_selected = this_positions[selected[this_positions]]
+        this_ng_noncertainty = int(this_ng) - int(certainty[this_positions].sum())
+
+        # inclusion probabilities of non-certainty muns, in the order they are sampled in
+        this_mos_noncertainty = mos[this_positions_noncertainty]
+        if this_ng_noncertainty > 0:
+            pi[this_positions_noncertainty] = this_ng_noncertainty * this_mos_noncertainty / this_mos_noncertainty.sum()
+
+        # joint inclusion probabilities of selected muns, the product unless both are non-certainty muns
+        this_pi_selected = pi[this_positions_selected]
+        this_joint = np.outer(this_pi_selected, this_pi_selected)
+        this_source = np.full(this_joint.shape, 'certainty', dtype=object)
+
+        cond_noncertainty = ~certainty[this_positions_selected]
+        if cond_noncertainty.sum() > 1:
+            # selected muns among the non-certainty muns (both in the order of the group)
+            units = np.flatnonzero(selected[this_positions_noncertainty])
+
+            joint = None
+            if len(this_positions_noncertainty) <= exact_max_units:
+                joint = exact_joint_probs(this_mos_noncertainty, this_ng_noncertainty, units, method)
+            if joint is not None:
+                source = 'exact'
+            elif method in spatial_samplers:
+                source = 'simulated'
+                joint = simulated_joint_probs(this_mos_noncertainty, this_ng_noncertainty, units, method, group_id, streams, K,
+                                              coords=muns[['LONG', 'LAT']].values[this_positions_noncertainty])
+            else:
+                source = approximation
+                joint = approx_joint_probs(pi[this_positions_noncertainty], this_ng_noncertainty, units, approximation)
+
+            this_joint[np.ix_(cond_noncertainty, cond_noncertainty)] = joint
+            this_source[np.ix_(cond_noncertainty, cond_noncertainty)] = source
+            count(f"{source} groups")
+
+        # pairs of selected muns
+        i, j = np.triu_indices(len(this_positions_selected), k=1)
+        pairs.append((np.full(len(i), group_id), this_positions_selected[i], this_positions_selected[j], this_joint[i, j], this_source[i, j]))
+
+    weights = muns \
+        .loc[selected, ['Group-ID']] \
+        .assign(
+            Certainty=certainty[selected],
+            pi=pi[selected],
+            Weight=1 / pi[selected],
+        )
+
+    group_ids, positions_1, positions_2, joint, source = (np.concatenate(columns) for columns in zip(*pairs))
+    joint_probs = pd.DataFrame({
+        'Group-ID': group_ids,
+        'pi_ij': joint,
+        'Source': pd.Categorical(source),
+    }, index=pd.MultiIndex.from_arrays([muns.index.values[positions_1], muns.index.values[positions_2]], names=['Mun-ID-1', 'Mun-ID-2']))
+
+    return weights, joint_probs
+
+
+# design weights in user-friendly format, with the labels of muns (see mun_labels)
+def weights_table(weights: pd.DataFrame, labels: pd.DataFrame):
+    return pd.concat([weights, labels.loc[weights.index]], axis=1)
@@ -20,26 +20,35 @@
 # ### Initialisation
 
 # %% [markdown]
-# Importing general-purpose libraries.
+# Importing general-purpose libraries. The pipeline stages are implemented in the `municipality_selection` package, which can also be run headless from the command line via `python -m municipality_selection`.
 
 # %%
 from pathlib import Path
-from urllib.request import urlretrieve
-from requests import request
-from dateutil import parser
-import json
 
 import numpy as np
 import pandas as pd
-from voting import apportionment
+from scipy.spatial import cKDTree
 from samplics import SelectMethod
 from samplics.sampling import SampleSelection
-from samplics.utils import CertaintyError
-import plotly.express as px
-import plotly.graph_objects as go
 
 from IPython.display import display, HTML, Markdown
 
+from municipality_selection.ingest import download_input, input_file_name, load_input
+from municipality_selection.stratify import define_classes, build_group_index, mun_labels
+from municipality_selection.targets import init_params, assign_targets, calc_measure, targets_table
+from municipality_selection.seed import fetch_pulse, seed_ints
+from municipality_selection.samplers import pps_sys_select
+from municipality_selection.select import run_selection
+from municipality_selection.streams import REPLACEMENTS, RandomStreams
+from municipality_selection.letters import calc_letters, results_table
+from municipality_selection.weights import calc_weights, weights_table
+from municipality_selection.replacements import select_replacements, replacements_table
+from municipality_selection.addresses import draw_addresses
+from municipality_selection.stats import calc_probs, calc_iterations, calc_stats, iter_stats, summarise_probs
+from municipality_selection.sweep import sweep_grid, run_sweep
+from municipality_selection.export import write_table
+from municipality_selection.plots import plot_population, plot_population_cumulative, plot_probs, plot_measure, plot_letters
+
 # %% [markdown]
 # Plot pandas dataframes with plotly by default.
 
@@ -69,176 +78,38 @@ for p in [input_path, cache_path, output_path]:
 # Set file name of list of municipalities. This file can be downloaded from the [DESTATIS webpage](https://www.destatis.de/DE/Themen/Laender-Regionen/Regionales/Gemeindeverzeichnis/Administrativ/Archiv/GVAuszugQ/AuszugGV1QAktuell.html). If it is not present, the code will attempt to download it automatically.
 
 # %%
-input_file_path = input_path / 'AuszugGV1QAktuell.xlsx'
-input_file_url = 'https://www.destatis.de/DE/Themen/Laender-Regionen/Regionales/Gemeindeverzeichnis/Administrativ/Archiv/GVAuszugQ/AuszugGV1QAktuell.xlsx?__blob=publicationFile'
+input_file_path = input_path / input_file_name
+download_input(input_file_path)
+
+# %% [markdown]
+# ### Reading and preprocessing data
+
+# %% [markdown]
+# Before reading in the data, we define the size classes. Municipalities (Gemeinden) and states (Bundeslaender) will then be read from input data file.
+#
+# The municipalities are stratified into groups by the keys in `strata`, by default the state and the size class. Any combination of columns can be used, eg also the degree of urbanisation (`Urbanisation`), the Kreis (`Kreis-ID`), or user-defined bins of a column (passed as `bins`). Every key is factorized and the combined codes are factorized again, so that groups are only formed for the combinations present in the data, with dense Group-IDs in the order of the keys. The tables below are laid out for the default strata.
+#
+# To speed up execution, the processed municipality data will be stored in cached files. The cache is keyed on the content hash of the input file, the class definitions, the column specification, and the strata, so it is invalidated automatically whenever any of them changes. The dataframes are stored in the uncompressed Feather format, which is memory-mapped on load. Set `allow_caching` to `False` in order to force reprocessing.
 
-if not (input_file_path.exists() and input_file_path.is_file()):
-    urlretrieve(input_file_url, input_file_path)
+# %%
+allow_caching: bool = True
+strata = ['State-ID', 'Class-ID']
 
+# %%
+classes = define_classes()
+states, muns, groups = load_input(input_file_path, cache_path, classes, allow_caching, strata=strata)
 
 # %% [markdown]
-# ### Reading and preprocessing data
+# To avoid scanning all municipalities for every group, we build an index of the municipalities sorted by group once. The municipalities of each group then form a contiguous slice given by an offset array (as in a compressed sparse row matrix).
+
+# %%
+group_index = build_group_index(muns, groups)
 
 # %% [markdown]
-# Before reading in the data, we define the size classes.
-
-# %%
-def define_classes():
-    # define classes
-    classes = pd.DataFrame.from_records([
-        {'Class-Name': 'Small', 'Threshold': 20000,},
-        {'Class-Name': 'Medium', 'Threshold': 100000,},
-        {'Class-Name': 'Large', 'Threshold': np.inf,},
-    ])
-    
-    # insure that the threshold is monotonic increasing
-    assert classes['Threshold'].is_monotonic_increasing
-    
-    # update index
-    classes.index += 1
-    classes.rename_axis('Class-ID', inplace=True)
-    
-    # add description
-    classes['Class-Desc'] = classes \
-        .assign(Lower=lambda df: df['Threshold'].shift()) \
-        .replace(np.inf, np.nan) \
-        .agg(
-            lambda row: f"{row['Class-Name']} (" 
-                      + (f"≥{row['Lower']}" if not pd.isnull(row['Lower']) else '')
-                      + ('; ' if row.notnull().all() else '')
-                      + (f"<{row['Threshold']}" if not pd.isnull(row['Threshold']) else '')
-                      + ')',
-            axis=1,
-        )
-
-    return classes
-
-
-# %% [markdown]
-# Municipalities (Gemeinden) and states (Bundeslaender) will be read from input data file.
-
-# %%
-# read states and muns from XLSX input file
-def read_from_input(classes: pd.DataFrame):
-    # list of columns to read from file
-    columns = {
-        'A': {'name': 'Satzart', 'dtype': 'str'},
-        'C': {'name': 'State-ID', 'dtype': 'str'},
-        'D': {'name': 'Mun-ID-1', 'dtype': 'str'},
-        'E': {'name': 'Mun-ID-2', 'dtype': 'str'},
-        'F': {'name': 'Mun-ID-3', 'dtype': 'str'},
-        'G': {'name': 'Mun-ID-4', 'dtype': 'str'},
-        'H': {'name': 'Name', 'dtype': 'str'},
-        'J': {'name': 'Nm', 'dtype': 'float64'},
-        'O': {'name': 'LONG', 'dtype': 'float64'},
-        'P': {'name': 'LAT', 'dtype': 'float64'},
-        'T': {'name': 'Urbanisation', 'dtype': 'str'},
-    }
-
-    # read excel to raw dataframe
-    raw_dataframe = pd.read_excel(
-        input_file_path,
-        sheet_name=1,
-        index_col=None,
-        usecols=','.join(list(columns.keys())),
-        names=[col_specs['name'] for col_specs in columns.values()],
-        dtype={col_specs['name']: col_specs['dtype'] for col_specs in columns.values()},
-        decimal=',',
-        skiprows=5,
-    )
-    
-    # obtain states from raw dataframe
-    states = raw_dataframe \
-        .query("Satzart=='10'") \
-        .rename(columns={'Name': 'State-Name'}) \
-        .astype({'State-ID': 'int64'}) \
-        .filter(['State-ID', 'State-Name']) \
-        .set_index('State-ID')
-
-    # obtain municipalities from raw dataframe
-    muns = raw_dataframe \
-        .query("Satzart=='60'") \
-        .rename(columns={'Name': 'Mun-Name'}) \
-        .astype({'State-ID': 'int64'}) \
-        .assign(**{
-            'Mun-ID': lambda df: df.agg("{0[State-ID]}{0[Mun-ID-1]}{0[Mun-ID-2]}{0[Mun-ID-3]}{0[Mun-ID-4]}".format, axis=1),
-            'Mun-Shortname': lambda df: df['Mun-Name'].str.split(',').str[0],
-        }) \
-        .filter(['Mun-ID', 'Mun-Name', 'Mun-Shortname', 'State-ID', 'Nm', 'Urbanisation', 'LONG', 'LAT']) \
-        .set_index('Mun-ID')
-
-    # drop municipalities with zero population
-    muns = muns.loc[muns['Nm'] > 0]
-
-    # add size classes
-    muns['Class-ID'] = muns['Nm'].agg(lambda Nm: (Nm > classes['Threshold']).idxmin())
-
-    # finally, we combine the state and class IDs into groups and compute total pop and share of pop in groups
-    groups = muns \
-        .groupby(['State-ID', 'Class-ID']) \
-        .agg({'Nm': 'sum'}) \
-        .rename(columns={'Nm': 'Ng'}) \
-        .assign(Sg=lambda x: x['Ng'] / x['Ng'].sum()) \
-        .unstack('Class-ID') \
-        .fillna(0) \
-        .stack('Class-ID')
-
-    # add group ID and set as index
-    groups['Group-ID'] = [j + 3*(i-1) for i, j in groups.index.values]
-    groups = groups.reset_index().set_index('Group-ID')
-
-    # add group ID to muns
-    muns = muns \
-        .reset_index() \
-        .merge(groups.filter(['State-ID', 'Class-ID']).reset_index(), on=['State-ID', 'Class-ID']) \
-        .set_index('Mun-ID')
-
-    # assign count of muns in groups
-    groups['Cg'] = 0
-    groups_count = muns.groupby('Group-ID')['Group-ID'].count()
-    groups.loc[groups_count.index, 'Cg'] = groups_count.values
-
-    # sort muns by population
-    muns = muns.sort_values(by=['Nm'], ascending=False)
-
-    return states, muns, groups
-
-
-# %% [markdown]
-# To speed up execution, the processed municipality data will be stored in cached files. Set `allow_caching` to `False` in order to force reprocessing.
-
-# %%
-allow_caching: bool = False
-
-
-# %%
-# read dataframe from cache
-def read_cache(name: str):
-    fpath = cache_path / f"cached_{name}.pkl"
-    return pd.read_pickle(fpath) if fpath.exists() else None
-
-# write dataframe from cache
-def write_cache(name: str, df: pd.DataFrame):
-    fpath = cache_path / f"cached_{name}.pkl"
-    df.to_pickle(fpath)
-
-
-# %%
-# read from cache if allowed
-classes, states, muns, groups = (
-    (read_cache('classes'), read_cache('states'), read_cache('muns'), read_cache('groups'))
-    if allow_caching else
-    (None, None, None, None)
-)
+# The names of the states and size classes of the municipalities are looked up once and shared by the output tables.
 
-# if either of the two is None, caching was either disabled or the file doesn't exist yet, so read from input file and write cache files
-if any(df is None for df in (classes, states, muns, groups)):
-    classes = define_classes()
-    states, muns, groups = read_from_input(classes)
-    write_cache('classes', classes)
-    write_cache('muns', muns)
-    write_cache('states', states)
-    write_cache('groups', groups)
+# %%
+labels = mun_labels(muns, states, classes)
 
 # %%
 display(classes)
@@ -261,54 +132,12 @@ display(groups \
 # Before we proceed, let's first take a closer look at the data.
 
 # %%
-fig = go.Figure(go.Bar(
-    x=muns['Nm'].cumsum()-muns['Nm'],
-    y=muns['Nm'],
-    width=muns['Nm'],
-    offset=0.0,
-    text=muns.where(lambda d: d['Nm'] > 0.5E+6)['Mun-Shortname'],
-    customdata=muns['Mun-Name'],
-    hovertemplate='<br>'.join([
-        '<b>%{customdata}</b>',
-        'Pop: %{y}',
-        '<extra></extra>',
-    ]),
-))
-fig.update_traces(
-    textfont_size=8,
-    textangle=270,
-    textposition='outside',
-    cliponaxis=True,
-)
-fig.update_layout(
-    xaxis_range=[0, 40E+6],
-    yaxis_range=[0, 5E+6],
-    uniformtext_minsize=5,
-    uniformtext_mode='show',
-)
-
-# add horizontal lines to illustrate classes
-for class_id, class_row in classes.iterrows():
-    x0 = muns.iloc[:(muns['Nm'] < class_row['Threshold']).argmax()]['Nm'].sum()
-    fig.add_vline(x=x0)
-    fig.add_annotation(x=x0, xanchor='left', y=4.5E+6, text=class_row['Class-Desc'], showarrow=False)
-
+fig = plot_population(muns, classes)
 display(fig)
 fig.write_image(output_path / 'plot1.png')
 
 # %%
-fig = go.Figure(go.Scatter(
-    x=muns['Nm'].cumsum(),
-    y=muns['Nm'],
-    customdata=muns['Mun-Name'],
-    mode='markers+lines',
-    hovertemplate='<br>'.join([
-        '<b>%{customdata}</b>',
-        'Pop: %{y}',
-        '<extra></extra>',
-    ]),
-))
-
+fig = plot_population_cumulative(muns)
 display(fig)
 fig.write_image(output_path / 'plot2.png')
 
@@ -320,48 +149,24 @@ fig.write_image(output_path / 'plot2.png')
 
 # %%
 # initialise key parameters
-params = {
-    'n*_init': 80,  # initial target for number of municipalities to select
-    'L*': 20000,  # total number of letters to send out
-    'N*': groups['Ng'].sum(),  # total population in Germany
-}
+params = init_params(groups, n_init=80, L=20000)
 
 # %% [markdown]
-# Then we assign targets to the groups via StLague.
+# Targets and numbers of letters are apportioned via the Sainte-Laguë method. We implement it as a divisor method with lower and upper bounds for every party built in, so that the bounds never change the total. The divisor is first estimated from the parties not fixed at their bounds, and the remaining difference to the total is then fixed by assigning (or removing) single seats in order of the Sainte-Laguë priorities $v_i / (a_i \pm 0.5)$ using a heap.
+#
+# Then we assign targets to the groups via StLague. Every group with non-zero population gets at least one target and no group gets more targets than it has muns. As these bounds are part of the apportionment, the total target stays at the initial target.
 
 # %%
-# assign targets via StLague
-groups['ng_init'] = apportionment.sainte_lague(groups['Ng'].values, params['n*_init'])
-groups['ng'] = groups['ng_init']
-
-# ng should at least be one for any group with non-zero population
-cond = (groups['ng'] == 0) & (groups['Ng'] > 0)
-groups.loc[cond, 'ng'] = 1
-
-# Tg should not be greater than Cg
-cond = groups['ng'] > groups['Cg']
-groups.loc[cond, 'ng'] = groups.loc[cond, 'Cg']
-
-# set total target number as new parameter Ttot
-params['n*'] = groups['ng'].sum()
+groups, params = assign_targets(groups, params)
 
 # %% [markdown]
 # Display groups in user-friendly format and dump to Excel spreadsheet file.
 
 # %%
-d = groups \
-    .reset_index() \
-    .join(states, on='State-ID') \
-    .join(classes, on='Class-ID') \
-    .set_index(['State-ID', 'State-Name', 'Class-ID', 'Class-Desc']) \
-    .assign(
-        Sg=lambda df: df['Sg'] * 100,
-    ) \
-    .round(2) \
-    .unstack(['Class-ID', 'Class-Desc'])
+d = targets_table(groups, states, classes, strata)
 
 display(d)
-d.to_excel(output_path / 'municipality_selection_targets.xlsx')
+write_table(d, output_path / 'municipality_selection_targets.xlsx', 'xlsx')
 
 # %% [markdown]
 # Analyse for which groups the initial targets were updated.
@@ -379,33 +184,19 @@ groups \
 # ### Set random seed
 
 # %% [markdown]
-# The random seed will be set via the randomness beacon.
+# The random seed will be set via the randomness beacon. Pulses are verified (output value, signature, and chain to the previous pulse) and cached locally, so rerunning the notebook for the same time string needs no network access.
 
 # %%
 # set timestamp
 timestr = '30 Apr 2024 08:00:00.000 CEST'
-timestamp = int(parser.parse(timestr).timestamp()) * 1000
 
 # request beacon at timestamp
-r = request(method="GET", url=f"https://beacon.nist.gov/beacon/2.0/pulse/time/{timestamp}")
-
-# ensure that status code is not 404, otherwise try again with updated timestr
-if r.status_code == 404:
-    timestr = timestamp = 'LAST'
-    r = request(method="GET", url=f"https://beacon.nist.gov/beacon/2.0/pulse/last")
-
-# load json data
-json_data = json.loads(r.text)
-
-# get output value in hex format
-output_value = json_data['pulse']['outputValue']
+timestr, timestamp, output_value = fetch_pulse(timestr, cache_path / 'beacon')
 
 # convert to list of ints
-l = 8
-chunks = [output_value[y-l:y] for y in range(l, len(output_value)+l, l)]
-ints = [int(c, 16) for c in chunks]
+ints = seed_ints(output_value)
 
-# random seed
+# random seed (only used for the cross-check with samplics below)
 np.random.seed(ints)
 
 # print outputs
@@ -423,7 +214,11 @@ display(Markdown(f"""
 # ### Random selection of municipalities
 
 # %% [markdown]
-# We are using PPS-SYS sampling from the samplics package (probability-proportional-to-size) w/o replacement and w/o stratification. Stratification is done manually by us at the moment.
+# We are using PPS-SYS sampling (probability-proportional-to-size) w/o replacement and w/o stratification, following the implementation in the samplics package. Stratification is done manually by us at the moment.
+#
+# Calling samplics once per group and iteration is slow for large $K$, as every call builds a new dataframe. We therefore implement the same PPS-SYS algorithm in NumPy, drawing the random starts of all groups and iterations at once. Drawn from the global random state, the random starts come in the same order as consecutive samplics calls (group by group, $K$ times each), so the selection is identical for the same random seed.
+#
+# For the actual selection, the random starts are instead drawn from counter-based random streams: every group has its own Philox stream, keyed by the beacon ints, the purpose of the draw (selection or replacements) and the Group-ID, and the random start of iteration $k$ is the $k$-th number of the stream, iteration $0$ being the actual selection. Any single draw can thus be regenerated on its own, and the results do not depend on the order in which groups and iterations are run.
 
 # %%
 # selection method
@@ -438,285 +233,225 @@ pps_sys_sel = SampleSelection(
 
 # %%
 alpha = 0.1
-Nmin = params['L*'] / params['n*'] / alpha
-muns['Mm'] = muns['Nm'] + Nmin / (1 + (muns['Nm'] / Nmin))
-
-
-# %% [markdown]
-# Define function for running selection $K$ times. This will later allows us to repeat the selection multiple times and experimentally tests whether the chances of receiving a letter converge to $\bar q$.
-
-# %%
-def run_selection(K: int = 1):
-    # initialise results dataframes
-    results = muns.copy()
-    results.insert(0, 'Selected', 0)
-    results.insert(1, 'Certainty', False)
-    
-    # loop over groups (with non-zero muns in them)
-    for group_id, group_specs in groups.loc[groups['ng'] != 0.0].iterrows():
-        # get all eligible municipalities
-        this_muns = muns.loc[muns['Group-ID'] == group_id]
-    
-        # get target and count for group
-        this_ng = int(group_specs['ng'])
-        this_Cg = int(group_specs['Cg'])
-    
-        # print for debug
-        #print(f"{states.loc[group_specs['State-ID'], 'State-Name']}, {classes.loc[group_specs['Class-ID'], 'Class-Desc']}")
-    
-        # only select if there are more muns in a group than we want to pick
-        # (eg skip Berlin or Hamburg, as they are the only muns in the respective states)
-        if this_ng == this_Cg:
-            results.loc[this_muns.index, 'Certainty'] = True
-        elif this_ng > this_Cg:
-            raise Exception(
-                f"Cannot select more municipalities than exist in a group. \n\n"
-                f"{group_specs.reset_index()}\n\n"
-                f"{states.loc[group_specs['State-ID']]}\n\n"
-                f"{classes.loc[group_specs['Class-ID']]}"
-            )
-        else:
-            # remove muns with certainty
-            this_muns_noncertainty = this_muns
-            this_muns_certainty = None
-            this_ng_noncertainty = this_ng
-    
-            while True:
-                cond_muns_certainty = (this_muns_noncertainty['Mm'] / this_muns_noncertainty['Mm'].sum() * this_ng_noncertainty) > 1
-                if not cond_muns_certainty.any():
-                    break
-                this_muns_certainty = pd.concat([this_muns_certainty, this_muns_noncertainty.loc[cond_muns_certainty]])
-                this_muns_noncertainty = this_muns_noncertainty.loc[~cond_muns_certainty]
-                this_ng_noncertainty -= int(cond_muns_certainty.sum())
-    
-            # for certainty units update results
-            if this_muns_certainty is not None:
-                results.loc[this_muns_certainty.index, 'Certainty'] = True
-    
-            # for non-certainty muns run sampling K times (so that we can experimentally test the results)
-            for k in range(K):
-                # run pps selection algorithm using samplics package
-                try:
-                    pps_sample = pps_sys_sel.select(
-                        samp_unit=this_muns_noncertainty.index.tolist(),
-                        samp_size=this_ng_noncertainty,
-                        stratum=None,
-                        mos=this_muns_noncertainty['Mm'].values,
-                        to_dataframe=True,
-                        sample_only=False,
-                    )
-                except CertaintyError:
-                    raise Exception(
-                        f"A group contains certainty muns.\n\n"
-                        f"{group_specs}\n\n"
-                        f"{states.loc[group_specs['State-ID']]}\n\n"
-                        f"{classes.loc[group_specs['Class-ID']]}"
-                    )
-    
-                # add number of times selected and correction factors for this group
-                results.loc[pps_sample['_samp_unit'], 'Selected'] += pps_sample['_sample'].astype(int).values
-    
-    # certainty muns are selected every time
-    results.loc[results['Certainty'], 'Selected'] = K
-
-    return results
-
-
-# %% [markdown]
-# Next, we define a function for computing the share of letters to send for each municipality (ie apportionment factors for deviation from $\bar L = L^*/n^*$). Then we calculate the actual final number of letters $L_m$ to send out.
-
-# %%
-def calc_letters(results: pd.DataFrame, check_sum: bool = True):
-    # certainty muns
-    Nm = results.loc[results['Certainty'], 'Nm']
-    results.loc[results['Certainty'], 'AFm'] = Nm / params['N*'] * params['n*']
-
-    # non-certainty muns
-    Nm = results.loc[~results['Certainty'], 'Nm']
-    Mm = results.loc[~results['Certainty'], 'Mm']
-    Mg = results.loc[~results['Certainty']].groupby('Group-ID')['Mm'].transform(sum)
-    ng = results.loc[~results['Certainty']].join(groups[['ng']], on='Group-ID')['ng'] - results.groupby('Group-ID')['Certainty'].transform(sum).loc[~results['Certainty']]
-    results.loc[~results['Certainty'], 'AFm'] = Nm / params['N*'] * params['n*'] / ng * Mg / Mm
-
-    # calculate final number of letters
-    results['Lm'] = params['L*'] / params['n*'] * results['AFm']
-    results.loc[results['Selected'] > 0, 'Lm_rounded'] = apportionment.sainte_lague(results.loc[results['Selected'] > 0, 'AFm'], round(results.loc[r['Selected'] > 0, 'Lm'].sum()))
-
-    return results
+muns = calc_measure(muns, params, alpha=alpha)
+
+# %% [markdown]
+# Cross-check that the NumPy implementation reproduces the samplics selection for the same random state, using the group with the most municipalities.
+
+# %%
+# get muns and target of group with most muns
+check_muns = muns.loc[muns['Group-ID'] == groups['Cg'].idxmax()]
+check_ng = int(groups.loc[groups['Cg'].idxmax(), 'ng'])
+
+# run samplics and NumPy selection K times from the same random state and restore the state afterwards
+random_state = np.random.get_state()
+check_samplics = np.stack([
+    pps_sys_sel.select(
+        samp_unit=check_muns.index.tolist(),
+        samp_size=check_ng,
+        stratum=None,
+        mos=check_muns['Mm'].values,
+        to_dataframe=True,
+        sample_only=False,
+    )['_sample'].astype(int).values
+    for k in range(10)
+])
+np.random.set_state(random_state)
+check_numpy = pps_sys_select(check_muns['Mm'].values, [0, len(check_muns)], [check_ng], K=10)
+np.random.set_state(random_state)
 
+assert (check_samplics == check_numpy).all()
+
+# %% [markdown]
+# Audit a single draw: the random start of iteration $k$ of a group is regenerated directly from its stream, without drawing the iterations before it.
+
+# %%
+streams = RandomStreams(ints)
+audit_group_ids = groups.index[groups['ng'] > 0].tolist()
+assert (streams.random_starts(audit_group_ids, k0=7, K=1)[:, 0] == streams.random_starts(audit_group_ids, K=10)[:, 7]).all()
+
+# %% [markdown]
+# Municipalities whose inclusion probability $n_g \times M_m / M_g$ would exceed one are selected with certainty and removed from the PPS selection. Removing them raises the inclusion probabilities of the remaining muns, which may turn further muns into certainty units. Sorting the muns by measure of size, the certainty units are always the $c$ largest ones, where $c$ is the first count for which the largest remaining mun no longer exceeds one after the $c$ largest are removed. This can be found in a single pass using the suffix sums of the measure of size.
+#
+# The function `run_selection` runs the selection $K$ times. This will later allows us to repeat the selection multiple times and experimentally tests whether the chances of receiving a letter converge to $\bar q$.
+#
+# Next, the function `calc_letters` computes the share of letters to send for each municipality (ie apportionment factors for deviation from $\bar L = L^*/n^*$). Then we calculate the actual final number of letters $L_m$ to send out.
 
 # %% [markdown]
 # We now run the selection once and then calculate the number of letters.
 
 # %%
 # run selection once
-r = run_selection()
+r = run_selection(muns, groups, group_index, streams=streams)
 
 # calculate number of letters
-r = calc_letters(r)
+r = calc_letters(r, muns, groups, params)
 
 # display selected muns and number of letters
 r_sel = r.loc[r['Selected'] > 0]
 display(r_sel['Lm'].sum())
 display(r_sel['Lm_rounded'].sum())
-display(r_sel[['Mun-Name', 'Nm', 'Lm', 'Lm_rounded']])
+display(muns.loc[r_sel.index, ['Mun-Name', 'Nm']].join(r_sel[['Lm', 'Lm_rounded']]))
 
 # %%
-d = r \
-    .loc[r['Selected'] > 0] \
-    .drop(columns=['Selected', 'Certainty']) \
-    .join(states, on='State-ID') \
-    .join(classes, on='Class-ID') \
-    .sort_values(by=['State-ID', 'Class-ID'])
+d = results_table(r, muns, labels)
 
 display(d['Lm_rounded'].sum())
 display(d)
-d.to_excel(output_path / 'municipality_selection_results.xlsx')
+write_table(d, output_path / 'municipality_selection_results.xlsx', 'xlsx')
+
+# %% [markdown]
+# For variance estimation in the assembly survey, we output the design weights $1/\pi_m$ of the selected municipalities and the joint inclusion probabilities $\pi_{ij}$ of all pairs of selected municipalities in the same group (municipalities in different groups are selected independently, as are certainty municipalities). For groups with at most `exact_max_units` non-certainty municipalities, $\pi_{ij}$ is exact: for PPS-SYS it is the overlap of the random starts hitting both municipalities, and for the Sampford and conditional Poisson designs it is found by enumerating all samples. Larger groups (and the designs without exact $\pi_{ij}$) use Hájek's closed-form approximation $\pi_i \pi_j \left(1 - (1 - \pi_i)(1 - \pi_j) / d\right)$ with $d = \sum_k \pi_k (1 - \pi_k)$, or optionally Brewer's, so that the cost only grows with the number of municipalities of a group. These approximations hold for high-entropy designs but not for the local pivotal method, which rarely selects neighbours together, so with `method='lpm'` the $\pi_{ij}$ are instead estimated by simulating `K` iterations of the selection from the random streams (given as `streams`). The `Source` column says how every $\pi_{ij}$ was found.
+
+# %%
+weights, joint_probs = calc_weights(r, muns, groups, group_index, streams=streams)
 
+display(weights_table(weights, labels))
+display(joint_probs['Source'].value_counts())
+write_table(weights_table(weights, labels), output_path / 'municipality_selection_weights.xlsx', 'xlsx')
+write_table(joint_probs, output_path / 'municipality_selection_joint_probs.xlsx', 'xlsx')
 
 # %% [markdown]
 # Finally, we select replacement municipalities for each group.
 
 # %%
-def select_replacements(results: pd.DataFrame, num_repl: int = 5):
-    replacements = None
-    
-    # loop over groups (with non-zero muns in them)
-    for group_id, group_specs in groups.loc[groups['ng'] != 0.0].iterrows():
-        # get all eligible municipalities
-        this_muns = muns.loc[(muns['Group-ID'] == group_id) & (results['Selected'] == 0)]
-        #print(f"{states.loc[group_specs['State-ID'], 'State-Name']}, {classes.loc[group_specs['Class-ID'], 'Class-Desc']}")
-        #display(this_muns)
-    
-        # get target and count for group
-        this_ng = num_repl
-        this_Cg = len(this_muns)
-    
-        # only perform PPS if there are more muns in the groups left than replacements we plan to select
-        if this_ng >= this_Cg:
-            new_replacements = this_muns
-        else:
-            # remove muns with certainty
-            this_muns_noncertainty = this_muns
-            this_muns_certainty = None
-            this_ng_noncertainty = this_ng
-    
-            while True:
-                cond_muns_certainty = (this_muns_noncertainty['Mm'] / this_muns_noncertainty['Mm'].sum() * this_ng_noncertainty) > 1
-                if not cond_muns_certainty.any():
-                    break
-                this_muns_certainty = pd.concat([this_muns_certainty, this_muns_noncertainty.loc[cond_muns_certainty]])
-                this_muns_noncertainty = this_muns_noncertainty.loc[~cond_muns_certainty]
-                this_ng_noncertainty -= int(cond_muns_certainty.sum())
-    
-            # for certainty units update results
-            new_replacements = this_muns_certainty if this_muns_certainty is not None else None
-
-            # run pps selection algorithm using samplics package
-            try:
-                pps_sample = pps_sys_sel.select(
-                    samp_unit=this_muns_noncertainty.index.tolist(),
-                    samp_size=this_ng_noncertainty,
-                    stratum=None,
-                    mos=this_muns_noncertainty['Mm'].values,
-                    to_dataframe=True,
-                    sample_only=False,
-                )
-            except CertaintyError:
-                raise Exception(
-                    f"A group contains certainty muns.\n\n"
-                    f"{group_specs}\n\n"
-                    f"{states.loc[group_specs['State-ID']]}\n\n"
-                    f"{classes.loc[group_specs['Class-ID']]}"
-                )
-
-            new_replacements = pd.concat([
-                new_replacements,
-                this_muns.loc[pps_sample.loc[pps_sample['_sample'] != 0, '_samp_unit']],
-            ])
-
-        replacements = pd.concat([replacements, new_replacements])
-
-    replacements['Lm'] = results.loc[replacements.index, 'Lm']
-    replacements['Lm_rounded'] = replacements['Lm'].round()
-    
-    return replacements
-
-
-# %%
-replacements = select_replacements(r)
-
-# %%
-d = replacements \
-    .join(states, on='State-ID') \
-    .join(classes, on='Class-ID')
+replacements = select_replacements(r, muns, groups, group_index, streams=RandomStreams(ints, REPLACEMENTS))
+
+# %%
+d = replacements_table(replacements, labels)
 
 display(d)
-d.to_excel(output_path / 'municipality_selection_replacements.xlsx')
+write_table(d, output_path / 'municipality_selection_replacements.xlsx', 'xlsx')
+
+# %% [markdown]
+# ### Drawing addresses
+#
+# In the second stage, exactly $L_m$ (rounded) addresses are drawn from the population register of every selected municipality, given as CSV files named by the Mun-ID in `input/registers`. The registers are streamed in chunks with reservoir sampling: every row gets a uniform random key and the rows with the smallest keys seen so far are kept, so memory stays bounded however large the register is. The keys are drawn from a random stream of the municipality derived from the beacon ints, and the municipalities are processed concurrently.
+
+# %%
+register_path = input_path / 'registers'
+if register_path.exists():
+    addresses = draw_addresses(r, register_path, ints)
+
+    display(addresses.groupby(level='Mun-ID').size().describe())
+    write_table(addresses, output_path / 'municipality_selection_addresses.xlsx', 'xlsx')
+
+# %% [markdown]
+# ### Checking probabilities analytically
+
+# %% [markdown]
+# The inclusion probabilities $\pi_m$ follow directly from the design: certainty muns are always selected, and for all other muns PPS-SYS gives $\pi_m = n_g' \times M_m / M_g'$, where $n_g'$ and $M_g'$ are the target and the total measure of size of the non-certainty muns in the group. This gives the probability of receiving a letter $q_m = \pi_m \times \frac{L_m}{N_m}$ for every municipality without any simulation.
+
+# %%
+probs_exact = calc_probs(r, muns, groups, params)
+display(probs_exact)
+display(probs_exact['q_dev'].abs().max())
+
+# %% [markdown]
+# The simulation below remains as a cross-check. The number of times $k_m$ a municipality is selected in $K$ iterations is binomially distributed, so the relative standard error of the estimate $k_m / K$ of $\pi_m$ is $\sqrt{(1 - \pi_m) / (K \pi_m)}$. From this we can compute the number of iterations needed to estimate $q_m$ within a relative tolerance.
+
+# %%
+K_required = calc_iterations(probs_exact)
+display(K_required.describe())
 
 # %% [markdown]
 # ### Checking probabilities experimentally
 
 # %% [markdown]
 # We now select muns $K > 1$ times in order to be able to visualise the convergence of the probability.
+#
+# The iterations are run in batches, and with `workers` set the batches are spread across a process pool. Iteration $k$ draws the $k$-th random start from the stream of every group, so the statistics are identical for any batch size and number of workers, and iteration $0$ reproduces the selection above.
+#
+# The number of times each municipality was selected is stored after every $K$ as a snapshot in an int32 matrix, which is memory-mapped from the cache directory, so that counts for many iterations and snapshots do not have to be held in memory.
 
 # %%
 # Ks = [100, 1000, 2000]  # uncomment for proper statistics
 Ks = [10, 20, 30]
 
+# number of worker processes (set to None to run serially)
+workers = None
+
+# %%
+stats = calc_stats(muns, groups, group_index, ints, Ks, workers=workers, cache_path=cache_path)
+display(stats)
+
+# %% [markdown]
+# Compare the number of times each municipality was selected with the analytic inclusion probabilities via the binomial z-score.
+
 # %%
-K_max_batch = 50  # max number of iterations to do in one batch
+z_scores = stats \
+    .apply(lambda col: (col - col.name * probs_exact['pi']) / np.sqrt(col.name * probs_exact['pi'] * (1 - probs_exact['pi']))) \
+    .replace([np.inf, -np.inf], np.nan)
+display(z_scores.abs().max())
 
+# %% [markdown]
+# #### Spatially balanced sampling
+#
+# PPS-SYS ignores geography, so the municipalities selected in a group can cluster in one corner of a state. As an alternative, the selection can be run with the local pivotal method (`method='lpm'`), which uses the coordinates (`LONG`, `LAT`) of the municipalities: units are visited in random order and each competes with its nearest undecided neighbour, so that neighbours are rarely selected together. The inclusion probabilities are the same as for PPS-SYS. The nearest neighbours of every municipality are looked up once per group in a KD tree and reused for all iterations.
+#
+# We check the inclusion probabilities as above and compare the spread of the samples via the mean distance (in degrees) of every selected municipality to the nearest other selected municipality in its group.
 
-def calc_stats(Ks: list[int]):
-    # check input parameters
-    if any(Ks[i] <= Ks[i-1] for i in range(1, len(Ks))):
-        raise Exception(f"The list of iterations has to be strictly increasing.")
+# %%
+stats_lpm = calc_stats(muns, groups, group_index, ints, Ks, workers=workers, cache_path=cache_path, method='lpm')
+z_scores_lpm = stats_lpm \
+    .apply(lambda col: (col - col.name * probs_exact['pi']) / np.sqrt(col.name * probs_exact['pi'] * (1 - probs_exact['pi']))) \
+    .replace([np.inf, -np.inf], np.nan)
+display(z_scores_lpm.abs().max())
 
-    # loop over iterations
-    stats = pd.DataFrame(index=muns.index)
-    K_prev = 0
-    for K in Ks:
-        print(K)
-        
-        # initialise column for this iteration
-        stats[K] = stats[K_prev] if K_prev else 0
-        
-        # in this iteration run K-K_prev times
-        K_this = K - K_prev
-        while K_this > 0:
-            K_batch = min(K_this, K_max_batch)
-            print(f"-- {K_batch}")
-            results = run_selection(K_batch)
-            K_this -= K_batch
 
-            # add number of times chosen to histogram
-            stats[K] += results['Selected']
+# mean distance of selected muns to the nearest other selected mun in the same group
+def mean_nn_distance(selected: pd.Series):
+    coords = muns.loc[selected.values > 0, ['LONG', 'LAT', 'Group-ID']]
+    return coords \
+        .groupby('Group-ID') \
+        .apply(lambda df: cKDTree(df[['LONG', 'LAT']].values).query(df[['LONG', 'LAT']].values, k=2)[0][:, 1].mean() if len(df) > 1 else np.nan) \
+        .mean()
 
-        # add K to total number of times chosen
-        K_prev = K
 
-    return stats
+display(pd.DataFrame({
+    method: [
+        mean_nn_distance(run_selection(muns, groups, group_index, streams=streams, k0=k, method=method)['Selected'])
+        for k in range(10)
+    ]
+    for method in ['pps_sys', 'lpm']
+}).describe())
 
+# %% [markdown]
+# #### Alternative πps designs
+#
+# Besides PPS-SYS and the local pivotal method, the sampler registry provides the Sampford, conditional Poisson (maximum entropy), and Pareto designs, which draw the samples of all iterations of a group at once. Sampford and conditional Poisson sampling have exactly the inclusion probabilities of PPS-SYS, while those of Pareto sampling are only approximately exact. Their throughput and exactness can be compared with samplics via `python -m benchmarks.samplers`; here we check the z-scores of the inclusion frequencies for the largest $K$.
 
 # %%
-stats = calc_stats(Ks)
-display(stats)
+K_max = max(Ks)
+z_scores_designs = pd.DataFrame({
+    method: run_selection(muns, groups, group_index, K_max, streams=streams, method=method)['Selected']
+    for method in ['sampford', 'conditional_poisson', 'pareto']
+}) \
+    .sub(K_max * probs_exact['pi'], axis=0) \
+    .div(np.sqrt(K_max * probs_exact['pi'] * (1 - probs_exact['pi'])), axis=0) \
+    .replace([np.inf, -np.inf], np.nan)
+display(pd.DataFrame({'max |z|': z_scores_designs.abs().max(), 'mean z^2': (z_scores_designs ** 2).mean()}))
 
 # %% [markdown]
-# Let's calculate and plot the probability of receiving a letter for every citizen in each municipality. This is given by $q_m = \pi_m \times \frac{L_m}{N_m} = \frac{k_m}{K} \times \frac{L_m}{N_m}$, where $k_m$ is the number of times a municipality was selected and $K$ is the number of iterations.
+# Summarise the deviation of $q_m$ from $L^*/N^*$ for every $K$, overall and in every group. The summaries are computed column by column straight from the counts.
+
+# %%
+probs_summary, probs_group_summary = summarise_probs(stats, r, muns, params)
+display(probs_summary)
+display(probs_group_summary.unstack('K'))
+
+# %% [markdown]
+# For long runs, the simulation can also be streamed: the running selection counts are yielded after every round of batches, and the run stops once the maximum relative deviation of $q_m$ from $L^*/N^*$ falls below a tolerance. After every round (or every `K_snapshot` iterations), the counts are added as a snapshot to a memory-mapped count store in the cache directory, so an interrupted run resumes from the last snapshot, continuing the random streams at the number of iterations done. The store is keyed on the beacon ints, the municipalities, and the design (the groups, the measure of size, the targets, and the sampling method), so a run with a different seed, frame, $\alpha$, $L^*$, $n^*$, or method never resumes from it.
 
 # %%
-probs = (stats.apply(lambda col: col * r['Lm'] / r['Nm'])) \
-    .melt(ignore_index=False, var_name='Iterations', value_name='Prob') \
-    .assign(Prob=lambda df: df['Prob'] / df['Iterations'])
-display(probs)
+for stats_K, q_dev in iter_stats(muns, groups, group_index, r, params, ints, cache_path, tol=0.1, K_max=100, workers=workers or 1):
+    print(f"{stats_K.name}: {q_dev:.4f}")
 
-# plot line
-fig = px.line(probs.reset_index(), x='Mun-ID', y='Prob', color='Iterations')
-fig.add_hline(params['L*'] / params['N*'])
-fig.update_layout(xaxis_range=[0, 1000], yaxis_range=[0, 0.0005])
+# %% [markdown]
+# Let's calculate and plot the probability of receiving a letter for every citizen in each municipality. This is given by $q_m = \pi_m \times \frac{L_m}{N_m} = \frac{k_m}{K} \times \frac{L_m}{N_m}$, where $k_m$ is the number of times a municipality was selected and $K$ is the number of iterations.
 
+# %%
+fig = plot_probs(stats, r, muns, params)
 display(fig)
 fig.write_image(output_path / 'plot3.png')
 
@@ -724,37 +459,7 @@ fig.write_image(output_path / 'plot3.png')
 # Let's plot the measure of size ($M_m$) along with the population size ($N_m$) such that we can compare the deviation.
 
 # %%
-fig = go.Figure()
-fig.add_trace(go.Scatter(
-    x=muns['Nm'].cumsum(),
-    y=muns['Nm'],
-    customdata=muns['Mun-Name'],
-    name='Real Population',
-    mode='markers+lines',
-    hovertemplate='<br>'.join([
-        '<b>%{customdata}</b>',
-        'Pop: %{y}',
-        '<extra></extra>',
-    ]),
-))
-fig.add_trace(go.Scatter(
-    x=muns['Nm'].cumsum(),
-    y=muns['Mm'],
-    customdata=muns['Mun-Name'],
-    name='Measure of Size',
-    mode='markers+lines',
-    hovertemplate='<br>'.join([
-        '<b>%{customdata}</b>',
-        'Pop: %{y}',
-        '<extra></extra>',
-    ]),
-))
-
-fig.update_layout(
-    xaxis_range=[60000000.0, 84360000.0],
-    yaxis_range=[0.0, 30000.0],
-)
-
+fig = plot_measure(muns)
 display(fig)
 fig.write_image(output_path / 'plot4.png')
 
@@ -762,13 +467,22 @@ fig.write_image(output_path / 'plot4.png')
 # Let us also plot the number of letters to send in a municipality.
 
 # %%
-fig = px.line(r.assign(Nm_cum=lambda df: df['Nm'].cumsum()), x='Nm_cum', y='Lm')
-fig.add_hline(params['L*'] / params['n*'])
-
-fig.update_layout(
-    xaxis_range=[0, 84360000.0],
-    yaxis_range=[0.0, 800.0],
-)
-
+fig = plot_letters(r, muns, params)
 display(fig)
 fig.write_image(output_path / 'plot5.png')
+
+# %% [markdown]
+# ### Exploring parameters
+
+# %% [markdown]
+# To explore the design decisions, we evaluate a grid of parameters ($n^*_\text{init}$, $L^*$, $\alpha$, and the thresholds of the size classes) at once. All configurations reuse the ingested frame and its group index (the frame is only regrouped for other thresholds) and are spread across a process pool with `workers` set. For every configuration we report $n^*$, the distribution of $L_m$, the number of certainty units, and the spread of $q_m$. Analytically, $q_m$ equals $L^*/N^*$ exactly, so the analytic spread only stems from rounding $L_m$ to whole letters. With `K` set, the selection is also simulated $K$ times per configuration.
+
+# %%
+configs = sweep_grid(
+    n_init=[60, 80, 100],
+    L=[10000, 20000, 40000],
+    alpha=[0.05, 0.1, 0.2],
+    thresholds=[(20000, 100000), (10000, 50000)],
+)
+sweep = run_sweep(muns, groups, group_index, classes, configs, ints=ints, K=0, workers=workers, strata=strata)
+display(sweep)
@@ -0,0 +1,132 @@
+import json
+
+import pytest
+
+from municipality_selection.beacon import BeaconClient, beacon_cache_path, calc_output_value, serialize_pulse
+from municipality_selection.beacon_server import StandInBeacon, serve
+from municipality_selection.seed import fetch_pulse
+
+
+# first pulse of the stand-in beacons at 30 Apr 2024 05:00 UTC, and a time string in the middle of the chain
+start = 1714453200000
+timestr = '2024-04-30T05:10:30+00:00'
+timestamp = start + 10 * 60000 + 30000
+pulse_index = 11
+
+
+# sign a modified pulse again with the key of the beacon, so that only the modification can be detected
+def resign(beacon: StandInBeacon, pulse: dict):
+    pulse['signatureValue'] = beacon._sign(serialize_pulse(pulse)).hex().upper()
+    pulse['outputValue'] = calc_output_value(pulse)
+
+
+# stand-in beacon that does not serve pulses by index
+class UnchainedBeacon(StandInBeacon):
+    def respond(self, path: str):
+        if '/chain/' in path:
+            self.requests.append(path)
+            return 404, 'text/plain', b'Not found'
+        return super().respond(path)
+
+
+@pytest.fixture
+def beacon():
+    return StandInBeacon(start, num_pulses=20)
+
+
+def test_round_trip(beacon, tmp_path):
+    with serve(beacon) as url:
+        result = fetch_pulse(timestr, tmp_path, url)
+
+    assert result == (timestr, timestamp, beacon.pulse(pulse_index)['outputValue'])
+
+
+def test_rerun_from_cache(beacon, tmp_path):
+    with serve(beacon) as url:
+        result = fetch_pulse(timestr, tmp_path, url)
+        num_requests = len(beacon.requests)
+
+        assert fetch_pulse(timestr, tmp_path, url) == result
+        assert fetch_pulse(timestr, tmp_path, url, offline=True) == result
+        assert len(beacon.requests) == num_requests
+
+
+def test_last_fallback(beacon, tmp_path):
+    with serve(beacon) as url, pytest.warns(UserWarning, match='using the last pulse'):
+        result = fetch_pulse('2024-05-01T00:00:00+00:00', tmp_path, url)
+
+    assert result == ('LAST', 'LAST', beacon.last_pulse()['outputValue'])
+
+
+def test_offline(beacon, tmp_path):
+    with serve(beacon) as url:
+        with pytest.raises(Exception, match='offline'):
+            fetch_pulse(timestr, tmp_path, url, offline=True)
+        with pytest.raises(Exception, match='cache path is required'):
+            BeaconClient(url, offline=True)
+
+    assert beacon.requests == []
+
+
+def test_corrupted_cache(beacon, tmp_path):
+    with serve(beacon) as url:
+        result = fetch_pulse(timestr, tmp_path, url)
+
+        fpath = beacon_cache_path(tmp_path, url) / f"pulse_1_{pulse_index}.json"
+        pulse = json.loads(fpath.read_text())
+        pulse['localRandomValue'] = '00' * 64
+        fpath.write_text(json.dumps(pulse))
+
+        with pytest.raises(Exception, match='offline'):
+            fetch_pulse(timestr, tmp_path, url, offline=True)
+        assert not fpath.exists()
+
+        assert fetch_pulse(timestr, tmp_path, url) == result
+        assert json.loads(fpath.read_text()) == beacon.pulse(pulse_index)
+
+
+def test_separate_caches(tmp_path):
+    beacon, other = StandInBeacon(start, num_pulses=20), StandInBeacon(start, num_pulses=20, seed=1)
+    with serve(beacon) as url, serve(other) as other_url:
+        result = fetch_pulse(timestr, tmp_path, url)
+        result_other = fetch_pulse(timestr, tmp_path, other_url)
+
+    assert result[2] == beacon.pulse(pulse_index)['outputValue']
+    assert result_other[2] == other.pulse(pulse_index)['outputValue']
+
+
+def test_tampered_output_value(beacon, tmp_path):
+    beacon.pulse(pulse_index)['outputValue'] = '00' * 64
+
+    with serve(beacon) as url, pytest.raises(Exception, match='output value .* does not match its content'):
+        fetch_pulse(timestr, tmp_path, url)
+
+
+def test_tampered_signature(beacon, tmp_path):
+    pulse = beacon.pulse(pulse_index)
+    pulse['localRandomValue'] = '00' * 64
+    pulse['outputValue'] = calc_output_value(pulse)
+
+    with serve(beacon) as url, pytest.raises(Exception, match='signature .* is invalid'):
+        fetch_pulse(timestr, tmp_path, url)
+
+
+def test_tampered_certificate(beacon, tmp_path):
+    beacon.certificate = StandInBeacon(start, num_pulses=20).certificate
+
+    with serve(beacon) as url, pytest.raises(Exception, match='certificate does not match'):
+        fetch_pulse(timestr, tmp_path, url)
+
+
+def test_broken_chain(beacon, tmp_path):
+    pulse = beacon.pulse(pulse_index)
+    pulse['listValues'][0]['value'] = '00' * 64
+    resign(beacon, pulse)
+
+    with serve(beacon) as url, pytest.raises(Exception, match='does not list the output value'):
+        fetch_pulse(timestr, tmp_path, url)
+
+
+def test_missing_previous_pulse(tmp_path):
+    with serve(UnchainedBeacon(start, num_pulses=20)) as url, pytest.raises(Exception, match='was not found'):
+        fetch_pulse(timestr, tmp_path, url)